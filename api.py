@@ -0,0 +1,591 @@
+"""JSON API: accounts, chat (plain and streamed), history, search and export."""
+import datetime
+import logging
+import math
+import uuid
+
+from flask import (Blueprint, Response, current_app, jsonify, make_response, request, session, stream_with_context,
+                   url_for)
+
+from batch import batch_args
+from context import load_turns
+from conversations import serialize_conversation
+from export import EXPORT_FORMATS, accepts_gzip, chat_records, encode, export_args, gzip_chunks
+from credentials import CredentialsBusy, authenticate
+from extensions import (auth_cache, batch_jobs, chat_compactor, chat_context, chat_writes, gemini, password_hasher,
+                        rate_limiter, related_index,
+                        response_cache)
+from gemini_client import CircuitOpenError, UpstreamError, extract_text
+from http_cache import not_modified, tag, version_etag
+from logs import log_event
+from metrics import StageTimer, token_authorized
+from models import ChatArchive, ChatHistory, Conversation, User, db, restore_conversation
+from pagination import keyset, page, page_args
+from quota import refund_token, reserve_token
+from related import related_args, related_conversations
+from response_cache import cache_requested
+from search import search_args, search_chats
+from sse import SSE_HEADERS, sse_event
+
+bp = Blueprint('api', __name__)
+
+# Turn away chat requests over the rate limits before they reach the database or upstream
+@bp.before_request
+def limit_chat_rate():
+    if request.method != 'POST' or request.endpoint not in ('api.chat', 'api.chat_stream', 'api.chat_batch'):
+        return None
+    # A batch counts against the user's limit once per prompt
+    cost = 1
+    if request.endpoint == 'api.chat_batch':
+        data = request.get_json(silent=True)
+        prompts = data.get('prompts') if isinstance(data, dict) else None
+        cost = max(1, len(prompts)) if isinstance(prompts, list) else 1
+    wait = rate_limiter.check(session.get('user_id'), request.remote_addr, cost=cost)
+    if wait is None:
+        return None
+    return jsonify({"error": "Too many requests, please try again later"}), 429, {'Retry-After': str(wait)}
+
+def upstream_failed(error):
+    # While the circuit breaker is open, tell clients when it is worth trying again
+    if isinstance(error, CircuitOpenError):
+        return jsonify({"error": "The AI service is temporarily unavailable, please try again later"}), 503, \
+            {'Retry-After': str(math.ceil(error.retry_after))}
+    return jsonify({"error": "Failed to get response from API"}), 500
+
+def credentials_busy(error):
+    # The password hashing queue is full: shed the request rather than let it wait
+    return jsonify({"error": "Too many sign-ins right now, please try again shortly"}), 503, \
+        {'Retry-After': str(error.retry_after)}
+
+def user_not_found():
+    # The session outlived its account: forget it, so the client logs in again
+    session.pop('user_id', None)
+    return jsonify({"error": "User not found"}), 404
+
+# User registration endpoint
+@bp.route('/api/register', methods=['POST'])
+def register():
+    data = request.json
+    email = data.get('email')
+    password = data.get('password')
+
+    if User.query.filter_by(email=email).first():
+        return jsonify({"message": "Email already registered"}), 400
+    # Hand the connection back while the password is hashed
+    db.session.rollback()
+
+    user = User(email=email)
+    try:
+        user.password = password_hasher.hash(password)
+    except CredentialsBusy as e:
+        return credentials_busy(e)
+    db.session.add(user)
+    db.session.commit()
+    # SQLite may reuse a deleted user's id
+    auth_cache.invalidate(user.id)
+
+    return jsonify({"message": "User registered successfully"}), 201
+
+# User login endpoint
+@bp.route('/api/login', methods=['POST'])
+def login():
+    data = request.json
+    email = data.get('email')
+    password = data.get('password')
+    try:
+        user = authenticate(db.session, User, password_hasher, email, password)
+    except CredentialsBusy as e:
+        return credentials_busy(e)
+
+    if user:
+        # Save user ID in session; the row just read also primes the auth cache
+        session['user_id'] = user.id
+        auth_cache.put(user)
+        
+        # Check subscription status
+        subscription_status = "Subscribed" if user.is_subscribed() else "Not Subscribed"
+        
+        return jsonify({
+            "message": "Login successful",
+            "subscription_status": subscription_status
+        }), 200
+    
+    return jsonify({"message": "Invalid credentials"}), 401
+
+# User logout endpoint
+@bp.route('/api/logout', methods=['POST'])
+def logout():
+    user_id = session.pop('user_id', None)
+    if user_id is not None:
+        auth_cache.invalidate(user_id)
+    return jsonify({"message": "Logged out successfully"}), 200
+
+# Chat creation endpoint
+@bp.route('/api/chat', methods=['POST'])
+def chat():
+    if 'user_id' not in session:
+        return jsonify({"error": "Unauthorized, please log in"}), 401
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request body must be a JSON object"}), 400
+    message = data.get('message')
+    title = data.get('title', 'General')
+
+    if not message:
+        return jsonify({"error": "Message is required"}), 400
+
+    # Time each stage of the chat: user load, quota, cache, context, upstream, parsing and save
+    stages = StageTimer(request.endpoint)
+
+    # Read back this user's queued chats first, before this request holds a DB connection
+    if data.get('conversation_id'):
+        chat_writes.wait(session['user_id'])
+    user = auth_cache.get(session['user_id'], User.query.get)
+    if user is None:
+        return user_not_found()
+    user_id = user.id
+
+    # Continue an existing conversation when the client passes its id
+    conversation_id = data.get('conversation_id')
+    conversation = None
+    if conversation_id:
+        conversation = Conversation.query.filter_by(id=conversation_id, user_id=user.id).first()
+        if not conversation:
+            return jsonify({"error": "Conversation not found"}), 404
+        if conversation.archived_at is not None:
+            # Its chats move back from the archive before the earlier turns are read
+            restore_conversation(db.session, conversation_id)
+    else:
+        conversation_id = str(uuid.uuid4())  # Generate unique conversation ID
+    stages.lap('load_user')
+
+    # Reserve a token before calling upstream (subscribers are unmetered); it is refunded if the chat fails
+    metered = not user.is_subscribed()
+    if metered and not reserve_token(db.session, User, user_id, daily_refill=current_app.config['TOKEN_DAILY_REFILL'],
+                                     auth_cache=auth_cache):
+        return jsonify({"error": "No tokens left, please subscribe or wait for refill"}), 403
+    stages.lap('quota')
+
+    # Serve repeated prompts from the response cache unless the client opted out;
+    # only an answer that opens a conversation depends on the prompt alone
+    use_cache = cache_requested(request) and conversation is None
+    # Cached answers are kept per model, under the one this prompt would be routed to first
+    model = gemini.choose(message, subscribed=not metered)[0]
+    chat_response = response_cache.get(message, model) if use_cache else None
+    stages.lap('cache')
+
+    if chat_response is None:
+        # Prepare request to external API, with the conversation's earlier turns
+        payload = chat_context.build_payload(
+            conversation, message, lambda skip: load_turns(ChatHistory, user_id, conversation_id, skip)
+        )
+        # The chat itself may be saved by the write-behind worker, so persist any new summary now
+        if db.session.dirty:
+            db.session.commit()
+        stages.lap('context')
+
+        # The router fails over between models; the clients count and log every upstream call, failures included
+        try:
+            model, response = gemini.generate_content(payload, subscribed=not metered)
+        except UpstreamError as e:
+            if metered:
+                refund_token(db.session, User, user_id, auth_cache=auth_cache)
+            return upstream_failed(e)
+        stages.lap('upstream')
+
+        if response.status_code != 200:
+            if metered:
+                refund_token(db.session, User, user_id, auth_cache=auth_cache)
+            return jsonify({"error": "Failed to get response from API"}), 500
+
+        try:
+            chat_response = extract_text(response.json())
+        except ValueError as e:
+            log_event('upstream_response_invalid', logging.WARNING, model=model, error=repr(e))
+            if metered:
+                refund_token(db.session, User, user_id, auth_cache=auth_cache)
+            return jsonify({"error": "Failed to get response from API"}), 500
+        if use_cache and chat_response != 'No response':
+            response_cache.set(message, model, chat_response)
+        stages.lap('parse')
+
+    # Store chat in database (queued when write-behind is on, so the response does not wait on the commit)
+    chat_writes.put(user_id, (dict(
+        user_id=user_id,
+        conversation_id=conversation_id,
+        title=title,
+        message=message,
+        response=chat_response,
+        timestamp=datetime.datetime.utcnow(),
+        model=model
+    ), title))
+    chat_context.record_turn(conversation_id, message, chat_response)
+    stages.lap('save')
+
+    return jsonify({
+        "conversation_id": conversation_id,
+        "message": message,
+        "response": chat_response,
+        "model": model
+    }), 200
+
+# Streaming chat endpoint: relays upstream chunks to the browser as server-sent events
+@bp.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    if 'user_id' not in session:
+        return jsonify({"error": "Unauthorized, please log in"}), 401
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request body must be a JSON object"}), 400
+    message = data.get('message')
+    title = data.get('title', 'General')
+
+    if not message:
+        return jsonify({"error": "Message is required"}), 400
+
+    # Time each stage of the chat; the relay and save stages end inside the stream
+    stages = StageTimer(request.endpoint)
+
+    # Read back this user's queued chats first, before this request holds a DB connection
+    if data.get('conversation_id'):
+        chat_writes.wait(session['user_id'])
+    user = auth_cache.get(session['user_id'], User.query.get)
+    if user is None:
+        return user_not_found()
+    user_id = user.id
+
+    # Continue an existing conversation when the client passes its id
+    conversation_id = data.get('conversation_id')
+    conversation = None
+    if conversation_id:
+        conversation = Conversation.query.filter_by(id=conversation_id, user_id=user.id).first()
+        if not conversation:
+            return jsonify({"error": "Conversation not found"}), 404
+        if conversation.archived_at is not None:
+            # Its chats move back from the archive before the earlier turns are read
+            restore_conversation(db.session, conversation_id)
+    else:
+        conversation_id = str(uuid.uuid4())  # Generate unique conversation ID
+    stages.lap('load_user')
+
+    # Reserve a token before calling upstream (subscribers are unmetered); it is refunded if the chat fails
+    metered = not user.is_subscribed()
+    if metered and not reserve_token(db.session, User, user_id, daily_refill=current_app.config['TOKEN_DAILY_REFILL'],
+                                     auth_cache=auth_cache):
+        return jsonify({"error": "No tokens left, please subscribe or wait for refill"}), 403
+    stages.lap('quota')
+
+    payload = chat_context.build_payload(
+        conversation, message, lambda skip: load_turns(ChatHistory, user_id, conversation_id, skip)
+    )
+    # The stream below runs in a fresh DB session, so persist any new summary now
+    db.session.commit()
+    stages.lap('context')
+
+    # A cached answer is sent as a single chunk
+    use_cache = cache_requested(request) and conversation is None
+    model = gemini.choose(message, subscribed=not metered)[0]
+    cached_response = response_cache.get(message, model) if use_cache else None
+    stages.lap('cache')
+
+    if cached_response is None:
+        try:
+            model, upstream = gemini.stream_generate_content(payload, subscribed=not metered)
+        except UpstreamError as e:
+            if metered:
+                refund_token(db.session, User, user_id, auth_cache=auth_cache)
+            return upstream_failed(e)
+
+        if upstream.status_code != 200:
+            upstream.close()
+            if metered:
+                refund_token(db.session, User, user_id, auth_cache=auth_cache)
+            return jsonify({"error": "Failed to get response from API"}), 500
+        chunks = gemini.iter_stream_text(upstream)
+        stages.lap('upstream')
+    else:
+        chunks = iter([cached_response])
+
+    def save(parts):
+        chat_response = ''.join(parts) or 'No response'
+        chat_writes.put(user_id, (dict(
+            user_id=user_id,
+            conversation_id=conversation_id,
+            title=title,
+            message=message,
+            response=chat_response,
+            timestamp=datetime.datetime.utcnow(),
+            model=model
+        ), title))
+        chat_context.record_turn(conversation_id, message, chat_response)
+        return chat_response
+
+    def stream_failed(parts, error):
+        log_event('upstream_stream_failed', logging.WARNING, received=len(parts), error=repr(error))
+        if metered:
+            refund_token(db.session, User, user_id, auth_cache=auth_cache)
+
+    def generate():
+        parts = []
+        try:
+            for text in chunks:
+                parts.append(text)
+                yield sse_event({"text": text})
+        except GeneratorExit:
+            # The browser went away mid-answer; finish reading so the chat is still saved
+            try:
+                parts.extend(chunks)
+            except (UpstreamError, ValueError) as e:
+                stream_failed(parts, e)
+            else:
+                save(parts)
+            raise
+        except (UpstreamError, ValueError) as e:
+            stream_failed(parts, e)
+            yield sse_event({"error": "Failed to get response from API"}, event='error')
+            return
+        stages.lap('stream')
+
+        chat_response = save(parts)
+        if use_cache and cached_response is None and parts:
+            response_cache.set(message, model, chat_response)
+        stages.lap('save')
+        yield sse_event({
+            "conversation_id": conversation_id,
+            "message": message,
+            "response": chat_response,
+            "model": model
+        }, event='done')
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+# Batch chat endpoint: many prompts, each opening a conversation, answered in the background (see batch.py)
+@bp.route('/api/chat/batch', methods=['POST'])
+def chat_batch():
+    if 'user_id' not in session:
+        return jsonify({"error": "Unauthorized, please log in"}), 401
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request body must be a JSON object"}), 400
+    try:
+        prompts = batch_args(data, batch_jobs.max_prompts)
+    except ValueError:
+        return jsonify({"error": f"Send prompts as a list of 1 to {batch_jobs.max_prompts} messages"}), 400
+
+    user = auth_cache.get(session['user_id'], User.query.get)
+    if user is None:
+        return user_not_found()
+    user_id = user.id
+
+    # One token per prompt, reserved all at once; failed prompts' tokens come back when the job ends
+    metered = not user.is_subscribed()
+    if metered and not reserve_token(db.session, User, user_id, daily_refill=current_app.config['TOKEN_DAILY_REFILL'],
+                                     auth_cache=auth_cache, count=len(prompts)):
+        return jsonify({"error": "Not enough tokens left for this batch, please subscribe or wait for refill"}), 403
+
+    job_id = batch_jobs.submit(user_id, prompts, subscribed=not metered, metered=metered,
+                               use_cache=cache_requested(request))
+    return jsonify({
+        "job_id": job_id,
+        "status": "running",
+        "count": len(prompts),
+        "status_url": url_for('.chat_batch_status', job_id=job_id),
+        "stream_url": url_for('.chat_batch_stream', job_id=job_id)
+    }), 202
+
+# Poll a batch job: its status and the results so far, in prompt order
+@bp.route('/api/chat/batch/<job_id>', methods=['GET'])
+def chat_batch_status(job_id):
+    if 'user_id' not in session:
+        return jsonify({"error": "Unauthorized, please log in"}), 401
+
+    job = batch_jobs.status(db.session, session['user_id'], job_id)
+    if job is None:
+        return jsonify({"error": "Batch job not found"}), 404
+    return jsonify(job), 200
+
+# Stream a batch job's results as server-sent events as they arrive, then a "done" event
+@bp.route('/api/chat/batch/<job_id>/stream', methods=['GET'])
+def chat_batch_stream(job_id):
+    if 'user_id' not in session:
+        return jsonify({"error": "Unauthorized, please log in"}), 401
+
+    user_id = session['user_id']
+    if batch_jobs.status(db.session, user_id, job_id) is None:
+        return jsonify({"error": "Batch job not found"}), 404
+
+    def generate():
+        for event, data in batch_jobs.follow(db.session, user_id, job_id):
+            yield sse_event(data, event=event)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+# Response cache hit/miss counters, plus per-model health, latency and coalescing, the auth cache, chat storage,
+# the related-conversations index and batch jobs. Like /metrics, it needs METRICS_TOKEN when that is set,
+# and a login otherwise
+@bp.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    if current_app.config.get('METRICS_TOKEN'):
+        if not token_authorized(request):
+            return jsonify({"error": "Unauthorized"}), 401
+    elif 'user_id' not in session:
+        return jsonify({"error": "Unauthorized, please log in"}), 401
+    return jsonify(dict(response_cache.stats(), models=gemini.stats(), write_behind=chat_writes.stats(),
+                        auth=auth_cache.stats(), storage=chat_compactor.stats(),
+                        related=related_index.stats(), batch=batch_jobs.stats())), 200
+
+# Fetch chat by conversation and user
+@bp.route('/api/chat/<conversation_id>', methods=['GET'])
+def get_chat_by_id(conversation_id):
+    if 'user_id' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    chat_writes.wait(session['user_id'])
+    user = auth_cache.get(session['user_id'], User.query.get)
+    if user is None:
+        return user_not_found()
+
+    # The conversation only changes when a message is added to it
+    summary = Conversation.query.filter_by(id=conversation_id, user_id=user.id).first()
+    etag = version_etag(request.full_path, 'conversation', user.id, summary.message_count if summary else 0)
+    if (cached := not_modified(request, etag)) is not None:
+        return cached
+
+    if summary is not None and summary.archived_at is not None:
+        restore_conversation(db.session, conversation_id)
+    chat = ChatHistory.query.filter_by(user_id=user.id, conversation_id=conversation_id).first()
+
+    if not chat:
+        return jsonify({"error": "Chat not found"}), 404
+
+    return tag(make_response(jsonify({
+        "conversation_id": chat.conversation_id,
+        "title": chat.title,
+        "message": chat.message,
+        "response": chat.response,
+        "timestamp": chat.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+        "model": chat.model
+    }), 200), etag)
+
+# List the logged-in user's conversations, most recently active first
+@bp.route('/api/conversations', methods=['GET'])
+def get_conversations():
+    if 'user_id' not in session:
+        return jsonify({"message": "Unauthorized, please log in"}), 401
+
+    try:
+        limit, cursor = page_args(request.args)
+    except ValueError:
+        return jsonify({"message": "Invalid limit or cursor"}), 400
+
+    chat_writes.wait(session['user_id'])
+    # Read the row rather than the auth cache: its history_version is what the ETag must reflect
+    user = User.query.get(session['user_id'])
+    if not user:
+        return jsonify({"message": "User not found"}), 404
+
+    etag = version_etag(request.full_path, 'conversations', user.id, user.history_version)
+    if (cached := not_modified(request, etag)) is not None:
+        return cached
+
+    query = Conversation.query.filter_by(user_id=user.id)
+    conversations, next_cursor = page(keyset(query, Conversation, limit, cursor, column='updated_at'), limit, column='updated_at')
+
+    return tag(make_response(jsonify({
+        "conversations": [serialize_conversation(conversation) for conversation in conversations],
+        "next_cursor": next_cursor
+    })), etag)
+
+# Get all chat history for logged-in user
+@bp.route('/api/chat_history', methods=['GET'])
+def get_chat_history():
+    if 'user_id' not in session:
+        return jsonify({"message": "Unauthorized, please log in"}), 401
+
+    chat_writes.wait(session['user_id'])
+    # Read the row rather than the auth cache: its history_version is what the ETag must reflect
+    user = User.query.get(session['user_id'])
+    if not user:
+        return jsonify({"message": "User not found"}), 404
+
+    try:
+        limit, cursor = page_args(request.args)
+    except ValueError:
+        return jsonify({"message": "Invalid limit or cursor"}), 400
+
+    # Unchanged since the client's copy: answer without loading any chats
+    etag = version_etag(request.full_path, 'history', user.id, user.history_version)
+    if (cached := not_modified(request, etag)) is not None:
+        return cached
+
+    # Newest first, one page at a time
+    chats, next_cursor = page(keyset(ChatHistory.query.filter_by(user_id=user.id), ChatHistory, limit, cursor), limit)
+
+    chat_history = [
+        {
+            "conversation_id": chat.conversation_id,
+            "title": chat.title,
+            "message": chat.message,
+            "response": chat.response,
+            "timestamp": chat.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+            "model": chat.model
+        }
+        for chat in chats
+    ]
+
+    return tag(make_response(jsonify({"chat_history": chat_history, "next_cursor": next_cursor})), etag)
+
+# Search the logged-in user's chat history, best match first
+@bp.route('/api/chat_history/search', methods=['GET'])
+def search_chat_history():
+    if 'user_id' not in session:
+        return jsonify({"message": "Unauthorized, please log in"}), 401
+
+    try:
+        query, limit, offset = search_args(request.args)
+    except ValueError:
+        return jsonify({"message": "Invalid q, limit or cursor"}), 400
+
+    chat_writes.wait(session['user_id'])
+    results, next_cursor = search_chats(db.session, ChatHistory, session['user_id'], query, limit, offset)
+    return jsonify({"results": results, "next_cursor": next_cursor})
+
+# The logged-in user's past conversations most like `q`, or like the conversation `conversation_id`
+@bp.route('/api/related', methods=['GET'])
+def related_chats():
+    if 'user_id' not in session:
+        return jsonify({"message": "Unauthorized, please log in"}), 401
+
+    try:
+        text, conversation_id, limit = related_args(request.args)
+    except ValueError:
+        return jsonify({"message": "Invalid q, conversation_id or limit"}), 400
+
+    user_id = session['user_id']
+    chat_writes.wait(user_id)
+    related = related_conversations(db.session, related_index, ChatHistory, Conversation, user_id, text,
+                                    conversation_id, limit)
+    return jsonify({"related": related})
+
+# Stream the logged-in user's whole chat history (only chats after `since` when given)
+@bp.route('/api/chat_history/export', methods=['GET'])
+def export_chat_history():
+    if 'user_id' not in session:
+        return jsonify({"message": "Unauthorized, please log in"}), 401
+
+    try:
+        export_format, since = export_args(request.args)
+    except ValueError:
+        return jsonify({"message": "Invalid format or since"}), 400
+
+    user_id = session['user_id']
+    chat_writes.wait(user_id)
+    body = encode(chat_records(db.session, ChatHistory, user_id, since, ChatArchive=ChatArchive), export_format)
+    headers = {'Content-Disposition': f'attachment; filename=chat_history.{export_format}', 'Vary': 'Accept-Encoding'}
+    if accepts_gzip(request):
+        body = gzip_chunks(body)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(body), mimetype=EXPORT_FORMATS[export_format], headers=headers)
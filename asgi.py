@@ -0,0 +1,404 @@
+"""Asyncio serving mode for the JSON chat API in app.py.
+
+Run it with an ASGI server, e.g. `uvicorn asgi:application`.
+
+POST /api/chat (new or continued conversations), GET /api/chat/<conversation_id> and GET /api/chat_history are
+served on the event loop with an async upstream client and async DB sessions,
+so a slow Gemini call no longer holds a worker thread. Every other route is
+handed to the Flask app unchanged, and both sides share the same session
+cookie, models and database.
+"""
+import asyncio
+import datetime
+import json
+import logging
+import math
+import re
+import uuid
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qsl
+
+from asgiref.wsgi import WsgiToAsgi
+from itsdangerous import BadSignature
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from werkzeug.http import parse_etags
+
+from app import app
+from context import load_turns
+from conversations import new_summary, summary_update
+from database import apply_profile
+from gemini_client import CircuitOpenError, UpstreamError, extract_text
+from http_cache import CACHE_CONTROL, history_version_update, version_etag
+from logs import log_event
+from metrics import StageTimer
+from models import ChatHistory, Conversation, User, db, restore_conversation
+from pagination import keyset, page, page_args
+from quota import refund_statement, reserve_statement
+from search import index_chats
+
+# Async drivers used in place of the sync ones from SQLALCHEMY_DATABASE_URI
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+    'mysql': 'mysql+aiomysql',
+}
+
+CHAT_BY_ID = re.compile(r'^/api/chat/(?P<conversation_id>[^/]+)$')
+
+
+def async_database_url(url):
+    driver = url.drivername.split('+')[0]
+    return url.set(drivername=ASYNC_DRIVERS.get(driver, url.drivername))
+
+
+class ChatASGI:
+    """ASGI app that serves the chat/history endpoints natively and proxies the rest to Flask."""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+
+        with flask_app.app_context():
+            url = db.engine.url
+        connect_args = {'timeout': 30} if url.drivername.startswith('sqlite') else {}
+        self.engine = create_async_engine(async_database_url(url), connect_args=connect_args)
+        apply_profile(self.engine, flask_app.config)
+        self.sessionmaker = async_sessionmaker(self.engine, expire_on_commit=False)
+        # The Flask app's model router, whose async clients share its breakers and health stats
+        self.router = flask_app.extensions['gemini']
+        self.rate_limiter = flask_app.extensions['rate_limiter']
+        self.auth_cache = flask_app.extensions['auth_cache']
+        self.chat_context = flask_app.extensions['chat_context']
+        self.chat_writes = flask_app.extensions['chat_writes']
+        self.serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+
+        if scope['type'] == 'http':
+            path, method = scope['path'], scope['method']
+            if path == '/api/chat' and method == 'POST':
+                await self.chat(scope, receive, send)
+                return
+            if path == '/api/chat_history' and method == 'GET':
+                await self.get_chat_history(scope, send)
+                return
+            match = CHAT_BY_ID.match(path)
+            if match and method == 'GET':
+                await self.get_chat_by_id(scope, send, match.group('conversation_id'))
+                return
+
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.router.close_async()
+                await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def load_session(self, scope):
+        """Decode the Flask session cookie so logins made through Flask carry over."""
+        cookie = SimpleCookie()
+        for name, value in scope['headers']:
+            if name == b'cookie':
+                cookie.load(value.decode('latin-1'))
+        morsel = cookie.get(self.flask_app.config['SESSION_COOKIE_NAME'])
+        if morsel is None or self.serializer is None:
+            return {}
+        max_age = int(self.flask_app.permanent_session_lifetime.total_seconds())
+        try:
+            return self.serializer.loads(morsel.value, max_age=max_age)
+        except BadSignature:
+            return {}
+
+    # Chat creation endpoint
+    async def chat(self, scope, receive, send):
+        user_id = self.load_session(scope).get('user_id')
+
+        # Same limits as the Flask hook; the memory backend is shared since both run in this process
+        client = scope.get('client')
+        wait = self.rate_limiter.check(user_id, client[0] if client else None)
+        if wait is not None:
+            await send_json(send, {"error": "Too many requests, please try again later"}, 429,
+                            headers=[(b'retry-after', str(wait).encode())])
+            return
+
+        if user_id is None:
+            await send_json(send, {"error": "Unauthorized, please log in"}, 401)
+            return
+
+        try:
+            data = json.loads(await read_body(receive) or b'{}')
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            await send_json(send, {"error": "Request body must be a JSON object"}, 400)
+            return
+        message = data.get('message')
+        title = data.get('title', 'General')
+
+        if not message:
+            await send_json(send, {"error": "Message is required"}, 400)
+            return
+
+        # Read back chats the Flask routes queued for this user before continuing one of their conversations
+        conversation_id = data.get('conversation_id')
+        if conversation_id:
+            await asyncio.to_thread(self.chat_writes.wait, user_id)
+
+        # Reserve a token before calling upstream (subscribers are unmetered); it is refunded if the chat fails.
+        # The session only connects if the user is not in the auth cache, has to be metered or continues a conversation
+        stages = StageTimer('asgi.chat')
+        async with self.sessionmaker() as dbs:
+            user = self.auth_cache.cached(user_id)
+            if user is None:
+                user = await dbs.get(User, user_id)
+                if user is None:
+                    await send_json(send, {"error": "User not found"}, 404)
+                    return
+                self.auth_cache.put(user)
+
+            # Continue an existing conversation when the client passes its id
+            conversation = None
+            if conversation_id:
+                conversation = (await dbs.execute(
+                    select(Conversation).filter_by(id=conversation_id, user_id=user_id)
+                )).scalar_one_or_none()
+                if conversation is None:
+                    await send_json(send, {"error": "Conversation not found"}, 404)
+                    return
+                if conversation.archived_at is not None:
+                    # Its chats move back from the archive before the earlier turns are read
+                    await dbs.run_sync(restore_conversation, conversation_id)
+            else:
+                conversation_id = str(uuid.uuid4())
+            stages.lap('load_user')
+            metered = not user.is_subscribed()
+            if metered:
+                now = datetime.datetime.utcnow()
+                daily_refill = self.flask_app.config['TOKEN_DAILY_REFILL']
+                reserved = False
+                if not self.auth_cache.out_of_tokens(user_id, now, daily_refill):
+                    reserved = (await dbs.execute(reserve_statement(User, user_id, now, daily_refill))).rowcount == 1
+                    await dbs.commit()
+                    if reserved:
+                        self.auth_cache.reserved(user_id, now, daily_refill)
+                    else:
+                        self.auth_cache.exhausted(user_id)
+                if not reserved:
+                    await send_json(send, {"error": "No tokens left, please subscribe or wait for refill"}, 403)
+                    return
+            stages.lap('quota')
+
+            payload = await self.build_payload(dbs, conversation, message, user_id)
+            # Persist any new summary of the earlier turns now
+            if dbs.dirty:
+                await dbs.commit()
+            stages.lap('context')
+
+        # No DB connection is held while waiting on the upstream call
+        # The router fails over between models; the clients retry, count and log every upstream call
+        try:
+            model, status, response_data = await self.router.generate_content_async(payload, subscribed=not metered)
+        except CircuitOpenError as e:
+            if metered:
+                await self.refund(user_id)
+            await send_json(send, {"error": "The AI service is temporarily unavailable, please try again later"}, 503,
+                            headers=[(b'retry-after', str(math.ceil(e.retry_after)).encode())])
+            return
+        except UpstreamError:
+            status = None
+        stages.lap('upstream')
+
+        if status != 200:
+            if metered:
+                await self.refund(user_id)
+            await send_json(send, {"error": "Failed to get response from API"}, 500)
+            return
+
+        try:
+            chat_response = extract_text(response_data)
+        except ValueError as e:
+            log_event('upstream_response_invalid', logging.WARNING, model=model, error=repr(e))
+            if metered:
+                await self.refund(user_id)
+            await send_json(send, {"error": "Failed to get response from API"}, 500)
+            return
+        stages.lap('parse')
+
+        async with self.sessionmaker() as dbs:
+            record = ChatHistory(
+                user_id=user_id,
+                conversation_id=conversation_id,
+                title=title,
+                message=message,
+                response=chat_response,
+                model=model
+            )
+            dbs.add(record)
+            await dbs.flush()
+            await dbs.run_sync(index_chats, [(record.id, user_id, title, message, chat_response)])
+            now = datetime.datetime.utcnow()
+            if not (await dbs.execute(summary_update(Conversation, conversation_id, message, now))).rowcount:
+                dbs.add(new_summary(Conversation, user_id, conversation_id, title, message, now))
+            await dbs.execute(history_version_update(User, [user_id]))
+            await dbs.commit()
+        self.chat_context.record_turn(conversation_id, message, chat_response)
+        stages.lap('save')
+
+        await send_json(send, {
+            "conversation_id": conversation_id,
+            "message": message,
+            "response": chat_response,
+            "model": model
+        }, 200)
+
+    async def build_payload(self, dbs, conversation, message, user_id):
+        """chat_context.build_payload() run in a thread, since summarizing older turns calls upstream.
+
+        The turns it needs are read through `dbs` back on the event loop.
+        """
+        if conversation is None:
+            return self.chat_context.build_payload(None, message, None)
+        loop = asyncio.get_running_loop()
+
+        def turns(skip):
+            return asyncio.run_coroutine_threadsafe(dbs.run_sync(
+                lambda session: load_turns(ChatHistory, user_id, conversation.id, skip, session)
+            ), loop).result()
+
+        return await asyncio.to_thread(self.chat_context.build_payload, conversation, message, turns)
+
+    async def refund(self, user_id):
+        async with self.sessionmaker() as dbs:
+            await dbs.execute(refund_statement(User, user_id))
+            await dbs.commit()
+        self.auth_cache.refunded(user_id)
+
+    # Fetch chat by conversation and user
+    async def get_chat_by_id(self, scope, send, conversation_id):
+        user_id = self.load_session(scope).get('user_id')
+        if user_id is None:
+            await send_json(send, {"error": "Unauthorized"}, 401)
+            return
+
+        # Read back chats the Flask routes queued for this user, before taking a connection
+        await asyncio.to_thread(self.chat_writes.wait, user_id)
+        async with self.sessionmaker() as dbs:
+            # Same ETag as the Flask view, so either server can answer the revalidation
+            summary = (await dbs.execute(
+                select(Conversation.message_count, Conversation.archived_at).filter_by(id=conversation_id, user_id=user_id)
+            )).first()
+            etag = version_etag(full_path(scope), 'conversation', user_id, summary.message_count if summary else 0)
+            if if_none_match(scope).contains_weak(etag):
+                await send_not_modified(send, etag)
+                return
+
+            if summary is not None and summary.archived_at is not None:
+                await dbs.run_sync(restore_conversation, conversation_id)
+
+            chat = (await dbs.execute(
+                select(ChatHistory).filter_by(user_id=user_id, conversation_id=conversation_id).limit(1)
+            )).scalar_one_or_none()
+
+        if not chat:
+            await send_json(send, {"error": "Chat not found"}, 404)
+            return
+
+        await send_json(send, serialize_chat(chat), 200, headers=etag_headers(etag))
+
+    # Get all chat history for logged-in user
+    async def get_chat_history(self, scope, send):
+        user_id = self.load_session(scope).get('user_id')
+        if user_id is None:
+            await send_json(send, {"message": "Unauthorized, please log in"}, 401)
+            return
+
+        try:
+            limit, cursor = page_args(dict(parse_qsl(scope['query_string'].decode())))
+        except ValueError:
+            await send_json(send, {"message": "Invalid limit or cursor"}, 400)
+            return
+
+        await asyncio.to_thread(self.chat_writes.wait, user_id)
+        async with self.sessionmaker() as dbs:
+            user = await dbs.get(User, user_id)
+            if user is None:
+                await send_json(send, {"message": "User not found"}, 404)
+                return
+
+            etag = version_etag(full_path(scope), 'history', user_id, user.history_version)
+            if if_none_match(scope).contains_weak(etag):
+                await send_not_modified(send, etag)
+                return
+
+            statement = keyset(select(ChatHistory).filter_by(user_id=user_id), ChatHistory, limit, cursor)
+            chats, next_cursor = page((await dbs.execute(statement)).scalars(), limit)
+
+        await send_json(send, {
+            "chat_history": [serialize_chat(chat) for chat in chats],
+            "next_cursor": next_cursor
+        }, 200, headers=etag_headers(etag))
+
+
+def serialize_chat(chat):
+    return {
+        "conversation_id": chat.conversation_id,
+        "title": chat.title,
+        "message": chat.message,
+        "response": chat.response,
+        "timestamp": chat.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+        "model": chat.model
+    }
+
+
+def full_path(scope):
+    # Matches Flask's request.full_path, which the ETags are computed over
+    return f"{scope['path']}?{scope['query_string'].decode('latin-1')}"
+
+
+def if_none_match(scope):
+    return parse_etags(next((value.decode('latin-1') for name, value in scope['headers'] if name == b'if-none-match'), None))
+
+
+def etag_headers(etag):
+    return [(b'etag', f'W/"{etag}"'.encode()), (b'cache-control', CACHE_CONTROL.encode())]
+
+
+async def send_not_modified(send, etag):
+    await send({'type': 'http.response.start', 'status': 304, 'headers': etag_headers(etag)})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def send_json(send, data, status, headers=()):
+    body = json.dumps(data, sort_keys=True).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+            *headers,
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+application = ChatASGI(app)
@@ -0,0 +1,151 @@
+"""Short-lived, per-process cache of who a session's user is and what they may do.
+
+Most authenticated requests only need the user's id, subscription and token
+balance, so these are kept for AUTH_CACHE_TTL seconds instead of being read from
+the user row on every call. This process drops or updates an entry as soon as it
+changes one of them (registration, login, logout, subscription, token
+reservations and refunds). Changes made by another worker show up once the entry
+expires, so the TTL bounds how stale a multi-worker deployment can be. The token
+balance is only used to turn away users who are known to be out of tokens: the
+reservation UPDATE in quota.py stays authoritative.
+"""
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from models import subscription_active
+from quota import DAILY_TOKENS, REFILL_INTERVAL
+
+# Defaults used when an app does not override them in its config
+DEFAULT_TTL = 30
+DEFAULT_MAX_ENTRIES = 10000
+
+
+class AuthEntry(namedtuple('AuthEntry', 'id subscription_plan subscription_expiry token_count last_token_update')):
+    """The parts of a User row the request handlers need; it stands in for the row."""
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.subscription_plan, user.subscription_expiry, user.token_count, user.last_token_update)
+
+    def is_subscribed(self):
+        return subscription_active(self.subscription_plan, self.subscription_expiry)
+
+    def refill_due(self, now, daily_refill=True):
+        return daily_refill and (self.last_token_update is None or self.last_token_update <= now - REFILL_INTERVAL)
+
+    def out_of_tokens(self, now, daily_refill=True):
+        return self.token_count is not None and self.token_count <= 0 and not self.refill_due(now, daily_refill)
+
+
+class AuthCache:
+    """LRU of AuthEntry by user id, with per-entry expiry; a TTL of 0 turns it off."""
+
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.quota_rejections = 0  # reservations refused without an UPDATE
+        self._entries = OrderedDict()  # user id -> (AuthEntry, expires at)
+        self._invalidations = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            ttl=config.get('AUTH_CACHE_TTL', DEFAULT_TTL),
+            max_entries=config.get('AUTH_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES),
+        )
+
+    def cached(self, user_id):
+        """The user's AuthEntry if it is cached and fresh, else None (for callers that load the row themselves)."""
+        with self._lock:
+            cached = self._entries.get(user_id)
+            if cached is not None and cached[1] > time.monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return cached[0]
+            self.misses += 1
+            return None
+
+    def get(self, user_id, load):
+        """The user's AuthEntry, calling `load(user_id)` for the row on a miss; None if there is no such user."""
+        invalidations = self._invalidations
+        entry = self.cached(user_id)
+        if entry is not None:
+            return entry
+        user = load(user_id)
+        if user is None:
+            return None
+        entry = AuthEntry.from_user(user)
+        # A row read before a concurrent invalidation may already be out of date, so it is not kept
+        if invalidations == self._invalidations:
+            self._store(entry)
+        return entry
+
+    def put(self, user):
+        """Cache a User row that was just read or written anyway, e.g. at login."""
+        self._store(AuthEntry.from_user(user))
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self._invalidations += 1
+
+    def _store(self, entry):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[entry.id] = (entry, time.monotonic() + self.ttl)
+            self._entries.move_to_end(entry.id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _change(self, user_id, change):
+        """Replace the cached entry, if any, with `change(entry)`, keeping its expiry."""
+        with self._lock:
+            cached = self._entries.get(user_id)
+            if cached is not None:
+                self._entries[user_id] = (change(cached[0]), cached[1])
+
+    def out_of_tokens(self, user_id, now, daily_refill=True):
+        """Whether the cached balance says a reservation would fail, so it need not be tried."""
+        with self._lock:
+            cached = self._entries.get(user_id)
+            if cached is None or cached[1] <= time.monotonic() or not cached[0].out_of_tokens(now, daily_refill):
+                return False
+            self.quota_rejections += 1
+            return True
+
+    def reserved(self, user_id, now, daily_refill=True, count=1):
+        """Mirror a successful reservation (and the refill it may have included) in the cached balance."""
+        def take(entry):
+            if entry.refill_due(now, daily_refill):
+                return entry._replace(token_count=DAILY_TOKENS - count, last_token_update=now)
+            if entry.token_count is None:
+                return entry
+            return entry._replace(token_count=max(entry.token_count - count, 0))
+        self._change(user_id, take)
+
+    def exhausted(self, user_id):
+        self._change(user_id, lambda entry: entry._replace(token_count=0))
+
+    def refunded(self, user_id, count=1):
+        def give_back(entry):
+            if entry.token_count is None:
+                return entry
+            return entry._replace(token_count=min(entry.token_count + count, DAILY_TOKENS))
+        self._change(user_id, give_back)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "quota_rejections": self.quota_rejections,
+            # Each hit skips the user row read, each quota rejection the reservation UPDATE
+            "db_reads_saved": self.hits + self.quota_rejections,
+        }
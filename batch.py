@@ -0,0 +1,337 @@
+"""Batch chats: many prompts in one request, answered in the background.
+
+POST /api/chat/batch reserves one token per prompt with a single UPDATE (all or
+none), records a batch_job row and answers with the job id straight away. Each
+prompt opens its own conversation. The prompts go to the model router on a pool
+of BATCH_CONCURRENCY threads per process, shared by every batch, so a batch of
+hundreds keeps only that many upstream calls in flight. Each call also waits
+its turn under the global rate limit instead of being refused.
+
+When the last prompt is answered, models.save_batch() writes every chat in one
+bulk INSERT, with the conversation summaries, search entries, the refund of
+failed prompts' tokens and the job's results, in one transaction.
+
+The process running a job has each answer as it arrives, and the poll and
+stream routes read them there. Other processes read the batch_job row, which
+has the results once the job has ended. When the pool is closed (at exit, after
+the interpreter has let running prompts finish), jobs still running end as
+usual: what was answered is saved and the other prompts fail and get their
+tokens back. Only a process killed outright leaves its jobs "running".
+
+A batch is charged against the per-user rate limit by its number of prompts
+(see RateLimiter.check), so batches cannot get round it.
+"""
+import atexit
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from context import user_turn
+from gemini_client import UpstreamError, extract_text
+from logs import log_event
+from metrics import BATCH_PROMPTS
+
+# Defaults used when an app does not override them in its config
+DEFAULT_CONCURRENCY = 8
+DEFAULT_MAX_PROMPTS = 500
+POLL_INTERVAL = 1.0  # seconds between reads of a job running in another process, while streaming it
+
+
+def batch_args(data, max_prompts):
+    """(message, title) pairs from a JSON body of "prompts" (strings or {"message", "title"}) and a default "title".
+
+    Raises ValueError on bad input.
+    """
+    prompts = data.get('prompts')
+    if not isinstance(prompts, list) or not 0 < len(prompts) <= max_prompts:
+        raise ValueError(f"prompts must be a list of 1 to {max_prompts} messages")
+    title = data.get('title', 'General')
+    pairs = []
+    for prompt in prompts:
+        if isinstance(prompt, dict):
+            prompt, prompt_title = prompt.get('message'), prompt.get('title', title)
+        else:
+            prompt_title = title
+        if not isinstance(prompt, str) or not prompt.strip():
+            raise ValueError("every prompt needs a message")
+        pairs.append((prompt, prompt_title))
+    return pairs
+
+
+def serialize_job(job):
+    """A BatchJob row as the poll route returns it."""
+    results = json.loads(job.results) if job.results else []
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "count": job.prompt_count,
+        "completed": len(results),
+        "failed": job.failed_count,
+        "created_at": job.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+        "finished_at": job.finished_at.strftime('%Y-%m-%d %H:%M:%S') if job.finished_at else None,
+        "results": results,
+    }
+
+
+class _Job:
+    """A batch running in this process: its prompts and the results so far, in the order they arrived."""
+
+    def __init__(self, job_id, user_id, prompts, subscribed, metered, use_cache, created_at):
+        self.id = job_id
+        self.user_id = user_id
+        self.prompts = prompts
+        self.subscribed = subscribed
+        self.metered = metered
+        self.use_cache = use_cache
+        self.created_at = created_at
+        self.results = []
+        self.status = 'running'
+        self.abandoned = False
+        self.changed = threading.Condition()
+
+    def record(self, result):
+        """Add one prompt's result; True for the last one. Results arriving after abandon() are dropped."""
+        with self.changed:
+            if self.abandoned:
+                return False
+            self.results.append(result)
+            self.changed.notify_all()
+            return len(self.results) == len(self.prompts)
+
+    def abandon(self, error):
+        """Fail every prompt that has no result yet; returns how many (0 if the job is already finishing)."""
+        with self.changed:
+            if self.abandoned or len(self.results) == len(self.prompts):
+                return 0
+            answered = {result['index'] for result in self.results}
+            failed = [{"index": index, "message": message, "error": error}
+                      for index, (message, _) in enumerate(self.prompts) if index not in answered]
+            self.results.extend(failed)
+            self.abandoned = True
+            self.changed.notify_all()
+            return len(failed)
+
+    def end(self, status):
+        with self.changed:
+            self.status = status
+            self.changed.notify_all()
+
+    def snapshot(self):
+        with self.changed:
+            results = sorted(self.results, key=lambda result: result['index'])
+            status = self.status
+        return {
+            "job_id": self.id,
+            "status": status,
+            "count": len(self.prompts),
+            "completed": len(results),
+            "failed": sum(1 for result in results if 'error' in result),
+            "created_at": self.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            "finished_at": None,
+            "results": results,
+        }
+
+
+class BatchJobs:
+    """Runs batch jobs on a bounded per-process pool and finishes each with `save` (models.save_batch).
+
+    Prompts are answered through the app's model router, response cache and
+    rate limiter, looked up in app.extensions when they run.
+    """
+
+    def __init__(self, app, session, BatchJob, save, concurrency=DEFAULT_CONCURRENCY, max_prompts=DEFAULT_MAX_PROMPTS):
+        self.app = app
+        self.session = session
+        self.BatchJob = BatchJob
+        self.save = save
+        self.concurrency = concurrency
+        self.max_prompts = max_prompts
+        self.submitted = 0
+        self._jobs = {}  # job id -> _Job, while it runs here
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    @classmethod
+    def from_config(cls, app, session, BatchJob, save):
+        config = app.config
+        return cls(
+            app,
+            session,
+            BatchJob,
+            save,
+            concurrency=config.get('BATCH_CONCURRENCY', DEFAULT_CONCURRENCY),
+            max_prompts=config.get('BATCH_MAX_PROMPTS', DEFAULT_MAX_PROMPTS),
+        )
+
+    @property
+    def executor(self):
+        # Started on first use in each process; a forked worker must not share its parent's threads
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(self.concurrency, thread_name_prefix='chat-batch')
+                    self._jobs = {}
+                    self._pid = os.getpid()
+        return self._executor
+
+    def submit(self, user_id, prompts, subscribed, metered, use_cache=True):
+        """Record a job for `prompts` ((message, title) pairs, tokens already reserved) and start it; returns its id."""
+        job = _Job(str(uuid.uuid4()), user_id, prompts, subscribed, metered, use_cache, datetime.datetime.utcnow())
+        self.session.add(self.BatchJob(id=job.id, user_id=user_id, prompt_count=len(prompts),
+                                       created_at=job.created_at))
+        self.session.commit()
+        executor = self.executor
+        with self._lock:
+            self._jobs[job.id] = job
+            self.submitted += 1
+        for index in range(len(prompts)):
+            executor.submit(self._answer, job, index)
+        return job.id
+
+    def _answer(self, job, index):
+        message, title = job.prompts[index]
+        result = {"index": index, "message": message}
+        try:
+            with self.app.app_context():
+                result.update(self._generate(job, message, title))
+        except Exception as e:
+            log_event('batch_prompt_failed', logging.WARNING, job_id=job.id, index=index, error=repr(e))
+            result["error"] = "Failed to get response from API"
+        BATCH_PROMPTS.inc(outcome='failed' if 'error' in result else result.pop('outcome'))
+        if job.record(result):
+            self._finish(job)
+
+    def _generate(self, job, message, title):
+        router = self.app.extensions['gemini']
+        cache = self.app.extensions['response_cache']
+        model = router.choose(message, subscribed=job.subscribed)[0]
+        response_text = cache.get(message, model) if job.use_cache else None
+        outcome = 'cached'
+        if response_text is None:
+            self.app.extensions['rate_limiter'].wait_global()
+            try:
+                model, response = router.generate_content({"contents": [user_turn(message)]}, subscribed=job.subscribed)
+            except UpstreamError:
+                return {"error": "Failed to get response from API"}
+            if response.status_code != 200:
+                return {"error": "Failed to get response from API"}
+            response_text = extract_text(response.json())
+            if job.use_cache and response_text != 'No response':
+                cache.set(message, model, response_text)
+            outcome = 'answered'
+        return {"conversation_id": str(uuid.uuid4()), "title": title, "response": response_text, "model": model,
+                "outcome": outcome}
+
+    def _finish(self, job):
+        results = sorted(job.results, key=lambda result: result['index'])
+        chats = [
+            dict(user_id=job.user_id, conversation_id=result['conversation_id'], title=result['title'],
+                 message=result['message'], response=result['response'], timestamp=datetime.datetime.utcnow(),
+                 model=result['model'])
+            for result in results if 'error' not in result
+        ]
+        refund = len(results) - len(chats) if job.metered else 0
+        try:
+            with self.app.app_context():
+                try:
+                    self.save(self.session, job.id, job.user_id, chats, results, refund)
+                except Exception as e:
+                    # Nothing was saved: report every prompt as failed and give all the tokens back
+                    log_event('batch_save_failed', logging.ERROR, job_id=job.id, error=repr(e))
+                    self.session.rollback()
+                    results = [{"index": result['index'], "message": result['message'],
+                                "error": "Failed to save the chat"} for result in results]
+                    chats, refund = [], len(results) if job.metered else 0
+                    self.save(self.session, job.id, job.user_id, chats, results, refund)
+                if refund:
+                    self.app.extensions['auth_cache'].refunded(job.user_id, refund)
+            log_event('batch_finished', job_id=job.id, prompts=len(results), saved=len(chats))
+        except Exception as e:
+            log_event('batch_save_failed', logging.ERROR, job_id=job.id, error=repr(e))
+            chats = []
+        finally:
+            with self._lock:
+                self._jobs.pop(job.id, None)
+            job.end('done' if chats else 'failed')
+
+    def _local(self, user_id, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id) if self._pid == os.getpid() else None
+        return job if job is not None and job.user_id == user_id else None
+
+    def status(self, session, user_id, job_id):
+        """The user's job as the poll route returns it, or None if there is no such job."""
+        job = self._local(user_id, job_id)
+        if job is not None:
+            return job.snapshot()
+        row = session.query(self.BatchJob).filter_by(id=job_id, user_id=user_id).first()
+        return serialize_job(row) if row is not None else None
+
+    def follow(self, session, user_id, job_id):
+        """Yield ('result', result) as the job's prompts are answered, then ('done', summary).
+
+        Nothing is yielded if there is no such job.
+        """
+        job = self._local(user_id, job_id)
+        if job is not None:
+            sent = 0
+            while True:
+                with job.changed:
+                    while len(job.results) == sent and job.status == 'running':
+                        job.changed.wait()
+                    fresh, status = job.results[sent:], job.status
+                for result in fresh:
+                    yield 'result', result
+                sent += len(fresh)
+                if status != 'running':
+                    break
+            # The results were saved before the job ended; the row has the final outcome
+            session.expire_all()
+
+        while True:
+            row = session.query(self.BatchJob).filter_by(id=job_id, user_id=user_id).first()
+            if row is None:
+                return
+            if row.status != 'running':
+                break
+            session.rollback()  # let go of the connection between reads
+            time.sleep(POLL_INTERVAL)
+        summary = serialize_job(row)
+        if job is None:
+            for result in summary.pop('results'):
+                yield 'result', result
+        else:
+            summary.pop('results')
+        yield 'done', summary
+
+    def close(self):
+        """Stop the pool; jobs still running here are finished with their unanswered prompts failed."""
+        with self._lock:
+            executor = self._executor if self._pid == os.getpid() else None
+            jobs = list(self._jobs.values()) if executor is not None else []
+            self._executor = None
+            self._pid = None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        for job in jobs:
+            failed = job.abandon("The server stopped before this prompt was answered")
+            if failed:
+                BATCH_PROMPTS.inc(failed, outcome='failed')
+                self._finish(job)
+
+    def stats(self):
+        with self._lock:
+            jobs = list(self._jobs.values()) if self._pid == os.getpid() else []
+        return {
+            "running": len(jobs),
+            "pending": sum(len(job.prompts) - len(job.results) for job in jobs),
+            "submitted": self.submitted,
+            "concurrency": self.concurrency,
+        }
@@ -0,0 +1,176 @@
+"""Load test: in-flight chat capacity of the threaded WSGI app vs the ASGI mode.
+
+Fires --concurrency simultaneous POST /api/chat requests at each server, with a
+local fake Gemini answering after --latency seconds. The fake upstream and each
+server run in their own process so they do not share the load generator's GIL.
+
+Usage: python bench_asgi.py [--concurrency 500] [--latency 1.0] [--threads 16]
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+import aiohttp
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class PooledWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    """WSGI server with a fixed number of worker threads, like `gunicorn --threads N`."""
+
+    request_queue_size = 1024
+    threads = 16
+
+    def process_request(self, request, client_address):
+        if not hasattr(self, 'executor'):
+            self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+
+def unlimited():
+    # Every benchmark chat comes from one user and one IP, so the rate limits would cap it
+    from app import app
+
+    rate_limiter = app.extensions['rate_limiter']
+    rate_limiter.user_limit = rate_limiter.ip_limit = rate_limiter.global_limit = None
+
+
+def serve_wsgi(port, threads):
+    from app import app
+
+    unlimited()
+    PooledWSGIServer.threads = threads
+    make_server('127.0.0.1', port, app, server_class=PooledWSGIServer, handler_class=QuietHandler).serve_forever()
+
+
+def serve_asgi(port):
+    import uvicorn
+
+    from asgi import application
+
+    unlimited()
+    uvicorn.run(application, port=port, backlog=2048, log_level='warning')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"nothing listening on port {port}")
+
+
+def spawn(args, env, port):
+    process = subprocess.Popen([sys.executable] + args, env=env, stdout=subprocess.DEVNULL)
+    wait_for_port(port)
+    return process
+
+
+async def drive(base_url, concurrency):
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    # unsafe=True keeps the session cookie for a bare 127.0.0.1 host
+    jar = aiohttp.CookieJar(unsafe=True)
+    async with aiohttp.ClientSession(base_url, connector=connector, cookie_jar=jar) as client:
+        async with client.post('/api/login', json={'email': 'bench@example.com', 'password': 'bench'}):
+            pass
+
+        async def one(i):
+            start = time.perf_counter()
+            async with client.post('/api/chat', json={'message': f"prompt {i}"}) as response:
+                await response.read()
+                return time.perf_counter() - start, response.status
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(one(i) for i in range(concurrency)))
+        return time.perf_counter() - start, results
+
+
+def report(label, elapsed, results):
+    latencies = sorted(latency for latency, _ in results)
+    errors = sum(1 for _, status in results if status != 200)
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+    print(f"{label:<6} wall={elapsed:6.2f}s throughput={len(results) / elapsed:7.1f} chats/s "
+          f"p50={pct(0.50):6.2f}s p95={pct(0.95):6.2f}s p99={pct(0.99):6.2f}s errors={errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--concurrency', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=1.0, help="fake Gemini delay in seconds")
+    parser.add_argument('--threads', type=int, default=16, help="WSGI worker threads")
+    parser.add_argument('--serve-wsgi', type=int, metavar='PORT', help=argparse.SUPPRESS)
+    parser.add_argument('--serve-asgi', type=int, metavar='PORT', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_wsgi:
+        serve_wsgi(args.serve_wsgi, args.threads)
+        return
+    if args.serve_asgi:
+        serve_asgi(args.serve_asgi)
+        return
+
+    # Keep benchmark rows out of the real database
+    gemini_port = free_port()
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{tempfile.mkdtemp()}/bench.db",
+        GEMINI_API_URL=f"http://127.0.0.1:{gemini_port}/v1beta/models/gemini-1.5-flash-latest:generateContent",
+    )
+    os.environ.update(env)
+    from app import app
+    from models import User, db, init_db
+
+    with app.app_context():
+        init_db()
+        user = User(email='bench@example.com')
+        user.set_password('bench')
+        user.subscription_expiry = datetime.date.today() + datetime.timedelta(days=30)
+        db.session.add(user)
+        db.session.commit()
+
+    fake = spawn(['fake_gemini.py', '--port', str(gemini_port), '--latency', str(args.latency)], env, gemini_port)
+    print(f"{args.concurrency} concurrent chats, upstream latency {args.latency}s, {args.threads} WSGI threads")
+    try:
+        for label in ('wsgi', 'asgi'):
+            port = free_port()
+            if label == 'wsgi':
+                server_args = [__file__, '--serve-wsgi', str(port), '--threads', str(args.threads)]
+            else:
+                server_args = [__file__, '--serve-asgi', str(port)]
+            server = spawn(server_args, env, port)
+            try:
+                report(label, *asyncio.run(drive(f"http://127.0.0.1:{port}", args.concurrency)))
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        fake.terminate()
+        fake.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""Throughput of one client sending many prompts: serial /api/chat calls vs one /api/chat/batch job.
+
+The app runs in its own process with a scratch SQLite database, no rate limits
+and the fake Gemini (see fake_gemini.py) answering after --latency seconds. A
+subscribed user then sends --prompts distinct prompts:
+
+    serial  one POST /api/chat after another, as integrations do today
+    batch   one POST /api/chat/batch, then its results streamed until "done",
+            with BATCH_CONCURRENCY set to --concurrency
+
+Reported per mode: wall time, prompts per second and failed prompts.
+
+Usage: python bench_batch.py [--prompts 200] [--latency 0.2] [--concurrency 8]
+"""
+import argparse
+import datetime
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from wsgiref.simple_server import make_server
+
+import requests
+
+from bench_asgi import PooledWSGIServer, QuietHandler, free_port, spawn, wait_for_port
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PASSWORD = 'bench'
+
+
+def serve(port, concurrency):
+    """Child process: the JSON API with a subscribed bench user, schema in place and limits off."""
+    from app import app
+    from models import User, db
+
+    app.test_cli_runner().invoke(args=['init-db'])
+    rate_limiter = app.extensions['rate_limiter']
+    rate_limiter.user_limit = rate_limiter.ip_limit = rate_limiter.global_limit = None
+    app.extensions['batch_jobs'].concurrency = concurrency
+    with app.app_context():
+        user = User(email='batch@example.com', password=app.extensions['password_hasher'].hash(PASSWORD),
+                    subscription_plan='unlimited', subscription_expiry=datetime.date.max)
+        db.session.add(user)
+        db.session.commit()
+
+    make_server('127.0.0.1', port, app, server_class=PooledWSGIServer, handler_class=QuietHandler).serve_forever()
+
+
+def login(base_url):
+    client = requests.Session()
+    client.post(f"{base_url}/api/login", json={'email': 'batch@example.com', 'password': PASSWORD}).raise_for_status()
+    return client
+
+
+def serial(base_url, prompts):
+    client = login(base_url)
+    failed = 0
+    for prompt in prompts:
+        failed += client.post(f"{base_url}/api/chat", json={'message': prompt}).status_code != 200
+    return failed
+
+
+def batch(base_url, prompts):
+    client = login(base_url)
+    response = client.post(f"{base_url}/api/chat/batch", json={'prompts': prompts})
+    response.raise_for_status()
+    failed = 0
+    with client.get(base_url + response.json()['stream_url'], stream=True) as stream:
+        event = None
+        for line in stream.iter_lines(decode_unicode=True):
+            if line.startswith('event:'):
+                event = line[6:].strip()
+            elif line.startswith('data:') and event == 'result':
+                failed += '"error"' in line
+            elif line.startswith('data:') and event == 'done':
+                break
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--prompts', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.2, help="fake Gemini delay in seconds")
+    parser.add_argument('--concurrency', type=int, default=8, help="BATCH_CONCURRENCY for the batch run")
+    parser.add_argument('--serve', type=int, metavar='PORT', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.concurrency)
+        return
+
+    gemini_port = free_port()
+    fake = subprocess.Popen([sys.executable, os.path.join(HERE, 'fake_gemini.py'), '--port', str(gemini_port),
+                             '--latency', str(args.latency)], stdout=subprocess.DEVNULL)
+    wait_for_port(gemini_port)
+    print(f"{args.prompts} prompts, upstream {args.latency}s, batch concurrency {args.concurrency}")
+    try:
+        for label, run in (('serial', serial), ('batch', batch)):
+            # A fresh server and database per mode; distinct prompts so the response cache never answers
+            env = dict(os.environ, DATABASE_URL=f"sqlite:///{tempfile.mkdtemp()}/bench.db", GEMINI_API_URL=(
+                f"http://127.0.0.1:{gemini_port}/v1beta/models/gemini-1.5-flash-latest:generateContent"))
+            port = free_port()
+            server = spawn([__file__, '--serve', str(port), '--concurrency', str(args.concurrency)], env, port)
+            try:
+                prompts = [f"{label} prompt number {i}" for i in range(args.prompts)]
+                start = time.perf_counter()
+                failed = run(f"http://127.0.0.1:{port}", prompts)
+                elapsed = time.perf_counter() - start
+                print(f"  {label:<8}{elapsed:>8.2f}s {args.prompts / elapsed:>8.1f} prompts/s  {failed} failed")
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        fake.terminate()
+        fake.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""Load test: mixed chat read/write throughput, default SQLite engine vs the production profile.
+
+--threads workers run for --duration seconds against a fresh database seeded with
+chat history. Each operation is either a chat save (ChatHistory row plus conversation
+summary in one transaction, as chat() does), with probability --write-ratio, or a
+page of a user's history read newest first.
+
+With --database-url the profile's pool settings are measured against that database
+instead (use a scratch database: tables are created and rows added).
+
+Usage: python bench_db.py [--threads 16] [--duration 10] [--write-ratio 0.2] [--database-url URL]
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+# Keep the app's own engine off the real database
+os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/bench-app.db"
+
+from app import app
+from conversations import record_message
+from database import apply_profile, engine_options
+from models import ChatHistory, Conversation, User, db
+from pagination import keyset
+
+USERS = 50
+SEED_CHATS = 200  # per user
+PAGE_SIZE = 50
+
+
+def make_engine(url, profile):
+    if not profile:
+        return create_engine(url)
+    config = dict(app.config, SQLALCHEMY_DATABASE_URI=url)
+    engine = create_engine(url, **engine_options(config))
+    apply_profile(engine, config)
+    return engine
+
+
+def seed(engine):
+    db.metadata.create_all(engine)
+    with Session(engine) as dbs:
+        users = [User(email=f"bench-{uuid.uuid4()}@example.com", password='x') for _ in range(USERS)]
+        dbs.add_all(users)
+        dbs.flush()
+        for user in users:
+            conversation_id = str(uuid.uuid4())
+            dbs.add(Conversation(id=conversation_id, user_id=user.id, title='Bench',
+                                 message_count=SEED_CHATS, last_message_preview='seed'))
+            dbs.add_all(ChatHistory(user_id=user.id, conversation_id=conversation_id, title='Bench',
+                                    message=f"seed {i}", response='Echo: seed') for i in range(SEED_CHATS))
+        dbs.commit()
+        return [(user.id, str(uuid.uuid4())) for user in users]
+
+
+def write(engine, user_id, conversation_id):
+    with Session(engine) as dbs:
+        dbs.add(ChatHistory(user_id=user_id, conversation_id=conversation_id, title='Bench',
+                            message='hello', response='Echo: hello'))
+        record_message(dbs, Conversation, user_id, conversation_id, 'Bench', 'hello')
+        dbs.commit()
+
+
+def read(engine, user_id):
+    with Session(engine) as dbs:
+        statement = keyset(select(ChatHistory).filter_by(user_id=user_id), ChatHistory, PAGE_SIZE)
+        return dbs.execute(statement).scalars().all()
+
+
+def run(engine, users, threads, duration, write_ratio):
+    latencies = {'read': [], 'write': []}
+    errors = []
+    deadline = time.perf_counter() + duration
+
+    def worker(seed):
+        rng = random.Random(seed)
+        while time.perf_counter() < deadline:
+            user_id, conversation_id = rng.choice(users)
+            kind = 'write' if rng.random() < write_ratio else 'read'
+            start = time.perf_counter()
+            try:
+                if kind == 'write':
+                    write(engine, user_id, conversation_id)
+                else:
+                    read(engine, user_id)
+            except OperationalError as e:
+                errors.append(e)
+                continue
+            latencies[kind].append(time.perf_counter() - start)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return time.perf_counter() - start, latencies, errors
+
+
+def report(label, elapsed, latencies, errors):
+    def pct(values, p):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * p))] * 1000 if values else 0.0
+
+    reads, writes = latencies['read'], latencies['write']
+    print(f"{label:<8} ops/s={(len(reads) + len(writes)) / elapsed:8.1f} "
+          f"reads/s={len(reads) / elapsed:8.1f} (p95 {pct(reads, 0.95):6.1f}ms) "
+          f"writes/s={len(writes) / elapsed:7.1f} (p95 {pct(writes, 0.95):6.1f}ms) errors={len(errors)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    parser.add_argument('--database-url', help="server database to measure instead of SQLite")
+    args = parser.parse_args()
+
+    if args.database_url:
+        runs = [('profile', args.database_url, True)]
+    else:
+        runs = [(label, f"sqlite:///{tempfile.mkdtemp()}/bench.db", profile)
+                for label, profile in (('default', False), ('profile', True))]
+
+    print(f"{args.threads} threads, {args.duration:g}s, {args.write_ratio:.0%} writes")
+    for label, url, profile in runs:
+        engine = make_engine(url, profile)
+        users = seed(engine)
+        report(label, *run(engine, users, args.threads, args.duration, args.write_ratio))
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
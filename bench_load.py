@@ -0,0 +1,443 @@
+"""Load test of the JSON API: a realistic traffic mix against a local fake Gemini.
+
+Each virtual user registers, logs in, then sends --requests operations drawn from
+--mix: chats (plain and streamed, some continuing the user's last conversation,
+some repeating popular prompts the response cache can answer), history and
+conversation list reads, and searches. Reported per operation: throughput,
+p50/p95/p99 latency and errors. The app's /metrics is scraped while it runs for
+per-stage server timings, upstream status codes and DB contention: peak pool
+checkouts and overflow, write-behind queue depth and time spent in the DB-bound
+stages (user load, quota, save).
+
+The fake upstream (see fake_gemini.py) and the app each run in their own process,
+the app with a scratch SQLite database, no rate limits and every user subscribed
+unless --metered is given. Runs are reproducible: the plan is drawn from --seed,
+--record saves it with each request's send time as a JSON-lines trace, and --replay
+sends a trace again on the same schedule (--speed 2 for twice as fast, 0 for as fast
+as possible). With --baseline the same plan also runs against that git revision, and
+--max-regression makes the run fail when chat p95 grew by more than that fraction.
+
+Usage:
+    python bench_load.py [--app app] [--users 20] [--requests 50] [--mix chat=50,history=20,...]
+                         [--latency 0.2] [--jitter 0.05] [--error-rate 0.01] [--seed 1] [--record trace.jsonl]
+                         [--baseline HEAD~1 [--max-regression 0.2]]
+    python bench_load.py --replay trace.jsonl [--speed 1]
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import make_server
+
+import requests
+
+from bench_asgi import PooledWSGIServer, QuietHandler, free_port, wait_for_port
+from bench_startup import extract
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_MIX = 'chat=45,chat_stream=10,history=20,conversations=10,search=15'
+OPERATIONS = ('register', 'login', 'chat', 'chat_stream', 'history', 'conversations', 'search')
+TOPICS = ('python', 'database', 'weather', 'recipes', 'travel', 'music', 'football', 'history')
+# Prompts many users send, so some chats are response cache hits
+POPULAR = tuple(f"What is {topic}?" for topic in TOPICS)
+POPULAR_RATIO = 0.2
+CONTINUE_RATIO = 0.5
+PASSWORD = 'bench'
+SIGN_IN_RETRIES = 5
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        op, _, weight = part.partition('=')
+        if op not in OPERATIONS[2:]:
+            raise argparse.ArgumentTypeError(f"unknown operation {op!r}")
+        mix[op] = float(weight)
+    return mix
+
+
+def make_plan(users, requests_per_user, mix, seed):
+    """The operations each virtual user sends, in order; the same seed gives the same plan."""
+    rng = random.Random(seed)
+    ops, weights = list(mix), list(mix.values())
+    plan = []
+    for user in range(users):
+        plan.append({'user': user, 'op': 'register'})
+        plan.append({'user': user, 'op': 'login'})
+        for i in range(requests_per_user):
+            entry = {'user': user, 'op': rng.choices(ops, weights)[0]}
+            if entry['op'] in ('chat', 'chat_stream'):
+                if rng.random() < POPULAR_RATIO:
+                    entry['message'] = rng.choice(POPULAR)
+                else:
+                    entry['message'] = f"Tell me something new about {rng.choice(TOPICS)} ({user}-{i})"
+                entry['continue'] = rng.random() < CONTINUE_RATIO
+            elif entry['op'] == 'search':
+                entry['q'] = rng.choice(TOPICS)
+            plan.append(entry)
+    return plan
+
+
+def load_trace(path):
+    with open(path) as trace:
+        return [json.loads(line) for line in trace if line.strip()]
+
+
+def save_trace(path, results):
+    with open(path, 'w') as trace:
+        for entry, sent, _, _, _ in sorted(results, key=lambda result: result[1]):
+            trace.write(json.dumps(dict(entry, at=round(sent, 4))) + '\n')
+
+
+def read_stream(response):
+    """Read an SSE chat to the end; returns (conversation id, whether it ended in an error event)."""
+    event = None
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith('event:'):
+            event = line[len('event:'):].strip()
+        elif line.startswith('data:') and event in ('done', 'error'):
+            if event == 'error':
+                return None, True
+            return json.loads(line[len('data:'):]).get('conversation_id'), False
+    return None, True
+
+
+def send(client, base_url, entry, state):
+    """Send one planned operation; returns (status, ok)."""
+    op = entry['op']
+    credentials = {'email': f"bench{entry['user']}@example.com", 'password': PASSWORD}
+
+    if op in ('register', 'login'):
+        # Password hashing sheds load with 503s; come back after Retry-After like a real client
+        for _ in range(SIGN_IN_RETRIES):
+            response = client.post(f"{base_url}/api/{op}", json=credentials)
+            if response.status_code != 503:
+                break
+            time.sleep(float(response.headers.get('Retry-After', 1)))
+        if op == 'register':
+            # Already registered is fine when a trace is replayed against the same database
+            return response.status_code, response.status_code in (201, 400)
+    elif op in ('chat', 'chat_stream'):
+        body = {'message': entry['message']}
+        if entry.get('continue') and state.get('conversation_id'):
+            body['conversation_id'] = state['conversation_id']
+        if op == 'chat':
+            response = client.post(f"{base_url}/api/chat", json=body)
+            if response.status_code == 200:
+                state['conversation_id'] = response.json()['conversation_id']
+        else:
+            with client.post(f"{base_url}/api/chat/stream", json=body, stream=True) as response:
+                if response.status_code == 200:
+                    conversation_id, failed = read_stream(response)
+                    if failed:
+                        return 'stream error', False
+                    state['conversation_id'] = conversation_id
+                else:
+                    response.content
+    elif op == 'history':
+        response = client.get(f"{base_url}/api/chat_history")
+    elif op == 'conversations':
+        response = client.get(f"{base_url}/api/conversations")
+    else:
+        response = client.get(f"{base_url}/api/chat_history/search", params={'q': entry['q']})
+    return response.status_code, response.status_code < 400
+
+
+def run_plan(base_url, plan, speed):
+    """Each virtual user sends its operations in order on its own thread.
+
+    Entries with an `at` time (from a trace) are sent at that offset divided by
+    `speed`; otherwise, or with speed 0, each follows the previous one immediately.
+    """
+    by_user = defaultdict(list)
+    for entry in plan:
+        by_user[entry['user']].append(entry)
+    start = time.perf_counter()
+
+    def user(entries):
+        client = requests.Session()
+        state, results = {}, []
+        for entry in entries:
+            if speed and 'at' in entry:
+                delay = start + entry['at'] / speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            entry = {key: value for key, value in entry.items() if key != 'at'}
+            sent = time.perf_counter()
+            try:
+                status, ok = send(client, base_url, entry, state)
+            except requests.RequestException:
+                status, ok = 'connection error', False
+            results.append((entry, sent - start, time.perf_counter() - sent, status, ok))
+        client.close()
+        return results
+
+    with ThreadPoolExecutor(len(by_user)) as executor:
+        results = [result for results in executor.map(user, by_user.values()) for result in results]
+    return results, time.perf_counter() - start
+
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][\w:]*)(?:\{(.*)\})? (\S+)$')
+LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def parse_metrics(text):
+    """(name, labels) -> value for every sample in a Prometheus text exposition."""
+    samples = {}
+    for line in text.splitlines():
+        match = SAMPLE.match(line)
+        if match:
+            name, labels, value = match.groups()
+            samples[name, tuple(LABEL.findall(labels or ''))] = float(value)
+    return samples
+
+
+def scrape(base_url):
+    try:
+        response = requests.get(f"{base_url}/metrics", timeout=5)
+    except requests.RequestException:
+        return None
+    return parse_metrics(response.text) if response.status_code == 200 else None
+
+
+def histogram_quantile(q, buckets):
+    """Estimate a quantile from cumulative (upper bound, count) buckets, as Prometheus does."""
+    buckets = sorted(buckets)
+    total = buckets[-1][1] if buckets else 0
+    if not total:
+        return None
+    rank = q * total
+    lower, below = 0.0, 0
+    for upper, count in buckets:
+        if count >= rank:
+            if upper == float('inf'):
+                return lower
+            return lower + (upper - lower) * (rank - below) / (count - below)
+        lower, below = upper, count
+    return lower
+
+
+class Monitor(threading.Thread):
+    """Scrapes /metrics during the run and keeps the peak of each gauge."""
+
+    GAUGES = ('db_pool_checked_out', 'db_pool_overflow', 'chat_write_queue_depth', 'gemini_in_flight')
+
+    def __init__(self, base_url, interval):
+        super().__init__(daemon=True)
+        self.base_url = base_url
+        self.interval = interval
+        self.peaks = {}
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            samples = scrape(self.base_url)
+            if samples is None:
+                continue
+            # Summed over labels, e.g. gemini_in_flight is reported per model
+            for name in self.GAUGES:
+                values = [value for (sample_name, _), value in samples.items() if sample_name == name]
+                if values:
+                    self.peaks[name] = max(self.peaks.get(name, float('-inf')), sum(values))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def report(label, results, elapsed, samples, peaks):
+    """Print the run's tables; returns p95 latency per operation, plus 'all'."""
+    print(f"\n{label}: {len(results)} requests in {elapsed:.2f}s, {len(results) / elapsed:.1f} req/s")
+    print(f"  {'operation':<14}{'count':>7}{'req/s':>8}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    by_op = defaultdict(list)
+    for entry, _, latency, status, ok in results:
+        by_op[entry['op']].append((latency, ok))
+        by_op['all'].append((latency, ok))
+
+    p95 = {}
+    for op in OPERATIONS + ('all',):
+        if op not in by_op:
+            continue
+        latencies = sorted(latency for latency, _ in by_op[op])
+        errors = sum(1 for _, ok in by_op[op] if not ok)
+        p95[op] = percentile(latencies, 0.95)
+        print(f"  {op:<14}{len(latencies):>7}{len(latencies) / elapsed:>8.1f}{errors:>8}"
+              f"{percentile(latencies, 0.50) * 1000:>9.1f}{p95[op] * 1000:>9.1f}{percentile(latencies, 0.99) * 1000:>9.1f}")
+
+    statuses = defaultdict(int)
+    for _, _, _, status, ok in results:
+        if not ok:
+            statuses[status] += 1
+    if statuses:
+        print("  errors by status: " + ', '.join(f"{status}={count}" for status, count in sorted(statuses.items(), key=str)))
+
+    if samples is None:
+        print("  (no /metrics on this tree)")
+        return p95
+
+    # Per-stage server timings from the chat_stage_seconds histogram
+    stages = defaultdict(list)
+    for (name, labels), value in samples.items():
+        if name == 'chat_stage_seconds_bucket':
+            labels = dict(labels)
+            upper = float('inf') if labels['le'] == '+Inf' else float(labels['le'])
+            stages[labels['endpoint'], labels['stage']].append((upper, value))
+    if stages:
+        print(f"  {'server stage':<30}{'count':>7}{'p50 ms':>9}{'p95 ms':>9}")
+        for (endpoint, stage), buckets in sorted(stages.items()):
+            count = max(value for _, value in buckets)
+            p50, p95_stage = histogram_quantile(0.5, buckets), histogram_quantile(0.95, buckets)
+            print(f"  {endpoint + ' ' + stage:<30}{count:>7.0f}{p50 * 1000:>9.1f}{p95_stage * 1000:>9.1f}")
+
+    upstream = sorted((dict(labels)['kind'], dict(labels)['status'], value)
+                      for (name, labels), value in samples.items() if name == 'gemini_requests_total')
+    if upstream:
+        print("  upstream calls: " + ', '.join(f"{kind} {status}={count:.0f}" for kind, status, count in upstream))
+    cache_hits, cache_misses = samples.get(('chat_cache_hits_total', ())), samples.get(('chat_cache_misses_total', ()))
+    if cache_hits is not None:
+        print(f"  response cache: {cache_hits:.0f} hits, {cache_misses:.0f} misses")
+
+    pool_size = samples.get(('db_pool_size', ()))
+    contention = []
+    if 'db_pool_checked_out' in peaks:
+        contention.append(f"peak {peaks['db_pool_checked_out']:.0f} connections checked out of {pool_size:.0f}, "
+                          f"peak overflow {max(peaks.get('db_pool_overflow', 0), 0):.0f}")
+    if 'chat_write_queue_depth' in peaks:
+        contention.append(f"peak write queue {peaks['chat_write_queue_depth']:.0f}")
+    if contention:
+        print("  DB: " + '; '.join(contention))
+    return p95
+
+
+def serve(tree, module, port, threads, metered):
+    """Child process: the app from `tree` on a pooled WSGI server, schema in place and limits off."""
+    sys.path[0] = tree
+    os.chdir(tree)
+    app_module = __import__(module)
+    app = app_module.app
+    if 'init-db' in app.cli.commands:
+        app.test_cli_runner().invoke(args=['init-db'])
+    User = getattr(app_module, 'User', None) or __import__('models').User
+
+    # Every chat would otherwise spend one of a handful of free tokens
+    if not metered:
+        from sqlalchemy import event
+
+        @event.listens_for(User, 'before_insert')
+        def subscribe(mapper, connection, user):
+            user.subscription_expiry = datetime.date.today() + datetime.timedelta(days=30)
+
+    rate_limiter = app.extensions.get('rate_limiter')
+    if rate_limiter is not None:
+        rate_limiter.user_limit = rate_limiter.ip_limit = rate_limiter.global_limit = None
+
+    PooledWSGIServer.threads = threads
+    make_server('127.0.0.1', port, app, server_class=PooledWSGIServer, handler_class=QuietHandler).serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--app', default='app', help="entry point serving the JSON API (app or app2)")
+    parser.add_argument('--users', type=int, default=20, help="concurrent virtual users")
+    parser.add_argument('--requests', type=int, default=50, help="operations per user after logging in")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"operation weights ({DEFAULT_MIX})")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=16, help="WSGI worker threads")
+    parser.add_argument('--metered', action='store_true', help="keep the free-token quota instead of subscribing every user")
+    parser.add_argument('--latency', type=float, default=0.2, help="fake Gemini delay in seconds")
+    parser.add_argument('--jitter', type=float, default=0.05, help="standard deviation of that delay")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of upstream calls that fail with 503")
+    parser.add_argument('--hang-rate', type=float, default=0.0, help="fraction of upstream calls that hang for 30s")
+    parser.add_argument('--chunk-delay', type=float, default=0.0, help="seconds between streamed chunks")
+    parser.add_argument('--scrape-interval', type=float, default=0.5)
+    parser.add_argument('--record', help="write the plan, with send times, to this trace file")
+    parser.add_argument('--replay', help="send the operations of a recorded trace instead of a generated plan")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay speed-up; 0 sends without waiting")
+    parser.add_argument('--baseline', help="git revision to run the same plan against")
+    parser.add_argument('--max-regression', type=float, help="fail when chat p95 exceeds the baseline's by this fraction")
+    parser.add_argument('--serve', help=argparse.SUPPRESS)
+    parser.add_argument('--tree', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.tree, args.serve, args.port, args.threads, args.metered)
+        return
+
+    plan = load_trace(args.replay) if args.replay else make_plan(args.users, args.requests, args.mix, args.seed)
+    trees = [('current', HERE)]
+    if args.baseline:
+        trees.append((args.baseline, extract(args.baseline)))
+    scratch = tempfile.mkdtemp(prefix='bench-load-')
+
+    gemini_port = free_port()
+    fake = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, 'fake_gemini.py'), '--port', str(gemini_port), '--latency', str(args.latency),
+         '--jitter', str(args.jitter), '--error-rate', str(args.error_rate), '--hang-rate', str(args.hang_rate),
+         '--chunk-delay', str(args.chunk_delay),
+         '--seed', str(args.seed)],
+        stdout=subprocess.DEVNULL,
+    )
+    wait_for_port(gemini_port)
+    print(f"{len({entry['user'] for entry in plan})} users, {len(plan)} requests "
+          f"({'replay of ' + args.replay if args.replay else f'seed {args.seed}'}), "
+          f"upstream {args.latency}s +/- {args.jitter}s, {args.error_rate:.0%} errors, {args.threads} WSGI threads; "
+          f"server logs in {scratch}")
+
+    p95 = {}
+    try:
+        for label, tree in trees:
+            port = free_port()
+            base_url = f"http://127.0.0.1:{port}"
+            env = dict(
+                os.environ,
+                DATABASE_URL=f"sqlite:///{scratch}/{label}.db",
+                GEMINI_API_URL=f"http://127.0.0.1:{gemini_port}/v1beta/models/gemini-1.5-flash-latest:generateContent",
+            )
+            server_args = [sys.executable, __file__, '--serve', args.app, '--tree', tree, '--port', str(port),
+                           '--threads', str(args.threads)] + (['--metered'] if args.metered else [])
+            with open(os.path.join(scratch, f"{label}.log"), 'w') as log:
+                server = subprocess.Popen(server_args, env=env, stdout=log, stderr=log)
+            try:
+                wait_for_port(port)
+                monitor = Monitor(base_url, args.scrape_interval)
+                monitor.start()
+                results, elapsed = run_plan(base_url, plan, args.speed if args.replay else 0)
+                monitor.stop()
+                p95[label] = report(label, results, elapsed, scrape(base_url), monitor.peaks)
+                if args.record and label == 'current':
+                    save_trace(args.record, results)
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        fake.terminate()
+        fake.wait()
+
+    if args.baseline:
+        print()
+        for op in ('chat', 'chat_stream', 'all'):
+            if op in p95['current'] and op in p95[args.baseline]:
+                change = p95['current'][op] / p95[args.baseline][op] - 1
+                print(f"{op:<12} p95 {p95[args.baseline][op] * 1000:.1f}ms -> {p95['current'][op] * 1000:.1f}ms ({change:+.0%})")
+        if args.max_regression is not None and 'chat' in p95['current']:
+            if p95['current']['chat'] > p95[args.baseline]['chat'] * (1 + args.max_regression):
+                sys.exit(f"chat p95 regressed by more than {args.max_regression:.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""Signup/login storm: login latency with password hashing in the request thread vs the process pool.
+
+--users virtual users register and then log in --logins times each, all at once.
+Meanwhile a probe fetches the home page every 50ms, showing whether requests
+that hash nothing still get a thread and the GIL. Each mode runs the app in its
+own process, with a scratch SQLite database and no rate limits:
+
+    inline  PASSWORD_HASH_WORKERS=0: scrypt runs in the request thread
+    pool    scrypt runs in the process pool (--workers, default one per CPU)
+
+Reported per mode: throughput, p50/p95/p99 per operation, requests shed with a
+503 by the hashing queue (users retry those after Retry-After, up to 5 times),
+and the mean queue and hash times from /metrics.
+
+Usage: python bench_login.py [--users 50] [--logins 5] [--threads 16] [--workers N] [--max-pending N]
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import make_server
+
+import requests
+
+from bench_asgi import PooledWSGIServer, QuietHandler, free_port, spawn
+from bench_load import percentile, scrape
+
+PASSWORD = 'bench'
+PROBE_INTERVAL = 0.05
+MAX_RETRIES = 5
+
+
+def serve(port, threads, workers, max_pending):
+    """Child process: the JSON API with the given hashing setup, schema in place and limits off."""
+    from app import app
+    from credentials import PasswordHasher
+
+    app.test_cli_runner().invoke(args=['init-db'])
+    rate_limiter = app.extensions['rate_limiter']
+    rate_limiter.user_limit = rate_limiter.ip_limit = rate_limiter.global_limit = None
+    app.extensions['password_hasher'] = PasswordHasher.from_config(
+        dict(app.config, PASSWORD_HASH_WORKERS=workers, PASSWORD_HASH_MAX_PENDING=max_pending))
+
+    PooledWSGIServer.threads = threads
+    make_server('127.0.0.1', port, app, server_class=PooledWSGIServer, handler_class=QuietHandler).serve_forever()
+
+
+def storm(base_url, users, logins):
+    """(results, elapsed, probe latencies); results are (operation, latency, status) tuples."""
+    stopped = threading.Event()
+    probes = []
+
+    def probe():
+        client = requests.Session()
+        while not stopped.wait(PROBE_INTERVAL):
+            sent = time.perf_counter()
+            client.get(f"{base_url}/")
+            probes.append(time.perf_counter() - sent)
+
+    def user(i):
+        client = requests.Session()
+        credentials = {'email': f"storm{i}@example.com", 'password': PASSWORD}
+        results = []
+        for op in ['register'] + ['login'] * logins:
+            # Like a well-behaved client, come back after Retry-After when shed
+            for _ in range(MAX_RETRIES + 1):
+                sent = time.perf_counter()
+                response = client.post(f"{base_url}/api/{op}", json=credentials)
+                results.append((op, time.perf_counter() - sent, response.status_code))
+                if response.status_code != 503:
+                    break
+                time.sleep(float(response.headers.get('Retry-After', 1)))
+        return results
+
+    prober = threading.Thread(target=probe, daemon=True)
+    prober.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(users) as executor:
+        results = [result for results in executor.map(user, range(users)) for result in results]
+    elapsed = time.perf_counter() - start
+    stopped.set()
+    prober.join()
+    return results, elapsed, probes
+
+
+def report(label, results, elapsed, probes, samples):
+    print(f"\n{label}: {len(results)} requests in {elapsed:.2f}s, {len(results) / elapsed:.1f} req/s")
+    print(f"  {'operation':<10}{'count':>7}{'shed':>6}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    by_op = defaultdict(list)
+    for op, latency, status in results:
+        by_op[op].append((latency, status))
+    by_op['probe'] = [(latency, 200) for latency in probes]
+    for op, entries in by_op.items():
+        latencies = sorted(latency for latency, _ in entries)
+        shed = sum(1 for _, status in entries if status == 503)
+        errors = sum(1 for _, status in entries if status >= 400 and status not in (400, 503))
+        print(f"  {op:<10}{len(entries):>7}{shed:>6}{errors:>8}" + ''.join(
+            f"{percentile(latencies, p) * 1000:>9.1f}" for p in (0.50, 0.95, 0.99)))
+    if samples:
+        for op in ('hash', 'verify'):
+            count = samples.get(('password_hash_seconds_count', (('op', op),)), 0)
+            if count:
+                queued = samples[('password_hash_queue_seconds_sum', (('op', op),))] / count
+                hashed = samples[('password_hash_seconds_sum', (('op', op),))] / count
+                print(f"  server {op}: {int(count)} done, mean queue {queued * 1000:.1f} ms, "
+                      f"mean hash {hashed * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50, help="concurrent virtual users")
+    parser.add_argument('--logins', type=int, default=5, help="logins per user after registering")
+    parser.add_argument('--threads', type=int, default=16, help="WSGI worker threads")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="hashing processes in pool mode")
+    parser.add_argument('--max-pending', type=int, help="hashes queued or running before logins wait (app default)")
+    parser.add_argument('--serve', type=int, metavar='PORT', help=argparse.SUPPRESS)
+    parser.add_argument('--hash-workers', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.threads, args.hash_workers, args.max_pending)
+        return
+
+    print(f"{args.users} users, 1 signup + {args.logins} logins each, {args.threads} WSGI threads, "
+          f"{os.cpu_count()} CPUs")
+    for label, workers in (('inline', 0), ('pool', args.workers)):
+        # Each mode gets a fresh database, so every run signs up the same users
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+        port = free_port()
+        server_args = [__file__, '--serve', str(port), '--threads', str(args.threads), '--hash-workers', str(workers)]
+        if args.max_pending:
+            server_args += ['--max-pending', str(args.max_pending)]
+        server = spawn(server_args, env, port)
+        try:
+            base_url = f"http://127.0.0.1:{port}"
+            results, elapsed, probes = storm(base_url, args.users, args.logins)
+            report(f"{label} ({workers} hashing processes)" if workers else label, results, elapsed, probes,
+                   scrape(base_url))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
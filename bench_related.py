@@ -0,0 +1,137 @@
+"""Related-conversations latency: the per-user vector index vs scanning the user's chat history.
+
+Seeds a scratch SQLite database with one user holding --messages messages in
+conversations of --chats messages each, drawn from --topics vocabularies so that
+conversations on the same topic are alike. Then, for --queries prompts, it times:
+
+    scan        read every message of the user and score each conversation by the
+                best word overlap (Jaccard) with the prompt, the way it had to be done
+    text        RelatedIndex.related() for the prompt
+    conversation  RelatedIndex.related() for an existing conversation
+
+The index build (the user's first query) is reported separately, as is how often
+the top suggestion shares the prompt's topic.
+
+Usage: python bench_related.py [--messages 100000] [--chats 10] [--topics 50] [--queries 200]
+"""
+import argparse
+import datetime
+import os
+import random
+import re
+import tempfile
+import time
+import uuid
+
+from sqlalchemy import insert, select
+
+# Keep the app's own engine off the real database
+os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/bench-related.db"
+
+from app import app
+from bench_load import percentile
+from models import ChatHistory, Conversation, User, db, init_db
+from related import RelatedIndex
+
+COMMON = ("how do i what is the best way to can you explain why does my please help with and for in of a an "
+          "it this that when should").split()
+TOPIC_WORDS = 12
+
+
+def seed(messages, chats, topics):
+    """Returns ({conversation id: topic}, topic vocabularies)."""
+    rng = random.Random(0)
+    vocabularies = [[f"t{topic}w{word}" for word in range(TOPIC_WORDS)] for topic in range(topics)]
+    topic_of = {}
+    now = datetime.datetime.utcnow()
+    with app.app_context():
+        init_db()
+        user = User(email="related@example.com", password='x')
+        db.session.add(user)
+        db.session.flush()
+        rows = []
+        for c in range(messages // chats):
+            conversation_id = str(uuid.uuid4())
+            topic = topic_of[conversation_id] = rng.randrange(topics)
+            db.session.add(Conversation(id=conversation_id, user_id=user.id, title=f"Topic {topic}", created_at=now,
+                                        updated_at=now, message_count=chats))
+            for _ in range(chats):
+                words = rng.choices(COMMON, k=8) + rng.choices(vocabularies[topic], k=4)
+                rng.shuffle(words)
+                rows.append(dict(user_id=user.id, conversation_id=conversation_id, title=f"Topic {topic}",
+                                 message=' '.join(words), response='ok', timestamp=now))
+        for start in range(0, len(rows), 10000):
+            db.session.execute(insert(ChatHistory), rows[start:start + 10000])
+        db.session.commit()
+    return topic_of, vocabularies
+
+
+def scan(user_id, text):
+    """Best conversations for `text` by reading every message, as before the index."""
+    words = set(re.findall(r'\w\w+', text.lower()))
+    best = {}
+    for conversation_id, message in db.session.execute(
+            select(ChatHistory.conversation_id, ChatHistory.message).where(ChatHistory.user_id == user_id)
+            .execution_options(yield_per=5000)):
+        other = set(re.findall(r'\w\w+', message.lower()))
+        score = len(words & other) / len(words | other) if other else 0.0
+        if score > best.get(conversation_id, 0.0):
+            best[conversation_id] = score
+    return sorted(best.items(), key=lambda item: -item[1])[:5]
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--chats', type=int, default=10, help="messages per conversation")
+    parser.add_argument('--topics', type=int, default=50)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--scans', type=int, default=5, help="queries timed with the full scan (it is slow)")
+    args = parser.parse_args()
+
+    topic_of, vocabularies = seed(args.messages, args.chats, args.topics)
+    rng = random.Random(1)
+    prompts = []
+    for _ in range(args.queries):
+        topic = rng.randrange(args.topics)
+        prompts.append((topic, ' '.join(rng.choices(COMMON, k=5) + rng.choices(vocabularies[topic], k=2))))
+    conversation_ids = rng.choices(list(topic_of), k=args.queries)
+
+    index = RelatedIndex.from_config(app.config)
+    with app.app_context():
+        build, _ = timed(index.related, db.session, ChatHistory, 1, prompts[0][1])
+        results = {'scan': [], 'text': [], 'conversation': []}
+        hits = {'scan': 0, 'text': 0, 'conversation': 0}
+        for topic, prompt in prompts[:args.scans]:
+            elapsed, top = timed(scan, 1, prompt)
+            results['scan'].append(elapsed)
+            hits['scan'] += bool(top) and topic_of[top[0][0]] == topic
+        for topic, prompt in prompts:
+            elapsed, top = timed(index.related, db.session, ChatHistory, 1, prompt)
+            results['text'].append(elapsed)
+            hits['text'] += bool(top) and topic_of[top[0][0]] == topic
+        for conversation_id in conversation_ids:
+            elapsed, top = timed(index.related, db.session, ChatHistory, 1, None, conversation_id)
+            results['conversation'].append(elapsed)
+            hits['conversation'] += bool(top) and topic_of[top[0][0]] == topic_of[conversation_id]
+        db.session.remove()
+
+    stats = index.stats()
+    print(f"{args.messages} messages in {len(topic_of)} conversations, {args.topics} topics; "
+          f"index built in {build * 1000:.0f} ms ({stats['messages']} vectors, "
+          f"{stats['messages'] * index.dimensions * 4 / 2 ** 20:.0f} MiB)")
+    print(f"  {'query':<14}{'count':>7}{'p50 ms':>9}{'p95 ms':>9}{'top-1 same topic':>18}")
+    for label, latencies in results.items():
+        latencies.sort()
+        print(f"  {label:<14}{len(latencies):>7}{percentile(latencies, 0.50) * 1000:>9.2f}"
+              f"{percentile(latencies, 0.95) * 1000:>9.2f}{hits[label] / len(latencies):>18.0%}")
+
+
+if __name__ == '__main__':
+    main()
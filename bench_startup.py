@@ -0,0 +1,159 @@
+"""Startup cost of the entry points, as paid by every preforked worker.
+
+For each entry point, measured --runs times in fresh interpreters:
+
+- import: time to import the module (interpreter startup excluded);
+- cold start: --workers processes started together, each importing the app and
+  serving on its own port as a gunicorn worker without --preload does, until
+  every one of them has answered a request.
+
+The working tree is compared with --baseline (a git revision, extracted with
+`git archive`), the two taking turns run by run. Each tree gets its own scratch
+SQLite database with the schema already in place, so only per-worker work is timed.
+
+Usage: python bench_startup.py [--baseline HEAD~1] [--modules app app1 app2] [--runs 10] [--workers 4]
+"""
+import argparse
+import http.client
+import io
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def child(tree, module, port):
+    # Import the app from `tree`, not from this script's directory
+    sys.path[0] = tree
+    os.chdir(tree)
+    start = time.perf_counter()
+    app = __import__(module).app
+    print(time.perf_counter() - start, flush=True)
+    if port:
+        from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+        make_server('127.0.0.1', port, app, handler_class=QuietHandler).serve_forever()
+
+
+def prepare(tree, module, env):
+    """Create the schema: the old apps did it on import, newer ones have an init-db command."""
+    script = (f"import sys; sys.path[0] = {tree!r}; import {module}\n"
+              f"if 'init-db' in {module}.app.cli.commands:\n"
+              f"    {module}.app.test_cli_runner().invoke(args=['init-db'])\n")
+    subprocess.run([sys.executable, '-c', script], env=env, cwd=tree, check=True, capture_output=True)
+
+
+def spawn(tree, module, env, port=0):
+    args = [sys.executable, __file__, '--child', module, '--tree', tree, '--port', str(port)]
+    return subprocess.Popen(args, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+
+
+def import_time(tree, module, env):
+    process = spawn(tree, module, env)
+    output, _ = process.communicate()
+    return float(output)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def answered(port):
+    try:
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+        connection.request('GET', '/')
+        connection.getresponse().read()
+        connection.close()
+        return True
+    except OSError:
+        return False
+
+
+def cold_start(tree, module, env, workers, timeout=60):
+    ports = [free_port() for _ in range(workers)]
+    start = time.perf_counter()
+    processes = [spawn(tree, module, env, port) for port in ports]
+    try:
+        waiting = set(ports)
+        while waiting:
+            if time.perf_counter() - start > timeout:
+                raise RuntimeError(f"{module} workers did not start within {timeout}s")
+            waiting = {port for port in waiting if not answered(port)}
+            if waiting:
+                time.sleep(0.005)
+        return time.perf_counter() - start
+    finally:
+        for process in processes:
+            process.kill()
+            process.wait()
+
+
+def extract(revision):
+    tree = tempfile.mkdtemp(prefix='bench-startup-')
+    archive = subprocess.run(['git', 'archive', revision], cwd=HERE, check=True, capture_output=True).stdout
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(tree)
+    return tree
+
+
+def summary(values):
+    return f"p50={statistics.median(values) * 1000:7.1f}ms min={min(values) * 1000:7.1f}ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--baseline', help="git revision to compare the working tree with")
+    parser.add_argument('--modules', nargs='+', default=['app', 'app1', 'app2'])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--tree', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.tree, args.child, args.port)
+        return
+
+    trees = [('current', HERE)]
+    if args.baseline:
+        trees.append((args.baseline, extract(args.baseline)))
+    scratch = tempfile.mkdtemp()
+
+    print(f"{args.runs} runs, {args.workers} workers, {os.cpu_count()} CPUs")
+    for module in args.modules:
+        envs, imports, starts = {}, {}, {}
+        for label, tree in trees:
+            envs[label] = dict(os.environ, DATABASE_URL=f"sqlite:///{scratch}/{label}-{module}.db")
+            prepare(tree, module, envs[label])
+            imports[label], starts[label] = [], []
+
+        # Trees take turns, so drift in machine load affects them alike
+        for _ in range(args.runs):
+            for label, tree in trees:
+                imports[label].append(import_time(tree, module, envs[label]))
+                starts[label].append(cold_start(tree, module, envs[label], args.workers))
+
+        for label, _ in trees:
+            print(f"{module:<6} {label:<9} import {summary(imports[label])}   "
+                  f"cold start ({args.workers} workers) {summary(starts[label])}")
+        if args.baseline:
+            speedup = statistics.median(starts[args.baseline]) / statistics.median(starts['current'])
+            saved = statistics.median(imports[args.baseline]) - statistics.median(imports['current'])
+            print(f"{module:<6} {saved * 1000:.0f}ms less import per worker, cold start {speedup:.2f}x faster")
+
+
+if __name__ == '__main__':
+    main()
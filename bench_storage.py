@@ -0,0 +1,171 @@
+"""Space and scan-time report for tiered chat storage (see chat_storage.py).
+
+Seeds a scratch SQLite database with --users users, each with --conversations
+conversations of --chats chats spread over the past year, stored the way they
+were before compression. It then measures the database, runs one compaction
+(compress every answer, archive conversations idle for --archive-after-days),
+and measures again:
+
+    file size       after VACUUM, so freed pages are not counted
+    full scan       read and decode every chat_history row, as a backup or an
+                    unindexed search does
+    history pages   the newest page of each user's history
+    export          every user's full export, archived conversations included
+    backup          copy the file with SQLite's online backup API
+
+Times are the best of 5 runs.
+
+Usage: python bench_storage.py [--users 20] [--conversations 20] [--chats 10] [--archive-after-days 90]
+"""
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import uuid
+
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+
+# Keep the app's own engine off the real database
+os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/bench-storage.db"
+
+import chat_storage
+from app import app
+from export import chat_records
+from models import ChatArchive, ChatHistory, Conversation, User, compact_chats, db, init_db
+from pagination import keyset, page
+
+PAGE_SIZE = 50
+REPEATS = 5
+WORDS = ("the a model answer can will should data request response user system time example python function "
+         "value list error table query result first second using with from into which because however also "
+         "performance cache memory latency throughput server client database index scan compress archive "
+         "step note here this that these those each every more most less quickly simply carefully").split()
+
+
+def answer(rng, size):
+    """Gemini-like prose of about `size` bytes: sentences, the odd list and code line."""
+    lines, length = [], 0
+    while length < size:
+        kind = rng.random()
+        if kind < 0.15:
+            line = f"- {' '.join(rng.choices(WORDS, k=rng.randint(4, 9)))}"
+        elif kind < 0.2:
+            line = f"    result = {rng.choice(WORDS)}({rng.choice(WORDS)}, {rng.randint(0, 999)})"
+        else:
+            line = ' '.join(rng.choices(WORDS, k=rng.randint(8, 20))).capitalize() + '.'
+        lines.append(line)
+        length += len(line) + 1
+    return '\n'.join(lines)
+
+
+def seed(users, conversations, chats, response_bytes):
+    rng = random.Random(0)
+    now = datetime.datetime.utcnow()
+    with app.app_context():
+        init_db()
+        for u in range(users):
+            user = User(email=f"storage{u}@example.com", password='x')
+            db.session.add(user)
+            db.session.flush()
+            for _ in range(conversations):
+                conversation_id = str(uuid.uuid4())
+                started = now - datetime.timedelta(days=rng.uniform(0, 365))
+                stamps = [started + datetime.timedelta(minutes=2 * i) for i in range(chats)]
+                db.session.add(Conversation(id=conversation_id, user_id=user.id, title='Bench', created_at=stamps[0],
+                                            updated_at=stamps[-1], message_count=chats))
+                db.session.add_all(ChatHistory(
+                    user_id=user.id, conversation_id=conversation_id, title='Bench', timestamp=stamp,
+                    message=' '.join(rng.choices(WORDS, k=12)), response=answer(rng, rng.randint(response_bytes // 2,
+                                                                                              response_bytes * 2)),
+                ) for stamp in stamps)
+            db.session.commit()
+
+
+def vacuum_size(path):
+    with sqlite3.connect(path) as conn:
+        conn.execute("VACUUM")
+        # The database is in WAL mode: the file only shrinks once the rebuilt pages are checkpointed
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return os.path.getsize(path)
+
+
+def timed(function):
+    """Best of REPEATS runs, in seconds."""
+    best = None
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def measure(path, users):
+    def full_scan():
+        for _ in db.session.execute(select(ChatHistory.id, ChatHistory.response).execution_options(yield_per=1000)):
+            pass
+
+    def history_pages():
+        for user_id in range(1, users + 1):
+            page(keyset(ChatHistory.query.filter_by(user_id=user_id), ChatHistory, PAGE_SIZE), PAGE_SIZE)
+            db.session.expunge_all()
+
+    def export():
+        for user_id in range(1, users + 1):
+            for _ in chat_records(db.session, ChatHistory, user_id, ChatArchive=ChatArchive):
+                pass
+
+    def backup():
+        with sqlite3.connect(path) as source, sqlite3.connect(os.path.join(tempfile.mkdtemp(), 'copy.db')) as target:
+            source.backup(target)
+
+    with app.app_context():
+        db.engine.dispose()
+        size = vacuum_size(path)
+        results = {'file size (KiB)': size / 1024}
+        for label, function in (('full scan (ms)', full_scan), ('history pages (ms)', history_pages),
+                                ('export (ms)', export), ('backup (ms)', backup)):
+            results[label] = timed(function) * 1000
+        db.session.remove()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--conversations', type=int, default=20, help="per user")
+    parser.add_argument('--chats', type=int, default=10, help="per conversation")
+    parser.add_argument('--response-bytes', type=int, default=1500, help="typical answer length")
+    parser.add_argument('--archive-after-days', type=int, default=90)
+    parser.add_argument('--codec', default='zlib', choices=sorted(chat_storage.TAGS))
+    args = parser.parse_args()
+
+    path = make_url(app.config['SQLALCHEMY_DATABASE_URI']).database
+    chat_storage.configure({'CHAT_COMPRESSION': None})
+    seed(args.users, args.conversations, args.chats, args.response_bytes)
+    before = measure(path, args.users)
+
+    chat_storage.configure({'CHAT_COMPRESSION': args.codec})
+    with app.app_context():
+        compactor = chat_storage.Compactor(app, db.session, compact_chats, archive_after_days=args.archive_after_days)
+        start = time.perf_counter()
+        report = compactor.run()
+        elapsed = time.perf_counter() - start
+    after = measure(path, args.users)
+
+    total = args.users * args.conversations * args.chats
+    print(f"{total} chats, {args.users} users; compaction took {elapsed:.2f}s: {report['compressed']} answers "
+          f"{report['bytes_before'] / 1024:.0f} -> {report['bytes_after'] / 1024:.0f} KiB ({args.codec}), "
+          f"{report['archived']} conversations ({report['archived_chats']} chats) archived")
+    print(f"  {'':<20}{'before':>12}{'after':>12}{'change':>9}")
+    for label in before:
+        change = (after[label] - before[label]) / before[label] if before[label] else 0.0
+        print(f"  {label:<20}{before[label]:>12.1f}{after[label]:>12.1f}{change:>+9.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Per-request upstream latency with and without the pooled Gemini client.
+
+Usage: python bench_upstream.py [--requests 500] [--concurrency 8] [--latency 0]
+"""
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from fake_gemini import FakeGeminiServer
+from gemini_client import GeminiClient
+
+PAYLOAD = {"contents": [{"parts": [{"text": "hello"}]}]}
+
+
+def unpooled_call(url):
+    # What the chat handlers used to do: a fresh connection per message
+    return requests.post(f"{url}?key=bench", json=PAYLOAD, headers={'Content-Type': 'application/json'})
+
+
+def run(label, call, total, concurrency):
+    def timed(_):
+        start = time.perf_counter()
+        response = call()
+        response.raise_for_status()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = sorted(pool.map(timed, range(total)))
+    elapsed = time.perf_counter() - start
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    print(f"{label:<10} mean={statistics.mean(latencies) * 1000:7.2f}ms "
+          f"p50={pct(0.50):7.2f}ms p95={pct(0.95):7.2f}ms p99={pct(0.99):7.2f}ms "
+          f"throughput={total / elapsed:8.1f} req/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.0, help="stub server delay in seconds")
+    args = parser.parse_args()
+
+    server = FakeGeminiServer(latency=args.latency).start()
+    client = GeminiClient(server.url, 'bench', pool_size=args.concurrency)
+    try:
+        run('unpooled', lambda: unpooled_call(server.url), args.requests, args.concurrency)
+        run('pooled', lambda: client.generate_content(PAYLOAD), args.requests, args.concurrency)
+    finally:
+        client.close()
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
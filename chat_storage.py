@@ -0,0 +1,236 @@
+"""Tiered storage for chat history.
+
+Hot tier: chat_history, whose response column holds each answer compressed
+(CHAT_COMPRESSION: zlib, or zstd when the zstandard package is installed) and
+decoded transparently when the row is read. Answers too short to shrink are kept
+as plain UTF-8, and rows saved before compression read back unchanged.
+
+Cold tier: conversations idle for CHAT_ARCHIVE_AFTER_DAYS move whole into
+chat_archive, one compressed row per conversation, and leave the search index.
+They stay in the conversation list; opening or continuing one moves it back to
+chat_history (models.restore_conversation), and exports read the archive in
+place. History pages and search only cover the hot tier.
+
+A Compactor compresses rows saved before compression was on and archives idle
+conversations, on a background thread every CHAT_COMPACT_INTERVAL seconds or once
+with `flask --app app compact-chats`. A pass is safe alongside the app and other
+passes, but one process running it is enough.
+"""
+import atexit
+import datetime
+import heapq
+import json
+import logging
+import os
+import threading
+import zlib
+
+from sqlalchemy import LargeBinary, select
+from sqlalchemy.types import TypeDecorator
+
+from logs import log_event
+
+# Defaults used when an app does not override them in its config
+DEFAULT_CODEC = 'zlib'
+DEFAULT_BATCH_SIZE = 500
+ARCHIVE_BATCH_SIZE = 50  # archive rows fetched at a time when reading them in place
+MIN_COMPRESS_BYTES = 128  # shorter answers rarely shrink
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# A compressed value starts with NUL and a codec letter; stored text never starts with NUL
+TAGS = {'zlib': b'\x00z', 'zstd': b'\x00s'}
+
+_codec = DEFAULT_CODEC
+
+
+def configure(config):
+    """Pick the codec new answers are stored with from CHAT_COMPRESSION (None stores them uncompressed)."""
+    global _codec
+    codec = config.get('CHAT_COMPRESSION', DEFAULT_CODEC)
+    if codec is not None and codec not in TAGS:
+        raise ValueError(f"unknown CHAT_COMPRESSION {codec!r}")
+    if codec == 'zstd':
+        _zstd()  # fail at startup rather than on the first save
+    _codec = codec
+
+
+def _zstd():
+    # zstandard is optional; zlib is always available
+    import zstandard
+
+    return zstandard
+
+
+def compress(data, codec):
+    if codec == 'zstd':
+        return TAGS['zstd'] + _zstd().ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return TAGS['zlib'] + zlib.compress(data, ZLIB_LEVEL)
+
+
+def encode(text):
+    """Stored form of `text`: compressed with the configured codec when that makes it smaller."""
+    data = text.encode()
+    if _codec is not None and len(data) >= MIN_COMPRESS_BYTES:
+        packed = compress(data, _codec)
+        if len(packed) < len(data):
+            return packed
+    return data
+
+
+def decode(value):
+    """Text of a stored value, whichever codec wrote it; plain text columns pass through."""
+    if value is None or isinstance(value, str):
+        return value
+    value = bytes(value)
+    if value[:2] == TAGS['zlib']:
+        return zlib.decompress(value[2:]).decode()
+    if value[:2] == TAGS['zstd']:
+        return _zstd().ZstdDecompressor().decompress(value[2:]).decode()
+    return value.decode()
+
+
+def is_compressed(value):
+    return isinstance(value, (bytes, memoryview)) and bytes(value[:1]) == b'\x00'
+
+
+class CompressedText(TypeDecorator):
+    """Text column stored through encode() and read through decode()."""
+
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else encode(value)
+
+    def process_result_value(self, value, dialect):
+        return decode(value)
+
+
+def pack_chats(chats):
+    """One archive payload for a conversation's chats (dicts with datetime timestamps)."""
+    records = [dict(chat, timestamp=chat['timestamp'].isoformat()) for chat in chats]
+    return compress(json.dumps(records).encode(), _codec or DEFAULT_CODEC)
+
+
+def unpack_chats(payload):
+    return [dict(record, timestamp=datetime.datetime.fromisoformat(record['timestamp']))
+            for record in json.loads(decode(payload))]
+
+
+def archived_chats(session, ChatArchive, user_id, since=None):
+    """Yield the user's archived chats oldest first, as dicts like export.chat_records() makes.
+
+    Archives are read in order of their first chat and each is unpacked only once
+    every earlier chat has been yielded, so memory holds the conversations that
+    overlap in time rather than the whole archive.
+    """
+    statement = select(ChatArchive.chats).where(ChatArchive.user_id == user_id)
+    if since is not None:
+        statement = statement.where(ChatArchive.last_timestamp > since)
+    statement = statement.order_by(ChatArchive.first_timestamp, ChatArchive.conversation_id)
+
+    pending = []
+    for payload in session.execute(statement.execution_options(yield_per=ARCHIVE_BATCH_SIZE)).scalars():
+        chats = unpack_chats(payload)
+        while pending and pending[0][0] <= chats[0]['timestamp']:
+            yield heapq.heappop(pending)[-1]
+        for chat in chats:
+            if since is None or chat['timestamp'] > since:
+                heapq.heappush(pending, (chat['timestamp'], chat['id'], chat))
+    while pending:
+        yield heapq.heappop(pending)[-1]
+
+
+class Compactor:
+    """Runs `compact(session, after_id, archive_before, batch_size)` passes over the chat tables.
+
+    `compact` (models.compact_chats) compresses up to batch_size rows with ids
+    above after_id and archives up to batch_size conversations idle since
+    archive_before, returning a report dict with the last id it looked at. A run
+    repeats it until both are done; later runs start after the last row already
+    seen, since new rows are compressed as they are saved.
+    """
+
+    def __init__(self, app, session, compact, interval=None, archive_after_days=None, batch_size=DEFAULT_BATCH_SIZE):
+        self.app = app
+        self.session = session
+        self.compact = compact
+        self.interval = interval
+        self.archive_after_days = archive_after_days
+        self.batch_size = batch_size
+        self.last_id = 0
+        self.totals = dict.fromkeys(('compressed', 'bytes_before', 'bytes_after', 'archived', 'archived_chats'), 0)
+        self.runs = 0
+        self.failed = 0
+        self._pid = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    @classmethod
+    def from_config(cls, app, session, compact):
+        config = app.config
+        return cls(
+            app,
+            session,
+            compact,
+            interval=config.get('CHAT_COMPACT_INTERVAL'),
+            archive_after_days=config.get('CHAT_ARCHIVE_AFTER_DAYS'),
+            batch_size=config.get('CHAT_COMPACT_BATCH_SIZE', DEFAULT_BATCH_SIZE),
+        )
+
+    def start(self):
+        """Start the background thread in this process, if an interval is set; cheap to call on every request."""
+        if not self.interval or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # The thread does not survive a fork, so each process starts its own
+            self._stop = threading.Event()
+            threading.Thread(target=self._loop, name='chat-compactor', daemon=True).start()
+            self._pid = os.getpid()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                with self.app.app_context():
+                    self.run()
+            except Exception as e:
+                # The next pass starts over from the same place
+                log_event('chat_compaction_failed', logging.ERROR, error=repr(e))
+                self.failed += 1
+
+    def run(self):
+        """Compress and archive until there is nothing left to do; needs an app context. Returns this run's report."""
+        report = dict.fromkeys(self.totals, 0)
+        archive_before = None
+        if self.archive_after_days is not None:
+            archive_before = datetime.datetime.utcnow() - datetime.timedelta(days=self.archive_after_days)
+        while True:
+            try:
+                done = self.compact(self.session, self.last_id, archive_before, self.batch_size)
+            except Exception:
+                self.session.rollback()
+                raise
+            for key in report:
+                report[key] += done[key]
+            with self._lock:
+                for key in report:
+                    self.totals[key] += done[key]
+            if done['last_id'] is None and done['archived'] < self.batch_size:
+                break
+            self.last_id = done['last_id'] or self.last_id
+        self.runs += 1
+        log_event('chat_compaction', **report)
+        return report
+
+    def close(self):
+        self._stop.set()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.totals, bytes_saved=self.totals['bytes_before'] - self.totals['bytes_after'],
+                        runs=self.runs, failed=self.failed, last_id=self.last_id, codec=_codec,
+                        archive_after_days=self.archive_after_days)
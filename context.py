@@ -0,0 +1,181 @@
+import threading
+from collections import OrderedDict, deque
+
+from gemini_client import UpstreamError, extract_text
+
+# Defaults used when an app does not override them in its config
+DEFAULT_TOKEN_BUDGET = 2000
+DEFAULT_MAX_CONVERSATIONS = 1000
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation below between a user and an assistant in a few sentences. "
+    "Keep any facts, names, numbers and decisions the assistant may need to answer later questions."
+)
+
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English text
+    return len(text) // 4 + 1
+
+
+def user_turn(text):
+    return {"role": "user", "parts": [{"text": text}]}
+
+
+def model_turn(text):
+    return {"role": "model", "parts": [{"text": text}]}
+
+
+class _Window:
+    def __init__(self, summary, summary_turns, turns, message_count):
+        self.summary = summary
+        self.summary_turns = summary_turns
+        self.turns = deque(turns)
+        self.message_count = message_count
+
+    def tokens(self):
+        return sum(estimate_tokens(message) + estimate_tokens(response) for message, response in self.turns)
+
+
+class ConversationContext:
+    """Builds multi-turn generateContent payloads from a conversation's earlier turns.
+
+    The recent turns of each conversation are kept in memory (LRU over conversations),
+    so a new turn only re-reads ChatHistory when this process has not seen the
+    conversation yet or another worker has added to it since. Once the turns exceed the
+    token budget, the oldest are folded into a running summary stored on the Conversation
+    row and sent as a system instruction instead of in full.
+    """
+
+    def __init__(self, summarize, token_budget=DEFAULT_TOKEN_BUDGET, max_conversations=DEFAULT_MAX_CONVERSATIONS):
+        self.summarize = summarize
+        self.token_budget = token_budget
+        self.max_conversations = max_conversations
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, summarize):
+        return cls(
+            summarize,
+            token_budget=config.get('CONTEXT_TOKEN_BUDGET', DEFAULT_TOKEN_BUDGET),
+            max_conversations=config.get('CONTEXT_MAX_CONVERSATIONS', DEFAULT_MAX_CONVERSATIONS),
+        )
+
+    def build_payload(self, conversation, message, load_turns):
+        """Return the payload for `message` sent in `conversation` (None for a new conversation).
+
+        `load_turns(skip)` returns the stored (message, response) pairs oldest first, skipping
+        the first `skip`. When older turns get summarized, the summary is written to
+        `conversation.summary`/`summary_turns` so it commits together with the chat being saved.
+        """
+        if conversation is None:
+            return {"contents": [user_turn(message)]}
+
+        window = self._window(conversation, load_turns)
+        turns = self._fit(window, conversation)
+
+        contents = []
+        for turn_message, turn_response in turns:
+            contents.append(user_turn(turn_message))
+            contents.append(model_turn(turn_response))
+        contents.append(user_turn(message))
+
+        payload = {"contents": contents}
+        if window.summary:
+            payload["systemInstruction"] = {
+                "parts": [{"text": f"Summary of the earlier conversation: {window.summary}"}]
+            }
+        return payload
+
+    def record_turn(self, conversation_id, message, response):
+        """Append a saved turn to the in-memory window, starting one for a new conversation."""
+        with self._lock:
+            window = self._windows.get(conversation_id)
+            if window is None:
+                window = self._windows[conversation_id] = _Window(None, 0, [], 0)
+            window.turns.append((message, response))
+            window.message_count += 1
+            self._windows.move_to_end(conversation_id)
+            while len(self._windows) > self.max_conversations:
+                self._windows.popitem(last=False)
+
+    def _window(self, conversation, load_turns):
+        with self._lock:
+            window = self._windows.get(conversation.id)
+            if window is not None and window.message_count == conversation.message_count:
+                self._windows.move_to_end(conversation.id)
+                return window
+
+        # First turn seen by this process, or another worker saved turns since
+        turns = load_turns(conversation.summary_turns or 0)
+        window = _Window(conversation.summary, conversation.summary_turns or 0, turns, conversation.message_count)
+        with self._lock:
+            self._windows[conversation.id] = window
+            self._windows.move_to_end(conversation.id)
+            while len(self._windows) > self.max_conversations:
+                self._windows.popitem(last=False)
+        return window
+
+    def _fit(self, window, conversation):
+        """Return the turns to send in full, summarizing older ones when over budget."""
+        if window.tokens() <= self.token_budget:
+            return window.turns
+
+        # Keep the newest turns within half the budget so summarizing happens every few turns, not every turn
+        kept, used = deque(), 0
+        for turn in reversed(window.turns):
+            cost = estimate_tokens(turn[0]) + estimate_tokens(turn[1])
+            if used + cost > self.token_budget // 2 and kept:
+                break
+            kept.appendleft(turn)
+            used += cost
+        older = list(window.turns)[:len(window.turns) - len(kept)]
+
+        summary = self.summarize(window.summary, older)
+        if summary is None:
+            # Summarizing failed: send only what fits and try again next turn
+            return kept
+
+        window.summary = summary
+        window.summary_turns += len(older)
+        window.turns = kept
+        conversation.summary = summary
+        conversation.summary_turns = window.summary_turns
+        return kept
+
+
+def make_summarizer(gemini):
+    """summarize(summary, turns) through the model router, as cheap traffic; returns None if the call fails."""
+    def summarize(summary, turns):
+        lines = [SUMMARY_PROMPT, ""]
+        if summary:
+            lines.append(f"Earlier summary: {summary}")
+        for message, response in turns:
+            lines.append(f"User: {message}")
+            lines.append(f"Assistant: {response}")
+
+        try:
+            _, response = gemini.generate_content({"contents": [user_turn("\n".join(lines))]})
+        except UpstreamError:
+            # The client has logged the failure; the caller keeps the turns unsummarized
+            return None
+        if response.status_code != 200:
+            return None
+        try:
+            return extract_text(response.json(), default=None)
+        except ValueError:
+            return None
+
+    return summarize
+
+
+def load_turns(ChatHistory, user_id, conversation_id, skip, session=None):
+    """Stored (message, response) pairs of a conversation, oldest first, after the first `skip`.
+
+    Read through `session` when given, else the Flask-SQLAlchemy one.
+    """
+    query = session.query(ChatHistory) if session is not None else ChatHistory.query
+    chats = query.filter_by(user_id=user_id, conversation_id=conversation_id) \
+        .order_by(ChatHistory.timestamp, ChatHistory.id).offset(skip).all()
+    return [(chat.message, chat.response) for chat in chats]
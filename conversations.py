@@ -0,0 +1,53 @@
+import datetime
+
+from sqlalchemy import update
+
+TITLE_LENGTH = 50
+PREVIEW_LENGTH = 100
+
+
+def summary_update(Conversation, conversation_id, message, now):
+    """UPDATE that folds one more message into an existing conversation summary."""
+    return (
+        update(Conversation)
+        .where(Conversation.id == conversation_id)
+        .values(
+            message_count=Conversation.message_count + 1,
+            updated_at=now,
+            last_message_preview=message[:PREVIEW_LENGTH],
+        )
+    )
+
+
+def new_summary(Conversation, user_id, conversation_id, title, message, now):
+    return Conversation(
+        id=conversation_id,
+        user_id=user_id,
+        title=(title or message)[:TITLE_LENGTH],
+        created_at=now,
+        updated_at=now,
+        message_count=1,
+        last_message_preview=message[:PREVIEW_LENGTH],
+    )
+
+
+def record_message(session, Conversation, user_id, conversation_id, title, message):
+    """Update the conversation summary for a chat being saved, creating it on the first message.
+
+    Runs in the caller's transaction so the summary commits together with the ChatHistory row.
+    """
+    now = datetime.datetime.utcnow()
+    if not session.execute(summary_update(Conversation, conversation_id, message, now)).rowcount:
+        session.add(new_summary(Conversation, user_id, conversation_id, title, message, now))
+
+
+def serialize_conversation(conversation):
+    return {
+        "conversation_id": conversation.id,
+        "title": conversation.title,
+        "message_count": conversation.message_count,
+        "last_message_preview": conversation.last_message_preview,
+        "created_at": conversation.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+        "updated_at": conversation.updated_at.strftime('%Y-%m-%d %H:%M:%S'),
+        "archived": conversation.archived_at is not None
+    }
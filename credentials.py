@@ -0,0 +1,202 @@
+"""Password hashing off the request threads.
+
+Passwords are stored as salted scrypt hashes (Werkzeug's format, method set by
+PASSWORD_HASH_METHOD). Each hash costs tens of milliseconds of CPU and 32 MiB,
+so hashing and checking run in a small process pool (PASSWORD_HASH_WORKERS,
+0 for the calling thread) instead of holding a request thread and the GIL. As
+with any multiprocessing pool, a script that logs users in must keep its own
+code under `if __name__ == '__main__':`, since pool workers import the main module.
+
+The pool is per server process, so a gunicorn deployment runs web workers x
+PASSWORD_HASH_WORKERS hashing processes. The default of 2 suits a few web
+workers; size it so that product stays near the number of CPUs. None starts one
+per CPU, which is only sensible for a single server process.
+
+At most PASSWORD_HASH_MAX_PENDING operations (by default 4 per hashing process)
+are queued or running per server process. A request that cannot get a slot
+within PASSWORD_HASH_QUEUE_TIMEOUT seconds gets CredentialsBusy, which the login
+and signup routes turn into a 503 with Retry-After. A login storm is thus shed
+instead of tying up every request thread while it waits for a hashing worker.
+
+Accounts created before this still hold an unsalted SHA-256 hex digest. It is
+checked directly and replaced with a current hash on the user's next login, as
+is a hash made with an older PASSWORD_HASH_METHOD.
+"""
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import update
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from metrics import PASSWORD_HASH_SECONDS, PASSWORD_QUEUE_SECONDS, PASSWORD_REJECTED, PASSWORD_UPGRADES
+
+# Defaults used when an app does not override them in its config
+DEFAULT_METHOD = 'scrypt:32768:8:1'
+DEFAULT_WORKERS = 2
+PENDING_PER_WORKER = 4
+DEFAULT_QUEUE_TIMEOUT = 1.0
+
+
+class CredentialsBusy(Exception):
+    """Too many password operations are queued; try again after `retry_after` seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"password hashing queue full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+def is_legacy(stored):
+    """Whether `stored` is an unsalted SHA-256 hex digest from before salted hashes."""
+    return len(stored) == 64 and '$' not in stored
+
+
+def password_matches(stored, password):
+    """Check a password in the calling thread, whichever kind of hash is stored."""
+    if is_legacy(stored):
+        return hmac.compare_digest(stored, hashlib.sha256(password.encode()).hexdigest())
+    return check_password_hash(stored, password)
+
+
+def _exit_with_server(server_pid):
+    # Pool workers are not told when a server process is killed, and a fork server only
+    # exits once its workers have, so each worker checks that its server is still there
+    def watch():
+        while True:
+            time.sleep(1)
+            try:
+                os.kill(server_pid, 0)
+            except ProcessLookupError:
+                os._exit(0)
+    threading.Thread(target=watch, daemon=True).start()
+
+
+def _pool_context():
+    # A fork server that has preloaded only this module: workers start quickly and copy no
+    # threads or locks from the (threaded) server. Each worker still imports the server's
+    # main module (as __mp_main__, so its `if __name__ == '__main__':` block does not run)
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['credentials'])
+        return context
+    return multiprocessing.get_context('spawn')
+
+
+def _timed(function, *args):
+    # Runs in the worker; wall-clock times so the caller can split queue time from hashing time
+    started = time.time()
+    return started, function(*args), time.time()
+
+
+class PasswordHasher:
+    def __init__(self, method=DEFAULT_METHOD, workers=DEFAULT_WORKERS, max_pending=None, queue_timeout=DEFAULT_QUEUE_TIMEOUT):
+        self.method = method
+        self.workers = os.cpu_count() if workers is None else workers
+        self.queue_timeout = queue_timeout
+        self.max_pending = max_pending or PENDING_PER_WORKER * max(self.workers, 1)
+        self.pending = 0
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            method=config.get('PASSWORD_HASH_METHOD', DEFAULT_METHOD),
+            workers=config.get('PASSWORD_HASH_WORKERS', DEFAULT_WORKERS),
+            max_pending=config.get('PASSWORD_HASH_MAX_PENDING'),
+            queue_timeout=config.get('PASSWORD_HASH_QUEUE_TIMEOUT', DEFAULT_QUEUE_TIMEOUT),
+        )
+
+    @property
+    def executor(self):
+        # Started on first use in each process
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._executor = ProcessPoolExecutor(self.workers, mp_context=_pool_context(),
+                                                         initializer=_exit_with_server,
+                                                         initargs=(os.getpid(),))
+                    self._pid = os.getpid()
+        return self._executor
+
+    def _run(self, op, function, *args):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            PASSWORD_REJECTED.inc(op=op)
+            raise CredentialsBusy(max(1, round(self.queue_timeout)))
+        with self._lock:
+            self.pending += 1
+        try:
+            submitted = time.time()
+            if self.workers:
+                started, result, finished = self.executor.submit(_timed, function, *args).result()
+            else:
+                started, result, finished = _timed(function, *args)
+            PASSWORD_QUEUE_SECONDS.observe(max(0.0, started - submitted), op=op)
+            PASSWORD_HASH_SECONDS.observe(finished - started, op=op)
+            return result
+        finally:
+            with self._lock:
+                self.pending -= 1
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run('hash', generate_password_hash, password, self.method)
+
+    def verify(self, stored, password):
+        """(whether `password` matches `stored`, a replacement hash to save or None)."""
+        if is_legacy(stored):
+            # Cheap enough for the request thread
+            if not password_matches(stored, password):
+                return False, None
+            PASSWORD_UPGRADES.inc(kind='sha256')
+            return True, self.hash(password)
+        if not self._run('verify', check_password_hash, stored, password):
+            return False, None
+        if not stored.startswith(self.method + '$'):
+            PASSWORD_UPGRADES.inc(kind=stored.split('$', 1)[0])
+            return True, self.hash(password)
+        return True, None
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self._pid = None
+
+    def stats(self):
+        return {"workers": self.workers, "pending": self.pending, "max_pending": self.max_pending}
+
+
+def authenticate(session, User, hasher, email, password):
+    """The user with this email and password (detached from `session`), or None.
+
+    The connection is handed back before the password is checked, so logins
+    waiting for a hashing worker do not hold the DB pool. An outdated hash is
+    replaced, unless the password changed in the meantime.
+    """
+    user = session.query(User).filter_by(email=email).first()
+    if user is not None:
+        session.expunge(user)
+    session.rollback()
+    if user is None:
+        return None
+    valid, upgraded = hasher.verify(user.password, password)
+    if not valid:
+        return None
+    if upgraded:
+        session.execute(
+            update(User)
+            .where(User.id == user.id, User.password == user.password)
+            .values(password=upgraded)
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+        user.password = upgraded
+    return user
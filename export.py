@@ -0,0 +1,110 @@
+"""Streaming export of a user's chat history.
+
+Rows come from a server-side cursor in batches of `yield_per` and are encoded and
+(optionally) gzipped chunk by chunk, so memory stays flat however long the history is.
+Plain column rows are selected rather than ORM objects, so nothing accumulates in
+the session's identity map while streaming. Archived conversations (see
+chat_storage.py) are merged in by timestamp as their turn comes.
+"""
+import datetime
+import heapq
+import json
+import zlib
+
+from sqlalchemy import select
+
+from chat_storage import archived_chats
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'json': 'application/json',
+}
+BATCH_SIZE = 1000
+CHUNK_SIZE = 64 * 1024  # bytes gathered before a chunk is sent
+
+
+def export_args(args):
+    """Read `format` and `since` (ISO timestamp, exclusive) from request args; raises ValueError on bad input.
+
+    A `since` with a UTC offset is converted to naive UTC, the form timestamps are stored in.
+    """
+    export_format = args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError("unknown format")
+    since = args.get('since')
+    if not since:
+        return export_format, None
+    since = datetime.datetime.fromisoformat(since)
+    if since.tzinfo is not None:
+        since = since.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return export_format, since
+
+
+def chat_records(session, ChatHistory, user_id, since=None, batch_size=BATCH_SIZE, ChatArchive=None):
+    """Yield the user's chats oldest first as dicts, reading `batch_size` rows at a time.
+
+    With `ChatArchive`, the user's archived chats are included.
+    """
+    columns = [ChatHistory.id, ChatHistory.conversation_id, ChatHistory.title, ChatHistory.message,
+               ChatHistory.response, ChatHistory.timestamp]
+    statement = select(*columns).where(ChatHistory.user_id == user_id)
+    if since is not None:
+        statement = statement.where(ChatHistory.timestamp > since)
+    statement = statement.order_by(ChatHistory.timestamp, ChatHistory.id).execution_options(yield_per=batch_size)
+
+    chats = (row._asdict() for row in session.execute(statement))
+    if ChatArchive is not None:
+        chats = heapq.merge(chats, archived_chats(session, ChatArchive, user_id, since),
+                            key=lambda chat: (chat['timestamp'], chat['id']))
+    for chat in chats:
+        yield {
+            "id": chat['id'],
+            "conversation_id": chat['conversation_id'],
+            "title": chat['title'],
+            "message": chat['message'],
+            "response": chat['response'],
+            # Full precision, so the last timestamp can be passed back as `since`
+            "timestamp": chat['timestamp'].isoformat(),
+        }
+
+
+def encode(records, export_format):
+    """Encode records as NDJSON lines or one JSON array, in chunks of about CHUNK_SIZE bytes."""
+    if export_format == 'ndjson':
+        pieces = (json.dumps(record) + '\n' for record in records)
+    else:
+        pieces = _json_array(records)
+
+    buffer, size = [], 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= CHUNK_SIZE:
+            yield ''.join(buffer).encode()
+            buffer, size = [], 0
+    if buffer:
+        yield ''.join(buffer).encode()
+
+
+def _json_array(records):
+    yield '['
+    separator = ''
+    for record in records:
+        yield separator + json.dumps(record)
+        separator = ','
+    yield ']'
+
+
+def gzip_chunks(chunks):
+    """Gzip a stream of byte chunks incrementally."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 writes a gzip header
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def accepts_gzip(request):
+    # Parsed like compress_response does, so "gzip;q=0" is a refusal
+    return request.accept_encodings['gzip'] > 0
@@ -0,0 +1,37 @@
+"""Per-app services, used by the blueprints as if they were module globals.
+
+create_app() builds one of each and keeps it in app.extensions; each name here
+resolves to the current app's instance.
+"""
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+# Pooled keep-alive Gemini client shared by every request in this process
+gemini = LocalProxy(lambda: current_app.extensions['gemini'])
+
+# Cache of upstream answers for repeated prompts
+response_cache = LocalProxy(lambda: current_app.extensions['response_cache'])
+
+# Recent turns per conversation, used to send earlier context with each message
+chat_context = LocalProxy(lambda: current_app.extensions['chat_context'])
+
+# Per-user, per-IP and global limits on the chat endpoints, which each cost an upstream call
+rate_limiter = LocalProxy(lambda: current_app.extensions['rate_limiter'])
+
+# Chat persistence, optionally batched on a background thread (CHAT_WRITE_BEHIND)
+chat_writes = LocalProxy(lambda: current_app.extensions['chat_writes'])
+
+# Recently read users' subscription and token balance, so most requests skip the user row
+auth_cache = LocalProxy(lambda: current_app.extensions['auth_cache'])
+
+# Password hashing in a bounded process pool, off the request threads
+password_hasher = LocalProxy(lambda: current_app.extensions['password_hasher'])
+
+# Compression of stored answers and archiving of idle conversations (see chat_storage.py)
+chat_compactor = LocalProxy(lambda: current_app.extensions['chat_compactor'])
+
+# Per-user message vectors for suggesting related past conversations
+related_index = LocalProxy(lambda: current_app.extensions['related_index'])
+
+# Batch chats answered in the background on a bounded pool (see batch.py)
+batch_jobs = LocalProxy(lambda: current_app.extensions['batch_jobs'])
@@ -0,0 +1,164 @@
+"""Application factory behind app.py, app1.py and app2.py.
+
+create_app() only builds objects: nothing connects to the database or to Gemini,
+and PayPal and requests are imported on first use, so each preforked worker boots
+quickly. Tables are created and migrations applied by an explicit step, once per deploy:
+
+    flask --app app init-db
+"""
+import os
+from importlib import import_module
+
+import click
+from flask import Flask, request
+
+import chat_storage
+import logs
+import metrics
+from auth_cache import AuthCache
+from batch import BatchJobs
+from chat_storage import Compactor
+from context import ConversationContext, make_summarizer
+from credentials import PasswordHasher
+from database import apply_profile, engine_options
+from http_cache import compress_response
+from model_router import ModelRouter
+from models import BatchJob, compact_chats, db, init_db, save_batch, save_chats
+from rate_limit import RateLimiter
+from related import RelatedIndex
+from response_cache import ResponseCache
+from write_behind import WriteBehindQueue
+
+# Blueprint modules: the HTML UI, the JSON API and PayPal payments
+BLUEPRINTS = ('ui', 'api', 'payments')
+
+DEFAULT_CONFIG = {
+    'SECRET_KEY': 'your_secret_key_here',  # Change this to a random secret key
+    'SQLALCHEMY_DATABASE_URI': os.environ.get('DATABASE_URL', 'sqlite:///users.db'),
+    'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+    'GEMINI_API_URL': os.environ.get('GEMINI_API_URL', "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash-latest:generateContent"),
+    'GEMINI_API_KEY': None,
+    'GEMINI_POOL_SIZE': 10,
+    'GEMINI_CONNECT_TIMEOUT': 3.05,
+    'GEMINI_READ_TIMEOUT': 60,
+    'GEMINI_COALESCE': True,  # share one upstream call between identical in-flight prompts
+    'GEMINI_RETRY_ATTEMPTS': 3,  # attempts per call, counting the first (see upstream_policy.py)
+    'GEMINI_RETRY_BACKOFF': 0.5,
+    'GEMINI_RETRY_MAX_BACKOFF': 8,
+    'GEMINI_DEADLINE': 90,  # seconds for a whole call, retries included
+    'GEMINI_HEDGE_AFTER': None,  # e.g. 2.0 to send a second request when the first has not answered in 2s
+    'GEMINI_BREAKER_THRESHOLD': 5,  # consecutive failed attempts that open the circuit
+    'GEMINI_BREAKER_RESET': 30,  # seconds the circuit stays open before a probe
+    'GEMINI_FAST_MODEL': None,  # e.g. "gemini-1.5-flash-8b" for short prompts from non-subscribers
+    'GEMINI_PREMIUM_MODEL': None,  # e.g. "gemini-1.5-pro-latest" for subscribers
+    'GEMINI_FALLBACK_MODELS': (),  # tried in order after the chosen model and the primary one fail
+    'ROUTER_LONG_PROMPT_TOKENS': 1000,  # longer prompts skip the fast model
+    'ROUTER_SLOW_SECONDS': 10,  # p95 above this moves a model to the back of the line
+    'ROUTER_MAX_ERROR_RATE': 0.25,
+    'ROUTER_WINDOW': 60,  # seconds of calls the health checks look at
+    'CONTEXT_TOKEN_BUDGET': 2000,  # history tokens sent with each turn before older turns are summarized
+    'CONTEXT_MAX_CONVERSATIONS': 1000,
+    'CHAT_CACHE_TTL': 3600,
+    'CHAT_CACHE_MAX_ENTRIES': 10000,
+    'CHAT_CACHE_MAX_BYTES': 64 * 1024 * 1024,
+    'CHAT_CACHE_URL': os.environ.get('CHAT_CACHE_URL'),  # e.g. redis://localhost:6379/0 to share across workers
+    'CHAT_WRITE_BEHIND': False,  # save chats on a background thread in batches instead of in the request
+    'CHAT_WRITE_QUEUE_SIZE': 1000,
+    'CHAT_WRITE_BATCH_SIZE': 100,
+    'CHAT_COMPRESSION': 'zlib',  # codec for stored answers: "zlib", "zstd" (needs zstandard) or None (see chat_storage.py)
+    'CHAT_ARCHIVE_AFTER_DAYS': None,  # e.g. 180 to move conversations idle that long to chat_archive
+    'CHAT_COMPACT_INTERVAL': None,  # seconds between background compaction passes; or run `flask --app app compact-chats`
+    'CHAT_COMPACT_BATCH_SIZE': 500,
+    'RELATED_DIMENSIONS': 256,  # hashed TF-IDF buckets per message vector (see related.py)
+    'RELATED_MAX_MESSAGES': 250000,  # message vectors kept in memory per process, across users (~1 KiB each)
+    'BATCH_CONCURRENCY': 8,  # upstream calls in flight per process for /api/chat/batch jobs, shared by all jobs
+    'BATCH_MAX_PROMPTS': 500,  # prompts accepted in one batch
+    'RATE_LIMIT_USER': (20, 60),  # chats per user per 60 seconds
+    'RATE_LIMIT_IP': (60, 60),
+    'RATE_LIMIT_GLOBAL': (1000, 60),  # keep at or below the Gemini project's requests-per-minute quota
+    'RATE_LIMIT_URL': os.environ.get('RATE_LIMIT_URL'),  # e.g. redis://localhost:6379/0 to share limits across workers
+    'TOKEN_DAILY_REFILL': True,  # top non-subscribers back up to 5 tokens once a day (see quota.py)
+    'AUTH_CACHE_TTL': 30,  # seconds a user's subscription and token balance are reused; 0 reads them on every request
+    'AUTH_CACHE_MAX_ENTRIES': 10000,
+    'PASSWORD_HASH_METHOD': 'scrypt:32768:8:1',  # Werkzeug method string; older hashes are replaced at login
+    'PASSWORD_HASH_WORKERS': 2,  # hashing processes per server process (see credentials.py), 0 for the request thread
+    'PASSWORD_HASH_MAX_PENDING': None,  # hashes queued or running before logins wait for a slot; None for 4 per process
+    'PASSWORD_HASH_QUEUE_TIMEOUT': 1.0,  # seconds a login waits for a slot before a 503
+    'DB_POOL_SIZE': 10,
+    'DB_MAX_OVERFLOW': 20,
+    'SQLITE_BUSY_TIMEOUT': 30000,  # ms a writer waits for the lock before "database is locked"
+    'LOG_LEVEL': os.environ.get('LOG_LEVEL', 'INFO'),
+    'LOG_SAMPLE_RATE': 0.01,  # fraction of routine events (successful upstream calls) that are logged
+    'METRICS_TOKEN': os.environ.get('METRICS_TOKEN'),  # when set, /metrics requires "Authorization: Bearer <token>"
+    'PAYPAL_MODE': 'sandbox',  # or "live" for production
+    'PAYPAL_CLIENT_ID': 'your_paypal_client_id',
+    'PAYPAL_CLIENT_SECRET': 'your_paypal_client_secret',
+}
+
+
+def create_app(config=None, blueprints=BLUEPRINTS):
+    """Build an app serving `blueprints`, with DEFAULT_CONFIG updated from `config`."""
+    app = Flask(__name__)
+    app.config.from_mapping(DEFAULT_CONFIG)
+    app.config.from_mapping(config or {})
+    # SQLite production profile or server pool settings (see database.py)
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
+
+    db.init_app(app)
+    with app.app_context():
+        apply_profile(db.engine, app.config)
+
+    # One client per configured model behind the router (see model_router.py)
+    gemini = ModelRouter.from_config(app.config)
+    app.extensions['gemini'] = gemini
+    app.extensions['response_cache'] = ResponseCache.from_config(app.config)
+    app.extensions['chat_context'] = ConversationContext.from_config(app.config, make_summarizer(gemini))
+    app.extensions['rate_limiter'] = RateLimiter.from_config(app.config)
+    app.extensions['chat_writes'] = WriteBehindQueue.from_config(app, db.session, save_chats)
+    app.extensions['auth_cache'] = AuthCache.from_config(app.config)
+    app.extensions['password_hasher'] = PasswordHasher.from_config(app.config)
+    chat_storage.configure(app.config)
+    app.extensions['chat_compactor'] = Compactor.from_config(app, db.session, compact_chats)
+    app.extensions['related_index'] = RelatedIndex.from_config(app.config)
+    app.extensions['batch_jobs'] = BatchJobs.from_config(app, db.session, BatchJob, save_batch)
+
+    # Structured logs, request timing and /metrics; registered first so the timing includes compression
+    logs.configure(app.config)
+    metrics.init_app(app)
+
+    # Compress large HTML and JSON responses for clients that accept it
+    @app.after_request
+    def compress(response):
+        return compress_response(request, response)
+
+    # Background compaction, when CHAT_COMPACT_INTERVAL is set, starts with the first request in each process
+    @app.before_request
+    def start_compactor():
+        app.extensions['chat_compactor'].start()
+
+    for name in blueprints:
+        app.register_blueprint(import_module(name).bp)
+
+    @app.cli.command('init-db')
+    def init_db_command():
+        """Create the tables and apply pending schema migrations."""
+        for version in init_db():
+            click.echo(f"Applied {version}")
+
+    @app.cli.command('compact-chats')
+    @click.option('--archive-after-days', type=int, help="Archive conversations idle this long (default CHAT_ARCHIVE_AFTER_DAYS).")
+    @click.option('--vacuum', is_flag=True, help="Rebuild the SQLite file afterwards so the space is returned.")
+    def compact_chats_command(archive_after_days, vacuum):
+        """Compress stored answers and archive idle conversations, then report the savings."""
+        compactor = app.extensions['chat_compactor']
+        if archive_after_days is not None:
+            compactor.archive_after_days = archive_after_days
+        report = compactor.run()
+        click.echo(f"Compressed {report['compressed']} answers: {report['bytes_before']} -> {report['bytes_after']} bytes")
+        click.echo(f"Archived {report['archived']} conversations ({report['archived_chats']} chats)")
+        if vacuum and db.engine.dialect.name == 'sqlite':
+            with db.engine.connect() as conn:
+                conn.exec_driver_sql("VACUUM")
+            click.echo("Vacuumed the database")
+
+    return app
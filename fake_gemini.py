@@ -0,0 +1,158 @@
+"""Local stand-in for the Gemini generateContent endpoint, used by the benchmarks.
+
+Run it on its own with `python fake_gemini.py --port 8081` and point `api_url` at
+http://127.0.0.1:8081/v1beta/models/gemini-1.5-flash-latest:generateContent
+
+Answers echo the prompt after `latency` seconds, give or take a normally distributed
+`jitter`; an `error_rate` fraction of calls get an `error_status` error instead, the
+way Gemini reports overload (with a Retry-After header when `retry_after` is set),
+and a `hang_rate` fraction only answer after `hang_time` seconds. Streams send `chunk_words` words per event, `chunk_delay`
+seconds apart. Given a `seed`, the delays and errors are drawn from the same sequence on every run.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so clients can keep the connection open between requests
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        prompt = body.get('contents', [{}])[-1].get('parts', [{}])[0].get('text', '')
+        delay, failed = self.server.draw()
+
+        if delay:
+            time.sleep(delay)
+
+        if failed:
+            self.send_error_body(self.server.error_status)
+            return
+
+        if ':streamGenerateContent' in self.path:
+            self.send_stream(f"Echo: {prompt}")
+            return
+
+        data = json.dumps({
+            "candidates": [
+                {"content": {"parts": [{"text": f"Echo: {prompt}"}], "role": "model"}}
+            ]
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_body(self, status):
+        data = json.dumps({"error": {"code": status, "message": "The model is overloaded.", "status": "UNAVAILABLE"}}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if self.server.retry_after is not None:
+            self.send_header('Retry-After', str(self.server.retry_after))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, text):
+        # One SSE event per chunk_words words, sent with chunked encoding so the connection stays reusable
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        words = text.split(' ')
+        size = self.server.chunk_words
+        for i in range(0, len(words), size):
+            part = ' '.join(words[i:i + size]) + ' '
+            chunk = {"candidates": [{"content": {"parts": [{"text": part}], "role": "model"}}]}
+            self.write_chunk(f"data: {json.dumps(chunk)}\r\n\r\n".encode())
+            if self.server.chunk_delay:
+                time.sleep(self.server.chunk_delay)
+        self.write_chunk(b'')
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+class FakeGeminiServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0, chunk_delay=0.0, jitter=0.0, error_rate=0.0,
+                 error_status=503, retry_after=None, hang_rate=0.0, hang_time=30.0, chunk_words=1, seed=None):
+        super().__init__(address, FakeGeminiHandler)
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.hang_rate = hang_rate
+        self.hang_time = hang_time
+        self.chunk_words = chunk_words
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def draw(self):
+        """Delay and whether to fail, for the next call."""
+        with self.lock:
+            self.requests += 1
+            delay = max(0.0, self.random.gauss(self.latency, self.jitter)) if self.jitter else self.latency
+            if self.random.random() < self.hang_rate:
+                delay = self.hang_time
+            failed = self.random.random() < self.error_rate
+            self.errors += failed
+        return delay, failed
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1beta/models/gemini-1.5-flash-latest:generateContent"
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds to wait before answering")
+    parser.add_argument('--jitter', type=float, default=0.0, help="standard deviation of the delay in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of calls answered with an error")
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--retry-after', type=int, help="Retry-After seconds sent with errors")
+    parser.add_argument('--hang-rate', type=float, default=0.0, help="fraction of calls that hang for --hang-time")
+    parser.add_argument('--hang-time', type=float, default=30.0)
+    parser.add_argument('--chunk-delay', type=float, default=0.0, help="seconds between streamed chunks")
+    parser.add_argument('--chunk-words', type=int, default=1, help="words per streamed chunk")
+    parser.add_argument('--seed', type=int, help="seed for the delays and errors")
+    args = parser.parse_args()
+
+    server = FakeGeminiServer((args.host, args.port), latency=args.latency, chunk_delay=args.chunk_delay,
+                              jitter=args.jitter, error_rate=args.error_rate, error_status=args.error_status,
+                              retry_after=args.retry_after, hang_rate=args.hang_rate, hang_time=args.hang_time,
+                              chunk_words=args.chunk_words, seed=args.seed)
+    print(f"Fake Gemini listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
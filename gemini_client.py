@@ -0,0 +1,395 @@
+import asyncio
+import atexit
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+from logs import log_event
+from metrics import UPSTREAM_HEDGES, UPSTREAM_REQUESTS, UPSTREAM_RETRIES, UPSTREAM_SECONDS
+from singleflight import SingleFlight
+from upstream_policy import RETRY_STATUSES, CircuitBreaker, RetryPolicy, parse_retry_after
+
+# Defaults used when an app does not override them in its config
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 60
+DEFAULT_ASYNC_POOL_SIZE = 100
+# How much of an upstream error body goes into the log
+ERROR_DETAIL_LENGTH = 200
+# requests puts the full URL, API key included, in its error messages
+API_KEY_PARAM = re.compile(r'key=[^&\s\'"]+')
+
+
+class UpstreamError(Exception):
+    """A call to the Gemini API failed: connection error, timeout or a broken stream."""
+
+
+class CircuitOpenError(UpstreamError):
+    """Upstream was not called because the circuit breaker is open."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Gemini circuit open, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+@contextmanager
+def _upstream_errors():
+    # requests is imported on first use, so workers that never call upstream skip it
+    import requests
+
+    try:
+        yield
+    except requests.RequestException as e:
+        raise UpstreamError(str(e)) from e
+
+
+def record_upstream(kind, model, started, status=None, error=None, detail=None):
+    """Count one upstream call by model and status ("error" when it failed before a response) and log it.
+
+    Failures and non-200 answers are always logged, successes are sampled. `detail` is
+    the start of an error body; response bodies are never logged otherwise.
+    """
+    elapsed = time.perf_counter() - started
+    UPSTREAM_SECONDS.observe(elapsed, kind=kind, model=model)
+    UPSTREAM_REQUESTS.inc(kind=kind, model=model, status=status or 'error')
+    fields = {'kind': kind, 'model': model, 'status': status, 'elapsed_ms': round(elapsed * 1000, 1)}
+    if error is not None:
+        log_event('upstream_failed', logging.WARNING, error=API_KEY_PARAM.sub('key=...', repr(error)), **fields)
+    elif status != 200:
+        log_event('upstream_status', logging.WARNING, detail=detail, **fields)
+    else:
+        log_event('upstream_ok', sampled=True, **fields)
+
+
+class GeminiClient:
+    """Shared upstream client that keeps connections to the Gemini API alive between chats.
+
+    Calls are retried and guarded by a circuit breaker as set out in upstream_policy.py.
+    """
+
+    def __init__(self, api_url, api_key, pool_size=DEFAULT_POOL_SIZE,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT, coalesce=True,
+                 retry=None, breaker=None):
+        self.api_url = api_url
+        self.api_key = api_key
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.coalesce = coalesce
+        self.retry = retry or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        self.inflight = SingleFlight()
+        self._session = None
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    @classmethod
+    def from_config(cls, config, api_url, api_key):
+        return cls(
+            api_url,
+            api_key,
+            pool_size=config.get('GEMINI_POOL_SIZE', DEFAULT_POOL_SIZE),
+            connect_timeout=config.get('GEMINI_CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT),
+            read_timeout=config.get('GEMINI_READ_TIMEOUT', DEFAULT_READ_TIMEOUT),
+            coalesce=config.get('GEMINI_COALESCE', True),
+            retry=RetryPolicy.from_config(config),
+            breaker=CircuitBreaker.from_config(config),
+        )
+
+    @property
+    def model(self):
+        return model_name(self.api_url)
+
+    @property
+    def session(self):
+        # One pool per process: a forked worker must not reuse its parent's sockets
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    self._session = self._build_session()
+                    self._executor = None
+                    self._pid = os.getpid()
+        return self._session
+
+    @property
+    def executor(self):
+        # Threads for hedged requests, started on first use in each process. Reading self.session
+        # is what notices a fork: it drops the parent's executor along with its sockets
+        self.session
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.pool_size, thread_name_prefix='gemini-hedge')
+        return self._executor
+
+    def _build_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=True)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({'Content-Type': 'application/json'})
+        return session
+
+    def generate_content(self, payload):
+        """POST a generateContent payload and return the raw upstream response.
+
+        Identical payloads already in flight share that call's response instead of sending their own.
+        """
+        if not self.coalesce:
+            return self._post(payload)
+        key = hashlib.sha256(f"{self.api_url}\0{json.dumps(payload, sort_keys=True)}".encode()).hexdigest()
+        return self.inflight.do(key, lambda: self._post(payload))
+
+    def _post(self, payload):
+        return self._call('generate', self.api_url, {'key': self.api_key}, payload)
+
+    @property
+    def stream_url(self):
+        return self.api_url.replace(':generateContent', ':streamGenerateContent')
+
+    def stream_generate_content(self, payload):
+        """POST to streamGenerateContent and return the open upstream SSE response.
+
+        Only opening the stream is retried: once chunks flow, a failure ends the chat.
+        """
+        return self._call('stream', self.stream_url, {'key': self.api_key, 'alt': 'sse'}, payload, stream=True)
+
+    def _call(self, kind, url, params, payload, stream=False):
+        """POST through the breaker, retrying within the deadline; returns the last response or raises UpstreamError."""
+        deadline = time.monotonic() + self.retry.deadline
+        attempt = 0
+        while True:
+            retry_after = self.breaker.check()
+            if retry_after is not None:
+                raise CircuitOpenError(retry_after)
+            attempt += 1
+            # No single attempt may outlive the call's deadline
+            timeout = (self.timeout[0], max(0.1, min(self.timeout[1], deadline - time.monotonic())))
+            response = error = None
+            try:
+                if self.retry.hedge_after is not None and not stream:
+                    response = self._hedged(kind, url, params, payload, timeout)
+                else:
+                    response = self._attempt(kind, url, params, payload, timeout, stream)
+            except UpstreamError as e:
+                error = e
+
+            if error is None and response.status_code not in RETRY_STATUSES:
+                self.breaker.record_success()
+                return response
+            self.breaker.record_failure()
+
+            retry_after = parse_retry_after(response.headers.get('Retry-After')) if response is not None else None
+            delay = self.retry.next_delay(attempt, deadline, retry_after)
+            if delay is None:
+                if error is not None:
+                    raise error
+                return response
+            if response is not None:
+                response.close()
+            UPSTREAM_RETRIES.inc(kind=kind)
+            time.sleep(delay)
+
+    def _attempt(self, kind, url, params, payload, timeout, stream=False):
+        started = time.perf_counter()
+        try:
+            with _upstream_errors():
+                response = self.session.post(url, params=params, json=payload, timeout=timeout, stream=stream)
+        except UpstreamError as e:
+            record_upstream(kind, self.model, started, error=e)
+            raise
+        detail = response.text[:ERROR_DETAIL_LENGTH] if response.status_code != 200 and not stream else None
+        record_upstream(kind, self.model, started, response.status_code, detail=detail)
+        return response
+
+    def _hedged(self, kind, url, params, payload, timeout):
+        """One attempt, plus an identical one if the first is still out after hedge_after; the first good answer wins."""
+        attempts = {self.executor.submit(self._attempt, kind, url, params, payload, timeout)}
+        if not wait(attempts, timeout=self.retry.hedge_after).done:
+            UPSTREAM_HEDGES.inc(kind=kind)
+            attempts.add(self.executor.submit(self._attempt, kind, url, params, payload, timeout))
+
+        # The losing request is left to finish on its own; its connection goes back to the pool
+        pending, last = attempts, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for last in done:
+                if last.exception() is None and last.result().status_code not in RETRY_STATUSES:
+                    return last.result()
+        return last.result()
+
+    @staticmethod
+    def iter_stream_text(response):
+        """Yield the text of each candidate chunk from an upstream SSE response."""
+        try:
+            with _upstream_errors():
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith('data:'):
+                        continue
+                    chunk = json.loads(line[len('data:'):].strip())
+                    text = extract_text(chunk, default='')
+                    if text:
+                        yield text
+        finally:
+            response.close()
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                if self._session is not None:
+                    self._session.close()
+            self._session = None
+            self._executor = None
+            self._pid = None
+
+
+class AsyncGeminiClient:
+    """asyncio counterpart of GeminiClient for the ASGI serving mode (needs aiohttp)."""
+
+    def __init__(self, api_url, api_key, pool_size=DEFAULT_ASYNC_POOL_SIZE,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT, retry=None, breaker=None):
+        self.api_url = api_url
+        self.api_key = api_key
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retry = retry or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        self._session = None
+
+    @classmethod
+    def from_config(cls, config, api_url, api_key, breaker=None):
+        """`breaker` lets the ASGI mode share the Flask client's breaker, so both see the same upstream health."""
+        return cls(
+            api_url,
+            api_key,
+            pool_size=config.get('GEMINI_ASYNC_POOL_SIZE', DEFAULT_ASYNC_POOL_SIZE),
+            connect_timeout=config.get('GEMINI_CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT),
+            read_timeout=config.get('GEMINI_READ_TIMEOUT', DEFAULT_READ_TIMEOUT),
+            retry=RetryPolicy.from_config(config),
+            breaker=breaker or CircuitBreaker.from_config(config),
+        )
+
+    @property
+    def model(self):
+        return model_name(self.api_url)
+
+    @property
+    def session(self):
+        # Created on first use so it binds to the server's running event loop
+        if self._session is None:
+            import aiohttp
+
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout),
+            )
+        return self._session
+
+    async def generate_content(self, payload):
+        """POST a generateContent payload and return (status code, decoded JSON body or None).
+
+        Retried like GeminiClient calls; raises UpstreamError when no response came back.
+        """
+        deadline = time.monotonic() + self.retry.deadline
+        attempt = 0
+        while True:
+            retry_after = self.breaker.check()
+            if retry_after is not None:
+                raise CircuitOpenError(retry_after)
+            attempt += 1
+            status = body = error = retry_after = None
+            try:
+                if self.retry.hedge_after is not None:
+                    status, body, retry_after = await self._hedged(payload, deadline)
+                else:
+                    status, body, retry_after = await self._attempt(payload, deadline)
+            except UpstreamError as e:
+                error = e
+
+            if error is None and status not in RETRY_STATUSES:
+                self.breaker.record_success()
+                return status, body
+            self.breaker.record_failure()
+
+            delay = self.retry.next_delay(attempt, deadline, retry_after)
+            if delay is None:
+                if error is not None:
+                    raise error
+                return status, body
+            UPSTREAM_RETRIES.inc(kind='async')
+            await asyncio.sleep(delay)
+
+    async def _attempt(self, payload, deadline):
+        """One POST; returns (status, body or None, Retry-After seconds or None)."""
+        import aiohttp
+
+        timeout = aiohttp.ClientTimeout(total=max(0.1, deadline - time.monotonic()),
+                                        sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+        started = time.perf_counter()
+        try:
+            async with self.session.post(self.api_url, params={'key': self.api_key}, json=payload,
+                                         timeout=timeout) as response:
+                if response.status != 200:
+                    detail = (await response.text())[:ERROR_DETAIL_LENGTH]
+                    record_upstream('async', self.model, started, response.status, detail=detail)
+                    return response.status, None, parse_retry_after(response.headers.get('Retry-After'))
+                body = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            record_upstream('async', self.model, started, error=e)
+            raise UpstreamError(repr(e)) from e
+        record_upstream('async', self.model, started, response.status)
+        return response.status, body, None
+
+    async def _hedged(self, payload, deadline):
+        """Like GeminiClient._hedged; the losing request is cancelled."""
+        attempts = {asyncio.ensure_future(self._attempt(payload, deadline))}
+        done, _ = await asyncio.wait(attempts, timeout=self.retry.hedge_after)
+        if not done:
+            UPSTREAM_HEDGES.inc(kind='async')
+            attempts.add(asyncio.ensure_future(self._attempt(payload, deadline)))
+
+        pending, last = attempts, None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for last in done:
+                    if last.exception() is None and last.result()[0] not in RETRY_STATUSES:
+                        return last.result()
+            return last.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+def model_name(api_url):
+    """Model id from a .../models/<model>:generateContent URL."""
+    return api_url.rsplit('/models/', 1)[-1].split(':', 1)[0]
+
+
+def extract_text(response_data, default='No response'):
+    """Pull the first candidate's text out of a generateContent response body.
+
+    Missing fields give `default`; a body of any other shape (e.g. no candidates) raises ValueError.
+    """
+    try:
+        return response_data.get('candidates', [{}])[0].get('content', {}).get('parts', [{}])[0].get('text', default)
+    except (AttributeError, IndexError, TypeError) as e:
+        raise ValueError(f"unexpected generateContent response: {e!r}") from e
@@ -0,0 +1,80 @@
+"""Conditional GETs and response compression for the history reads.
+
+History only changes when a chat is saved, so reads are tagged with a version
+instead of a hash of the body: User.history_version (bumped with every saved chat)
+for whole-history reads, Conversation.message_count for one conversation. A poll
+with a matching If-None-Match gets a 304 after one primary-key lookup, without
+loading or serializing any chats. ETags are weak because the same version may be
+sent with different Content-Encodings.
+"""
+import gzip
+import hashlib
+
+from flask import Response
+from sqlalchemy import update
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always offered
+    brotli = None
+
+# Browsers may keep the response but must revalidate it on every use
+CACHE_CONTROL = 'private, no-cache'
+
+COMPRESSIBLE_TYPES = {'application/json', 'text/html', 'text/plain', 'text/css', 'application/javascript'}
+MIN_COMPRESS_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def history_version_update(User, user_ids):
+    """UPDATE that marks these users' histories as changed; runs in the transaction saving the chats."""
+    return (
+        update(User)
+        .where(User.id.in_(user_ids))
+        .values(history_version=User.history_version + 1)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def version_etag(full_path, *version):
+    """ETag for `version` of the resource at `full_path` (query string included, so each page differs)."""
+    return hashlib.sha256(repr((full_path,) + version).encode()).hexdigest()[:32]
+
+
+def not_modified(request, etag):
+    """A 304 response if the client already has `etag`, else None."""
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    return tag(Response(status=304), etag)
+
+
+def tag(response, etag):
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    return response
+
+
+def compress_response(request, response):
+    """after_request hook: compress buffered text responses with brotli or gzip, as the client accepts."""
+    if (response.is_streamed or response.direct_passthrough
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    offered = ['br', 'gzip'] if brotli else ['gzip']
+    encoding = request.accept_encodings.best_match(offered)
+    if encoding is None:
+        return response
+
+    data = response.get_data()
+    if len(data) < MIN_COMPRESS_SIZE:
+        return response
+    if encoding == 'br':
+        response.set_data(brotli.compress(data, quality=BROTLI_QUALITY))
+    else:
+        response.set_data(gzip.compress(data, compresslevel=GZIP_LEVEL))
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,46 @@
+"""Structured logging: one JSON object per line on stderr.
+
+Failures are always logged. Routine events that happen on every chat (a
+successful upstream call, say) are logged for a LOG_SAMPLE_RATE fraction of
+occurrences, which keeps a representative trace without paying for a write per
+request. Nothing logs request or response bodies.
+"""
+import json
+import logging
+import random
+import sys
+
+DEFAULT_LEVEL = 'INFO'
+DEFAULT_SAMPLE_RATE = 0.01
+
+logger = logging.getLogger('chatbot')
+_sample_rate = DEFAULT_SAMPLE_RATE
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'ts': round(record.created, 3), 'level': record.levelname.lower(), 'event': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure(config):
+    """Set the level and sample rate from LOG_LEVEL and LOG_SAMPLE_RATE; installs the JSON handler once."""
+    global _sample_rate
+    _sample_rate = config.get('LOG_SAMPLE_RATE', DEFAULT_SAMPLE_RATE)
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(JSONFormatter())
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(config.get('LOG_LEVEL', DEFAULT_LEVEL))
+
+
+def log_event(event, level=logging.INFO, sampled=False, **fields):
+    """Log `event` with `fields`; sampled events are only kept for a LOG_SAMPLE_RATE fraction of calls."""
+    if sampled and random.random() >= _sample_rate:
+        return
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={'fields': fields})
@@ -0,0 +1,287 @@
+"""Prometheus-style metrics for the chat pipeline, served at /metrics in the text format.
+
+Counters and histograms are kept per process: with several workers, each one
+reports its own and Prometheus sums them by instance. Component stats (response
+cache, request coalescing, write-behind queue, auth cache, chat compaction,
+related-conversations index, batch jobs, rate limiter, DB pool) are read when
+/metrics is scraped, so they cost nothing per request.
+"""
+import hmac
+import threading
+import time
+from bisect import bisect_left
+
+from flask import Response, current_app, g, request
+
+# Upper bounds in seconds, from a cache hit to a slow upstream answer
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def render_metric(name, kind, help, samples):
+    """Text-format block for one metric; `samples` are (labels dict, value) pairs."""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for labels, value in samples:
+        lines.append(f"{name}{_labels(labels.keys(), labels.values())} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            samples = [(dict(zip(self.labelnames, key)), value) for key, value in sorted(self._values.items())]
+        return render_metric(self.name, 'counter', self.help, samples)
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [per-bucket counts (last is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((key, list(counts), total) for key, (counts, total) in self._series.items())
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help, labelnames=()):
+        metric = Counter(name, help, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        return ''.join(metric.render() for metric in self._metrics)
+
+
+REGISTRY = Registry()
+
+CHAT_STAGE_SECONDS = REGISTRY.histogram(
+    'chat_stage_seconds', "Time spent in each stage of a chat request", ('endpoint', 'stage'))
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    'http_request_duration_seconds', "Time to produce each response (streamed bodies not included)",
+    ('endpoint', 'method', 'status'))
+UPSTREAM_REQUESTS = REGISTRY.counter(
+    'gemini_requests_total', "Gemini API calls by HTTP status, or \"error\" when none came back",
+    ('kind', 'model', 'status'))
+UPSTREAM_RETRIES = REGISTRY.counter(
+    'gemini_retries_total', "Gemini API attempts retried after a failure or a 429/5xx answer", ('kind',))
+UPSTREAM_HEDGES = REGISTRY.counter(
+    'gemini_hedged_total', "Second, identical Gemini requests sent because the first was slow", ('kind',))
+UPSTREAM_SECONDS = REGISTRY.histogram(
+    'gemini_request_seconds', "Gemini API call latency (until the headers arrive, for streams)", ('kind', 'model'))
+MODEL_ROUTED = REGISTRY.counter(
+    'gemini_routed_total', "Upstream calls answered per model and routing tier (a different model means failover)",
+    ('model', 'tier'))
+MODEL_FAILURES = REGISTRY.counter(
+    'gemini_model_failures_total', "Calls to a model that failed or got 429/5xx, moving on to the next model if any",
+    ('model',))
+PASSWORD_QUEUE_SECONDS = REGISTRY.histogram(
+    'password_hash_queue_seconds', "Time a password hash or check waited for a hashing worker", ('op',))
+PASSWORD_HASH_SECONDS = REGISTRY.histogram(
+    'password_hash_seconds', "Time a hashing worker spent on a password hash or check", ('op',))
+PASSWORD_REJECTED = REGISTRY.counter(
+    'password_hash_rejected_total', "Logins and signups turned away because the hashing queue was full", ('op',))
+PASSWORD_UPGRADES = REGISTRY.counter(
+    'password_hash_upgrades_total', "Stored password hashes replaced at login, by the kind they replaced", ('kind',))
+CHAT_RESTORES = REGISTRY.counter(
+    'chat_archive_restores_total', "Archived conversations moved back to chat_history when opened or continued")
+RELATED_QUERY_SECONDS = REGISTRY.histogram(
+    'related_query_seconds', "Time to score a user's messages for related conversations, not counting indexing")
+BATCH_PROMPTS = REGISTRY.counter(
+    'chat_batch_prompts_total', "Batch prompts by outcome: answered upstream, cached or failed", ('outcome',))
+
+
+class StageTimer:
+    """Times consecutive stages of one request: each lap() records the time since the previous one."""
+
+    def __init__(self, endpoint, histogram=CHAT_STAGE_SECONDS):
+        self.endpoint = endpoint
+        self.histogram = histogram
+        self.mark = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.histogram.observe(now - self.mark, endpoint=self.endpoint, stage=stage)
+        self.mark = now
+
+
+def component_metrics(extensions, engine):
+    """Text-format stats of the app's shared components, read at scrape time."""
+    blocks = []
+
+    cache = extensions['response_cache'].stats()
+    blocks.append(render_metric('chat_cache_hits_total', 'counter', "Response cache hits", [({}, cache['hits'])]))
+    blocks.append(render_metric('chat_cache_misses_total', 'counter', "Response cache misses", [({}, cache['misses'])]))
+    blocks.append(render_metric('chat_cache_hit_ratio', 'gauge', "Response cache hits per lookup", [({}, cache['hit_rate'])]))
+    for key in ('entries', 'bytes'):
+        if cache.get(key) is not None:
+            blocks.append(render_metric(f'chat_cache_{key}', 'gauge', f"Response cache {key}", [({}, cache[key])]))
+
+    # One client per model, each with its own coalescing and circuit breaker (see model_router.py)
+    models = extensions['gemini'].stats()
+    for name, key, kind, help in (
+        ('gemini_coalesced_total', 'coalesced', 'counter', "Chats that shared an identical in-flight upstream call"),
+        ('gemini_in_flight', 'in_flight', 'gauge', "Distinct upstream calls in flight"),
+    ):
+        blocks.append(render_metric(name, kind, help, [({'model': model}, stats['coalescing'][key])
+                                                       for model, stats in models.items()]))
+    blocks.append(render_metric('gemini_circuit_state', 'gauge', "Circuit breaker state: 0 closed, 1 half-open, 2 open",
+                                [({'model': model}, ('closed', 'half_open', 'open').index(stats['circuit']['state']))
+                                 for model, stats in models.items()]))
+    for name, key, help in (
+        ('gemini_circuit_trips_total', 'trips', "Times the circuit breaker opened"),
+        ('gemini_circuit_rejections_total', 'rejected', "Calls refused while the circuit was open"),
+    ):
+        blocks.append(render_metric(name, 'counter', help, [({'model': model}, stats['circuit'][key])
+                                                            for model, stats in models.items()]))
+    blocks.append(render_metric('gemini_model_error_ratio', 'gauge', "Failed share of each model's calls in the routing window",
+                                [({'model': model}, stats['error_rate']) for model, stats in models.items()]))
+    blocks.append(render_metric('gemini_model_p95_seconds', 'gauge', "p95 latency of each model's calls in the routing window",
+                                [({'model': model}, stats['p95']) for model, stats in models.items()
+                                 if stats['p95'] is not None]))
+
+    writes = extensions['chat_writes'].stats()
+    blocks.append(render_metric('chat_write_queue_depth', 'gauge', "Chats waiting to be written", [({}, writes['queued'])]))
+    for name, key, help in (
+        ('chat_writes_total', 'written', "Chats saved by the write-behind worker"),
+        ('chat_write_batches_total', 'batches', "Write-behind transactions committed"),
+        ('chat_write_overflows_total', 'overflowed', "Chats saved inline because the write queue was full"),
+        ('chat_write_failures_total', 'failed', "Chats the write-behind worker could not save"),
+    ):
+        blocks.append(render_metric(name, 'counter', help, [({}, writes[key])]))
+
+    auth = extensions['auth_cache'].stats()
+    for name, key, help in (
+        ('auth_cache_hits_total', 'hits', "Requests that found the user in the auth cache"),
+        ('auth_cache_misses_total', 'misses', "Requests that read the user row"),
+        ('auth_cache_quota_rejections_total', 'quota_rejections', "Chats refused as out of tokens without a DB update"),
+    ):
+        blocks.append(render_metric(name, 'counter', help, [({}, auth[key])]))
+    blocks.append(render_metric('auth_cache_entries', 'gauge', "Users in the auth cache", [({}, auth['entries'])]))
+
+    hasher = extensions['password_hasher'].stats()
+    blocks.append(render_metric('password_hash_pending', 'gauge', "Password hashes and checks queued or running",
+                                [({}, hasher['pending'])]))
+
+    compaction = extensions['chat_compactor'].stats()
+    for name, key, help in (
+        ('chat_compacted_rows_total', 'compressed', "Stored answers compressed by compaction"),
+        ('chat_compacted_bytes_saved_total', 'bytes_saved', "Bytes saved by compressing stored answers"),
+        ('chat_archived_conversations_total', 'archived', "Conversations moved to chat_archive"),
+        ('chat_archived_chats_total', 'archived_chats', "Chats moved to chat_archive"),
+        ('chat_compaction_failures_total', 'failed', "Background compaction passes that failed"),
+    ):
+        blocks.append(render_metric(name, 'counter', help, [({}, compaction[key])]))
+
+    related = extensions['related_index'].stats()
+    blocks.append(render_metric('related_index_users', 'gauge', "Users with a related-conversations index in memory",
+                                [({}, related['users'])]))
+    blocks.append(render_metric('related_index_messages', 'gauge', "Messages in the related-conversations indexes",
+                                [({}, related['messages'])]))
+    blocks.append(render_metric('related_indexed_total', 'counter', "Messages vectorized for related-conversations indexes",
+                                [({}, related['indexed'])]))
+
+    batches = extensions['batch_jobs'].stats()
+    blocks.append(render_metric('chat_batch_jobs_running', 'gauge', "Batch jobs running in this process",
+                                [({}, batches['running'])]))
+    blocks.append(render_metric('chat_batch_prompts_pending', 'gauge', "Batch prompts not answered yet",
+                                [({}, batches['pending'])]))
+
+    limiter = extensions['rate_limiter']
+    blocks.append(render_metric('rate_limit_rejections_total', 'counter', "Chat requests turned away by the rate limits",
+                                [({}, limiter.rejected)]))
+
+    # QueuePool only; SQLite in-memory databases use a single connection
+    pool = engine.pool
+    if hasattr(pool, 'checkedout'):
+        for name, value, help in (
+            ('db_pool_size', pool.size(), "Connections the pool keeps open"),
+            ('db_pool_checked_out', pool.checkedout(), "Connections in use"),
+            ('db_pool_overflow', pool.overflow(), "Connections open beyond the pool size (negative while it fills)"),
+        ):
+            blocks.append(render_metric(name, 'gauge', help, [({}, value)]))
+    return ''.join(blocks)
+
+
+def token_authorized(request):
+    """Whether METRICS_TOKEN is set and `request` carries it as `Authorization: Bearer <METRICS_TOKEN>`."""
+    token = current_app.config.get('METRICS_TOKEN')
+    return bool(token) and hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}")
+
+
+def metrics_view():
+    if current_app.config.get('METRICS_TOKEN') and not token_authorized(request):
+        return Response("Unauthorized\n", status=401, mimetype='text/plain')
+    body = REGISTRY.render() + component_metrics(current_app.extensions, current_app.extensions['sqlalchemy'].engine)
+    return Response(body, content_type=CONTENT_TYPE)
+
+
+def init_app(app):
+    """Time every request and serve /metrics (behind `Authorization: Bearer <METRICS_TOKEN>` when that is set)."""
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('request_started', None)
+        if started is not None:
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=request.endpoint or 'unmatched',
+                                         method=request.method, status=response.status_code)
+        return response
+
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -0,0 +1,137 @@
+"""Schema changes that db.create_all() cannot apply to an existing database.
+
+upgrade() runs as part of `flask --app app init-db`, after db.create_all(); it
+can also be run by hand against DATABASE_URL with `python migrations.py`. Applied versions are recorded in
+the schema_migrations table, so every step runs once per database.
+"""
+import datetime
+import os
+
+from sqlalchemy import create_engine, inspect, text
+
+from search import create_search_index
+
+
+def add_column(table, column, ddl):
+    """Step that adds a column unless db.create_all() already created the table with it."""
+    def step(conn):
+        if column not in {c['name'] for c in inspect(conn).get_columns(table)}:
+            # Quoted, since "user" is a reserved word on server databases
+            quoted = conn.dialect.identifier_preparer.quote(table)
+            conn.execute(text(f"ALTER TABLE {quoted} ADD COLUMN {column} {ddl}"))
+    return step
+
+
+def backfill_conversations(conn):
+    """Build one conversation summary per existing conversation_id in chat_history."""
+    # Databases app1.py created have no chat_history.title until 0006; their titles come from the first message
+    columns = {column['name'] for column in inspect(conn).get_columns('chat_history')}
+    title = "COALESCE(c.title, c.message)" if 'title' in columns else "c.message"
+    conn.execute(text(f"""
+        INSERT INTO conversation (id, user_id, title, created_at, updated_at, message_count, last_message_preview)
+        SELECT h.conversation_id, MIN(h.user_id),
+               (SELECT SUBSTR({title}, 1, 50) FROM chat_history c
+                 WHERE c.conversation_id = h.conversation_id ORDER BY c.timestamp, c.id LIMIT 1),
+               MIN(h.timestamp), MAX(h.timestamp), COUNT(*),
+               (SELECT SUBSTR(c.message, 1, 100) FROM chat_history c
+                 WHERE c.conversation_id = h.conversation_id ORDER BY c.timestamp DESC, c.id DESC LIMIT 1)
+          FROM chat_history h
+         WHERE h.conversation_id NOT IN (SELECT id FROM conversation)
+         GROUP BY h.conversation_id
+    """))
+
+
+def backfill_chat_titles(conn):
+    """Give untitled chats (saved by app1.py) their conversation's title."""
+    conn.execute(text("""
+        UPDATE chat_history SET title = COALESCE(
+            (SELECT c.title FROM conversation c WHERE c.id = chat_history.conversation_id), '')
+         WHERE title = ''
+    """))
+
+
+def binary_responses(conn):
+    """Let chat_history.response hold compressed bytes; SQLite columns already take either."""
+    response = next(c for c in inspect(conn).get_columns('chat_history') if c['name'] == 'response')
+    if response['type'].python_type is bytes:
+        return
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text(
+            "ALTER TABLE chat_history ALTER COLUMN response TYPE BYTEA USING convert_to(response, 'UTF8')"
+        ))
+    elif conn.dialect.name == 'mysql':
+        conn.execute(text("ALTER TABLE chat_history MODIFY response LONGBLOB NOT NULL"))
+
+
+# (version, steps) in the order they must run; a step is SQL text or a callable taking the connection
+MIGRATIONS = [
+    ('0001_chat_history_indexes', [
+        "CREATE INDEX IF NOT EXISTS ix_chat_history_user_timestamp ON chat_history (user_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_chat_history_user_conversation ON chat_history (user_id, conversation_id)",
+    ]),
+    # The conversation table itself comes from db.create_all(), which runs first
+    ('0002_backfill_conversations', [backfill_conversations]),
+    ('0003_conversation_summary', [
+        add_column('conversation', 'summary', "TEXT"),
+        add_column('conversation', 'summary_turns', "INTEGER NOT NULL DEFAULT 0"),
+    ]),
+    ('0004_chat_history_fts', [create_search_index]),
+    ('0005_user_history_version', [
+        add_column('user', 'history_version', "INTEGER NOT NULL DEFAULT 0"),
+    ]),
+    # The apps used to define their own models: app1.py's chats had no title, app2.py's users no refill time
+    ('0006_shared_models', [
+        add_column('chat_history', 'title', "VARCHAR(50) NOT NULL DEFAULT ''"),
+        backfill_chat_titles,
+        add_column('user', 'last_token_update', "TIMESTAMP"),
+    ]),
+    ('0007_chat_history_model', [
+        add_column('chat_history', 'model', "VARCHAR(64)"),
+    ]),
+    # The chat_archive table comes from db.create_all(); see chat_storage.py
+    ('0008_tiered_chat_storage', [
+        binary_responses,
+        add_column('conversation', 'archived_at', "TIMESTAMP"),
+    ]),
+    ('0009_chat_history_user_id', [
+        "CREATE INDEX IF NOT EXISTS ix_chat_history_user_id ON chat_history (user_id, id)",
+    ]),
+    # 0004 only indexed SQLite; PostgreSQL gets its tsvector table here (SQLite finds nothing left to index)
+    ('0010_chat_history_tsvector', [create_search_index]),
+]
+
+
+def applied_versions(conn):
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations (version VARCHAR(100) PRIMARY KEY, applied_at TIMESTAMP)"
+    ))
+    return {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))}
+
+
+def upgrade(engine):
+    """Apply every pending migration, each in its own transaction. Returns the versions applied."""
+    with engine.begin() as conn:
+        done = applied_versions(conn)
+
+    applied = []
+    for version, steps in MIGRATIONS:
+        if version in done:
+            continue
+        with engine.begin() as conn:
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(text(step))
+            conn.execute(
+                text("INSERT INTO schema_migrations (version, applied_at) VALUES (:version, :applied_at)"),
+                {'version': version, 'applied_at': datetime.datetime.utcnow()},
+            )
+        applied.append(version)
+    return applied
+
+
+if __name__ == '__main__':
+    url = os.environ.get('DATABASE_URL', 'sqlite:///instance/users.db')
+    for version in upgrade(create_engine(url)):
+        print(f"Applied {version}")
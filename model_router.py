@@ -0,0 +1,199 @@
+"""Per-request choice between Gemini models, with failover.
+
+Every model gets its own client, and so its own retries, circuit breaker and
+coalescing. The router only decides which models to ask, and in what order:
+
+- subscribers go to GEMINI_PREMIUM_MODEL, other users' short prompts to
+  GEMINI_FAST_MODEL, and everything else (or any tier without a model set) to
+  the primary model named in GEMINI_API_URL;
+- the primary and then GEMINI_FALLBACK_MODELS follow as failovers;
+- a model that looks unhealthy over the last ROUTER_WINDOW seconds (circuit
+  open, too many failures, or p95 latency above ROUTER_SLOW_SECONDS) moves to
+  the back. Traffic thus leaves a slow or rate-limited model before its calls
+  fail, and comes back once its bad samples age out of the window.
+
+A call moves on to the next model when it raises UpstreamError or answers 429/5xx.
+"""
+import threading
+import time
+from collections import deque
+
+from context import estimate_tokens
+from gemini_client import AsyncGeminiClient, CircuitOpenError, GeminiClient, UpstreamError, model_name
+from metrics import MODEL_FAILURES, MODEL_ROUTED
+from upstream_policy import RETRY_STATUSES
+
+# Defaults used when an app does not override them in its config
+DEFAULT_LONG_PROMPT_TOKENS = 1000
+DEFAULT_SLOW_SECONDS = 10
+DEFAULT_MAX_ERROR_RATE = 0.25
+DEFAULT_WINDOW = 60
+# Calls in the window before a model's error rate or p95 is trusted
+MIN_SAMPLES = 10
+
+
+def model_url(api_url, model):
+    """`api_url` with its model replaced by `model`."""
+    prefix, _, rest = api_url.partition('/models/')
+    return f"{prefix}/models/{model}:{rest.split(':', 1)[1]}"
+
+
+def payload_text(payload):
+    return ' '.join(part.get('text', '') for content in payload.get('contents', []) for part in content.get('parts', []))
+
+
+class ModelHealth:
+    """Outcomes and latencies of one model's recent calls."""
+
+    def __init__(self, window=DEFAULT_WINDOW, max_samples=500):
+        self.window = window
+        self._samples = deque(maxlen=max_samples)  # (time, seconds, ok)
+        self._lock = threading.Lock()
+
+    def record(self, seconds, ok):
+        with self._lock:
+            self._samples.append((time.monotonic(), seconds, ok))
+
+    def stats(self):
+        cutoff = time.monotonic() - self.window
+        with self._lock:
+            while self._samples and self._samples[0][0] < cutoff:
+                self._samples.popleft()
+            samples = list(self._samples)
+        latencies = sorted(seconds for _, seconds, ok in samples if ok)
+        return {
+            "calls": len(samples),
+            "error_rate": sum(1 for *_, ok in samples if not ok) / len(samples) if samples else 0.0,
+            "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else None,
+        }
+
+
+class ModelRouter:
+    def __init__(self, clients, primary, fast=None, premium=None, fallbacks=(), async_clients=None,
+                 long_prompt_tokens=DEFAULT_LONG_PROMPT_TOKENS, slow_seconds=DEFAULT_SLOW_SECONDS,
+                 max_error_rate=DEFAULT_MAX_ERROR_RATE, window=DEFAULT_WINDOW):
+        self.clients = clients  # model -> GeminiClient
+        self.async_clients = async_clients or {}  # model -> AsyncGeminiClient, for the ASGI mode
+        self.primary = primary
+        self.fast = fast
+        self.premium = premium
+        self.fallbacks = tuple(fallbacks)
+        self.long_prompt_tokens = long_prompt_tokens
+        self.slow_seconds = slow_seconds
+        self.max_error_rate = max_error_rate
+        self.health = {model: ModelHealth(window) for model in clients}
+
+    @classmethod
+    def from_config(cls, config):
+        api_url, api_key = config['GEMINI_API_URL'], config['GEMINI_API_KEY']
+        primary = model_name(api_url)
+        fast, premium = config.get('GEMINI_FAST_MODEL'), config.get('GEMINI_PREMIUM_MODEL')
+        fallbacks = tuple(config.get('GEMINI_FALLBACK_MODELS', ()))
+        models = [model for model in dict.fromkeys((primary, fast, premium) + fallbacks) if model]
+        clients = {model: GeminiClient.from_config(config, model_url(api_url, model), api_key) for model in models}
+        # The async clients share the sync ones' breakers, so both serving modes see the same upstream health
+        async_clients = {
+            model: AsyncGeminiClient.from_config(config, model_url(api_url, model), api_key, breaker=clients[model].breaker)
+            for model in models
+        }
+        return cls(
+            clients,
+            primary,
+            fast=fast,
+            premium=premium,
+            fallbacks=fallbacks,
+            async_clients=async_clients,
+            long_prompt_tokens=config.get('ROUTER_LONG_PROMPT_TOKENS', DEFAULT_LONG_PROMPT_TOKENS),
+            slow_seconds=config.get('ROUTER_SLOW_SECONDS', DEFAULT_SLOW_SECONDS),
+            max_error_rate=config.get('ROUTER_MAX_ERROR_RATE', DEFAULT_MAX_ERROR_RATE),
+            window=config.get('ROUTER_WINDOW', DEFAULT_WINDOW),
+        )
+
+    def choose(self, prompt, subscribed=False):
+        """(model, tier) a prompt goes to first, before health is considered."""
+        if subscribed and self.premium:
+            return self.premium, 'premium'
+        if not subscribed and self.fast and estimate_tokens(prompt) <= self.long_prompt_tokens:
+            return self.fast, 'fast'
+        return self.primary, 'primary'
+
+    def healthy(self, model):
+        if not self.clients[model].breaker.available:
+            return False
+        stats = self.health[model].stats()
+        if stats['calls'] < MIN_SAMPLES:
+            return True
+        return stats['error_rate'] <= self.max_error_rate and stats['p95'] <= self.slow_seconds
+
+    def candidates(self, payload, subscribed=False):
+        """(models to try in order, tier) for a request."""
+        preferred, tier = self.choose(payload_text(payload), subscribed)
+        order = list(dict.fromkeys((preferred, self.primary) + self.fallbacks))
+        healthy = [model for model in order if self.healthy(model)]
+        return healthy + [model for model in order if model not in healthy], tier
+
+    def generate_content(self, payload, subscribed=False):
+        """(model, raw upstream response) from the first model that answers."""
+        return self._call('generate_content', payload, subscribed)
+
+    def stream_generate_content(self, payload, subscribed=False):
+        """(model, open upstream SSE response); only opening the stream fails over."""
+        return self._call('stream_generate_content', payload, subscribed)
+
+    iter_stream_text = staticmethod(GeminiClient.iter_stream_text)
+
+    def _call(self, method, payload, subscribed):
+        models, tier = self.candidates(payload, subscribed)
+        for model in models:
+            last = model == models[-1]
+            started = time.perf_counter()
+            try:
+                response = getattr(self.clients[model], method)(payload)
+            except UpstreamError as e:
+                self._failed(model, started, e)
+                if last:
+                    raise
+                continue
+            if response.status_code not in RETRY_STATUSES or last:
+                self._served(model, tier, started, response.status_code)
+                return model, response
+            self._failed(model, started)
+            response.close()
+
+    async def generate_content_async(self, payload, subscribed=False):
+        """(model, status code, decoded JSON body or None), using the async clients."""
+        models, tier = self.candidates(payload, subscribed)
+        for model in models:
+            last = model == models[-1]
+            started = time.perf_counter()
+            try:
+                status, body = await self.async_clients[model].generate_content(payload)
+            except UpstreamError as e:
+                self._failed(model, started, e)
+                if last:
+                    raise
+                continue
+            if status not in RETRY_STATUSES or last:
+                self._served(model, tier, started, status)
+                return model, status, body
+            self._failed(model, started)
+
+    def _served(self, model, tier, started, status):
+        self.health[model].record(time.perf_counter() - started, status not in RETRY_STATUSES)
+        MODEL_ROUTED.inc(model=model, tier=tier)
+
+    def _failed(self, model, started, error=None):
+        # A call the open breaker refused never reached upstream, so it says nothing new about the model
+        if not isinstance(error, CircuitOpenError):
+            self.health[model].record(time.perf_counter() - started, False)
+        MODEL_FAILURES.inc(model=model)
+
+    async def close_async(self):
+        for client in self.async_clients.values():
+            await client.close()
+
+    def stats(self):
+        return {
+            model: dict(self.health[model].stats(), circuit=client.breaker.stats(), coalescing=client.inflight.stats())
+            for model, client in self.clients.items()
+        }
@@ -0,0 +1,280 @@
+"""Database models shared by every entry point, and the chat save path."""
+import datetime
+import json
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import LargeBinary, bindparam, delete, insert, select, type_coerce, update
+from werkzeug.security import generate_password_hash
+
+from chat_storage import CompressedText, decode, encode, is_compressed, pack_chats, unpack_chats
+from conversations import new_summary, record_message
+from credentials import DEFAULT_METHOD, password_matches
+from http_cache import history_version_update
+from metrics import CHAT_RESTORES
+from migrations import upgrade
+from quota import refund_statement
+from search import index_chats, unindex_chats
+
+db = SQLAlchemy()
+
+
+def subscription_active(plan, expiry):
+    """Whether a user with this plan and expiry date is subscribed (and so not metered) today."""
+    if plan == 'unlimited':
+        return True
+    return bool(expiry and expiry >= datetime.date.today())
+
+
+# User model
+class User(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    email = db.Column(db.String(120), unique=True, nullable=False)
+    password = db.Column(db.String(200), nullable=False)  # Salted scrypt hash, or a legacy SHA-256 digest (see credentials.py)
+    subscription_plan = db.Column(db.String(50), nullable=True)  # e.g., "unlimited", "1 Month", "6 Months"
+    subscription_expiry = db.Column(db.Date, nullable=True)  # Expiry date for subscription
+    token_count = db.Column(db.Integer, default=5)  # 5 tokens for non-subscribed users
+    last_token_update = db.Column(db.DateTime, default=datetime.datetime.utcnow)  # Last daily refill (see quota.py)
+    history_version = db.Column(db.Integer, default=0, server_default='0', nullable=False)  # Bumped whenever a chat is saved
+
+    # Hash in the calling thread, for scripts; request handlers go through the app's PasswordHasher
+    def set_password(self, password):
+        self.password = generate_password_hash(password, DEFAULT_METHOD)
+
+    def check_password(self, password):
+        return password_matches(self.password, password)
+
+    def is_subscribed(self):
+        return subscription_active(self.subscription_plan, self.subscription_expiry)
+
+    def update_subscription(self, plan, months):
+        self.subscription_plan = plan
+        self.subscription_expiry = datetime.date.today() + datetime.timedelta(days=30 * months)
+        # Subscribers are not metered, so token_count is left as is (see quota.py)
+
+# Chat history model
+class ChatHistory(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    conversation_id = db.Column(db.String(100), nullable=False)
+    title = db.Column(db.String(50), nullable=False)
+    message = db.Column(db.String(500), nullable=False)
+    response = db.Column(CompressedText, nullable=False)  # Stored compressed (see chat_storage.py)
+    timestamp = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    model = db.Column(db.String(64), nullable=True)  # Gemini model that answered; empty for older chats
+
+    user = db.relationship('User', backref=db.backref('chats', lazy=True))
+
+    __table_args__ = (
+        db.Index('ix_chat_history_user_timestamp', 'user_id', 'timestamp'),
+        db.Index('ix_chat_history_user_conversation', 'user_id', 'conversation_id'),
+        db.Index('ix_chat_history_user_id', 'user_id', 'id'),  # a user's chats saved since a given one (related.py)
+    )
+
+# Per-conversation summary kept up to date as chats are saved, so listing conversations is one indexed query
+class Conversation(db.Model):
+    id = db.Column(db.String(100), primary_key=True)  # Same value as ChatHistory.conversation_id
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    title = db.Column(db.String(50), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    message_count = db.Column(db.Integer, default=0, nullable=False)
+    last_message_preview = db.Column(db.String(100), nullable=True)
+    summary = db.Column(db.Text, nullable=True)  # Running summary of turns too old to send in full
+    summary_turns = db.Column(db.Integer, default=0, server_default='0', nullable=False)  # How many of the oldest turns it covers
+    archived_at = db.Column(db.DateTime, nullable=True)  # Set while its chats are in chat_archive
+
+    __table_args__ = (
+        db.Index('ix_conversation_user_updated', 'user_id', 'updated_at'),
+    )
+
+# Chats of a conversation that went idle, moved out of chat_history as one compressed row (see chat_storage.py)
+class ChatArchive(db.Model):
+    conversation_id = db.Column(db.String(100), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    chat_count = db.Column(db.Integer, nullable=False)
+    first_timestamp = db.Column(db.DateTime, nullable=False)
+    last_timestamp = db.Column(db.DateTime, nullable=False)
+    archived_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    chats = db.Column(db.LargeBinary, nullable=False)  # pack_chats() payload
+
+    __table_args__ = (
+        db.Index('ix_chat_archive_user_first', 'user_id', 'first_timestamp'),
+    )
+
+# Prompts sent together to /api/chat/batch and answered in the background (see batch.py)
+class BatchJob(db.Model):
+    id = db.Column(db.String(36), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    status = db.Column(db.String(16), nullable=False, default='running')  # running, done or failed
+    prompt_count = db.Column(db.Integer, nullable=False)
+    failed_count = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    results = db.Column(CompressedText, nullable=True)  # JSON list with one entry per prompt, set when the job ends
+
+    __table_args__ = (
+        db.Index('ix_batch_job_user_created', 'user_id', 'created_at'),
+    )
+
+
+def init_db():
+    """Create missing tables and apply pending migrations (`flask --app app init-db`); needs an app context."""
+    db.create_all()
+    return upgrade(db.engine)
+
+
+def save_chats(chats):
+    """Write (chat fields, title) pairs, their conversation summaries and search index entries in one transaction."""
+    records = []
+    for fields, title in chats:
+        record = ChatHistory(**fields)
+        db.session.add(record)
+        records.append((record, title))
+        record_message(db.session, Conversation, fields['user_id'], fields['conversation_id'], title, fields['message'])
+    db.session.flush()  # assigns the ids the search index is keyed on
+    index_chats(db.session, [
+        (record.id, record.user_id, title, record.message, record.response) for record, title in records
+    ])
+    db.session.execute(history_version_update(User, {fields['user_id'] for fields, _ in chats}))
+    db.session.commit()
+
+
+def save_batch(session, job_id, user_id, chats, results, refund=0):
+    """End a batch job in one transaction: its chats (each opening a conversation) in one bulk INSERT, their
+    conversation summaries and search index entries, `refund` tokens given back and the job's results."""
+    now = datetime.datetime.utcnow()
+    if chats:
+        session.add_all(new_summary(Conversation, user_id, chat['conversation_id'], chat['title'], chat['message'], now)
+                        for chat in chats)
+        ids = session.scalars(insert(ChatHistory).returning(ChatHistory.id, sort_by_parameter_order=True), chats).all()
+        index_chats(session, [
+            (chat_id, user_id, chat['title'], chat['message'], chat['response']) for chat_id, chat in zip(ids, chats)
+        ])
+        session.execute(history_version_update(User, [user_id]))
+    if refund:
+        session.execute(refund_statement(User, user_id, refund))
+    session.execute(
+        update(BatchJob).where(BatchJob.id == job_id)
+        .values(status='done' if chats else 'failed', finished_at=now, failed_count=len(results) - len(chats),
+                results=json.dumps(results))
+        .execution_options(synchronize_session=False)
+    )
+    session.commit()
+
+
+def restore_conversation(session, conversation_id):
+    """Move an archived conversation's chats back into chat_history, before it is read or continued."""
+    archive = session.execute(
+        select(ChatArchive.user_id, ChatArchive.chats).where(ChatArchive.conversation_id == conversation_id)
+    ).first()
+    # Deleting the archive claims it: a request restoring the same conversation at once deletes nothing
+    claimed = session.execute(delete(ChatArchive).where(ChatArchive.conversation_id == conversation_id)).rowcount
+    session.execute(
+        update(Conversation).where(Conversation.id == conversation_id).values(archived_at=None)
+        .execution_options(synchronize_session=False)
+    )
+    if archive is not None and claimed:
+        records = [
+            ChatHistory(user_id=archive.user_id, conversation_id=conversation_id, title=chat['title'],
+                        message=chat['message'], response=chat['response'], timestamp=chat['timestamp'],
+                        model=chat['model'])
+            for chat in unpack_chats(archive.chats)
+        ]
+        session.add_all(records)
+        session.flush()
+        index_chats(session, [
+            (record.id, record.user_id, record.title, record.message, record.response) for record in records
+        ])
+        session.execute(history_version_update(User, [archive.user_id]))
+        CHAT_RESTORES.inc()
+    session.commit()
+
+
+def archive_conversations(session, before, limit):
+    """Move up to `limit` conversations not updated since `before` into chat_archive; (conversations, chats) moved."""
+    conversations = session.execute(
+        select(Conversation.id, Conversation.user_id)
+        .where(Conversation.updated_at < before, Conversation.archived_at.is_(None))
+        .order_by(Conversation.updated_at)
+        .limit(limit)
+    ).all()
+
+    archived = moved = 0
+    for conversation_id, user_id in conversations:
+        now = datetime.datetime.utcnow()
+        # Flagging it first takes the write lock; a chat saved since the query above makes it recent again
+        claimed = session.execute(
+            update(Conversation)
+            .where(Conversation.id == conversation_id, Conversation.updated_at < before,
+                   Conversation.archived_at.is_(None))
+            .values(archived_at=now)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if not claimed:
+            session.rollback()
+            continue
+
+        columns = [ChatHistory.id, ChatHistory.title, ChatHistory.message, ChatHistory.response,
+                   ChatHistory.timestamp, ChatHistory.model]
+        chats = [row._asdict() for row in session.execute(
+            select(*columns).where(ChatHistory.conversation_id == conversation_id)
+            .order_by(ChatHistory.timestamp, ChatHistory.id)
+        )]
+        if chats:
+            session.add(ChatArchive(
+                conversation_id=conversation_id, user_id=user_id, chat_count=len(chats),
+                first_timestamp=chats[0]['timestamp'], last_timestamp=chats[-1]['timestamp'], archived_at=now,
+                chats=pack_chats(dict(chat, conversation_id=conversation_id) for chat in chats),
+            ))
+            session.execute(delete(ChatHistory).where(ChatHistory.conversation_id == conversation_id))
+            unindex_chats(session, [chat['id'] for chat in chats])
+            session.execute(history_version_update(User, [user_id]))
+        session.commit()
+        archived += 1
+        moved += len(chats)
+    return archived, moved
+
+
+def compress_responses(session, after_id, limit):
+    """Compress stored answers among the `limit` chats after id `after_id`.
+
+    Returns (rows rewritten, their bytes before, bytes after, last id looked at or None).
+    """
+    stored = type_coerce(ChatHistory.response, LargeBinary)  # as stored, without decoding
+    rows = session.execute(
+        select(ChatHistory.id, stored.label('stored'))
+        .where(ChatHistory.id > after_id)
+        .order_by(ChatHistory.id)
+        .limit(limit)
+    ).all()
+
+    updates = []
+    before = after = 0
+    for row in rows:
+        if row.stored is None or is_compressed(row.stored):
+            continue
+        text = decode(row.stored)
+        packed = encode(text)
+        if is_compressed(packed):
+            updates.append({'chat_id': row.id, 'response': text})
+            before += len(text.encode())
+            after += len(packed)
+    if updates:
+        table = ChatHistory.__table__
+        session.execute(
+            table.update().where(table.c.id == bindparam('chat_id')).values(response=bindparam('response')),
+            updates,
+        )
+    session.commit()
+    return len(updates), before, after, rows[-1].id if rows else None
+
+
+def compact_chats(session, after_id, archive_before, batch_size):
+    """One compaction step for chat_storage.Compactor: its report, with the last chat id looked at."""
+    compressed, bytes_before, bytes_after, last_id = compress_responses(session, after_id, batch_size)
+    archived, archived_chats = (0, 0) if archive_before is None else \
+        archive_conversations(session, archive_before, batch_size)
+    return {
+        'compressed': compressed, 'bytes_before': bytes_before, 'bytes_after': bytes_after,
+        'archived': archived, 'archived_chats': archived_chats, 'last_id': last_id,
+    }
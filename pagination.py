@@ -0,0 +1,61 @@
+import base64
+import datetime
+import json
+
+from sqlalchemy import and_, or_
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+
+def page_args(args):
+    """Read `limit` and `cursor` from request args; raises ValueError on bad input."""
+    limit = int(args.get('limit', DEFAULT_LIMIT))
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    cursor = args.get('cursor')
+    return min(limit, MAX_LIMIT), decode_cursor(cursor) if cursor else None
+
+
+def encode_cursor(row, column='timestamp'):
+    raw = json.dumps([getattr(row, column).isoformat(), row.id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        value, row_id = json.loads(raw)
+        return datetime.datetime.fromisoformat(value), row_id
+    except (ValueError, TypeError, UnicodeDecodeError) as e:
+        raise ValueError("invalid cursor") from e
+
+
+def keyset(query, model, limit, cursor=None, newest_first=True, column='timestamp'):
+    """Order `query` by (`column`, id) and resume after `cursor`.
+
+    Works on both ORM queries and select() statements. One extra row is fetched
+    so the caller can tell whether another page exists; pass the rows to page().
+    """
+    order_by = getattr(model, column)
+    if cursor is not None:
+        value, row_id = cursor
+        if newest_first:
+            after = or_(order_by < value, and_(order_by == value, model.id < row_id))
+        else:
+            after = or_(order_by > value, and_(order_by == value, model.id > row_id))
+        query = query.filter(after)
+
+    if newest_first:
+        query = query.order_by(order_by.desc(), model.id.desc())
+    else:
+        query = query.order_by(order_by.asc(), model.id.asc())
+    return query.limit(limit + 1)
+
+
+def page(rows, limit, column='timestamp'):
+    """Split the rows fetched by keyset() into (this page, cursor for the next page or None)."""
+    rows = list(rows)
+    if len(rows) > limit:
+        return rows[:limit], encode_cursor(rows[limit - 1], column)
+    return rows, None
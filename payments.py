@@ -0,0 +1,92 @@
+"""PayPal subscription payments."""
+from flask import Blueprint, current_app, jsonify, request, session
+
+from extensions import auth_cache
+from models import User, db
+
+bp = Blueprint('payments', __name__)
+
+
+def paypal():
+    """The PayPal SDK, imported and configured on first use: most workers never take a payment."""
+    import paypalrestsdk
+
+    if 'paypal' not in current_app.extensions:
+        current_app.extensions['paypal'] = paypalrestsdk.configure({
+            "mode": current_app.config['PAYPAL_MODE'],
+            "client_id": current_app.config['PAYPAL_CLIENT_ID'],
+            "client_secret": current_app.config['PAYPAL_CLIENT_SECRET'],
+        })
+    return paypalrestsdk
+
+# Subscription endpoint
+@bp.route('/api/subscribe', methods=['POST'])
+def subscribe():
+    if 'user_id' not in session:
+        return jsonify({"error": "Unauthorized, please log in"}), 401
+
+    data = request.json
+    plan = data.get('plan')
+    months = data.get('months')
+
+    if plan not in ['1', '6', '12']:
+        return jsonify({"error": "Invalid plan, choose 1, 6, or 12 months"}), 400
+
+    user = User.query.get(session['user_id'])
+    if user is None:
+        return jsonify({"error": "User not found"}), 404
+
+    # Update subscription based on the plan
+    if plan == '1':
+        user.update_subscription('1 Month', 1)
+    elif plan == '6':
+        user.update_subscription('6 Months', 6)
+    else:
+        user.update_subscription('1 Year', 12)
+
+    db.session.commit()
+    auth_cache.invalidate(user.id)
+
+    # Now redirect to PayPal payment page
+    payment = paypal().Payment({
+        "intent": "sale",
+        "payer": {
+            "payment_method": "paypal"
+        },
+        "transactions": [{
+            "amount": {
+                "total": str(10 * months),  # Example cost: 10 USD per month
+                "currency": "USD"
+            },
+            "description": f"Subscription for {months} months"
+        }],
+        "redirect_urls": {
+            "return_url": "http://localhost:5000/api/payment/success",
+            "cancel_url": "http://localhost:5000/api/payment/cancel"
+        }
+    })
+
+    if payment.create():
+        for link in payment.links:
+            if link.rel == "approval_url":
+                return jsonify({"approval_url": link.href})
+
+    return jsonify({"error": "Payment creation failed"}), 500
+
+# PayPal payment success endpoint
+@bp.route('/api/payment/success', methods=['GET'])
+def payment_success():
+    payment_id = request.args.get('paymentId')
+    payer_id = request.args.get('PayerID')
+
+    payment = paypal().Payment.find(payment_id)
+
+    if payment.execute({"payer_id": payer_id}):
+        return jsonify({"message": "Payment successful, subscription activated!"}), 200
+    else:
+        return jsonify({"error": "Payment execution failed"}), 500
+
+# PayPal payment cancel endpoint
+@bp.route('/api/payment/cancel', methods=['GET'])
+def payment_cancel():
+    return jsonify({"message": "Payment cancelled"}), 200
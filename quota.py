@@ -0,0 +1,78 @@
+"""Race-free chat token accounting.
+
+Tokens are taken and refilled with single conditional UPDATE statements, so
+concurrent requests from one user can neither lose a deduction nor push the
+balance below zero. A token is reserved before the upstream call and refunded
+if the chat fails; a batch reserves one per prompt at once, all or none.
+"""
+import datetime
+
+from sqlalchemy import case, or_, update
+
+DAILY_TOKENS = 5
+REFILL_INTERVAL = datetime.timedelta(days=1)
+
+
+def reserve_statement(User, user_id, now, daily_refill=True, count=1):
+    """UPDATE that takes `count` tokens, first refilling the daily allowance if it is due.
+
+    It matches no row when the user has fewer than `count` tokens left.
+    """
+    if not daily_refill:
+        return (
+            update(User)
+            .where(User.id == user_id, User.token_count >= count)
+            .values(token_count=User.token_count - count)
+            .execution_options(synchronize_session=False)
+        )
+
+    refill_due = or_(User.last_token_update.is_(None), User.last_token_update <= now - REFILL_INTERVAL)
+    # The balance after any refill; a refill replaces whatever is stored, e.g. a legacy unlimited balance
+    balance = case((refill_due, DAILY_TOKENS), else_=User.token_count)
+    return (
+        update(User)
+        .where(User.id == user_id, balance >= count)
+        .values(
+            token_count=balance - count,
+            last_token_update=case((refill_due, now), else_=User.last_token_update),
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+def refund_statement(User, user_id, count=1):
+    """UPDATE that gives `count` reserved tokens back, never above the daily allowance."""
+    return (
+        update(User)
+        .where(User.id == user_id, User.token_count < DAILY_TOKENS)
+        .values(token_count=case((User.token_count + count > DAILY_TOKENS, DAILY_TOKENS),
+                                 else_=User.token_count + count))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def reserve_token(session, User, user_id, daily_refill=True, auth_cache=None, count=1):
+    """Take one token for a chat (`count` for a batch); False means the user has too few left.
+
+    Commits straight away so the row is not kept locked during the upstream call.
+    With an `auth_cache` (see auth_cache.py), a user it knows to be out of tokens
+    is turned away without the UPDATE, and its balance follows the outcome.
+    """
+    now = datetime.datetime.utcnow()
+    if auth_cache is not None and auth_cache.out_of_tokens(user_id, now, daily_refill):
+        return False
+    reserved = session.execute(reserve_statement(User, user_id, now, daily_refill, count)).rowcount == 1
+    session.commit()
+    if auth_cache is not None:
+        if reserved:
+            auth_cache.reserved(user_id, now, daily_refill, count)
+        elif count == 1:
+            auth_cache.exhausted(user_id)
+    return reserved
+
+
+def refund_token(session, User, user_id, auth_cache=None, count=1):
+    session.execute(refund_statement(User, user_id, count))
+    session.commit()
+    if auth_cache is not None:
+        auth_cache.refunded(user_id, count)
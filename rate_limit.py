@@ -0,0 +1,161 @@
+import math
+import threading
+import time
+
+# Defaults used when an app does not override them in its config: (requests, seconds)
+DEFAULT_USER_LIMIT = (20, 60)
+DEFAULT_IP_LIMIT = (60, 60)
+DEFAULT_MAX_KEYS = 100000
+
+
+class MemoryBackend:
+    """Token buckets kept in this process; each worker enforces the limits on its own."""
+
+    def __init__(self, max_keys=DEFAULT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, buckets):
+        """Take `cost` tokens from every (key, limit, period, cost) bucket, or from none of them.
+
+        Returns 0 if allowed, else seconds until every bucket has enough tokens free.
+        """
+        now = time.monotonic()
+        with self._lock:
+            levels, wait = [], 0
+            for key, limit, period, cost in buckets:
+                rate = limit / period
+                tokens, updated, _ = self._buckets.get(key, (limit, now, period))
+                tokens = min(limit, tokens + (now - updated) * rate)
+                levels.append((key, tokens, period, cost))
+                if tokens < cost:
+                    wait = max(wait, (cost - tokens) / rate)
+            for key, tokens, period, cost in levels:
+                self._buckets[key] = (tokens if wait else tokens - cost, now, period)
+            if len(self._buckets) > self.max_keys:
+                self._prune(now)
+            return wait
+
+    def _prune(self, now):
+        # A bucket idle for a whole period is full again, so forgetting it changes nothing
+        for key, (_, updated, period) in list(self._buckets.items()):
+            if now - updated >= period:
+                del self._buckets[key]
+        while len(self._buckets) > self.max_keys:
+            self._buckets.pop(next(iter(self._buckets)))
+
+
+# Token buckets as one atomic script, using the Redis clock so every worker agrees on time.
+# ARGV holds limit, period, cost for each key in turn; the cost is taken from every bucket or from none.
+TAKE_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local levels, wait = {}, 0
+for i, key in ipairs(KEYS) do
+    local limit, period, cost = tonumber(ARGV[3 * i - 2]), tonumber(ARGV[3 * i - 1]), tonumber(ARGV[3 * i])
+    local rate = limit / period
+    local bucket = redis.call('HMGET', key, 'tokens', 'updated')
+    local tokens = tonumber(bucket[1]) or limit
+    local updated = tonumber(bucket[2]) or now
+    levels[i] = math.min(limit, tokens + (now - updated) * rate)
+    if levels[i] < cost then
+        wait = math.max(wait, (cost - levels[i]) / rate)
+    end
+end
+for i, key in ipairs(KEYS) do
+    local tokens = levels[i]
+    if wait == 0 then
+        tokens = tokens - tonumber(ARGV[3 * i])
+    end
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(tonumber(ARGV[3 * i - 1])))
+end
+return tostring(wait)
+"""
+
+
+class RedisBackend:
+    """Buckets shared by every worker, for multi-process deployments (needs redis)."""
+
+    def __init__(self, url, prefix='rate-limit:'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._take = self.client.register_script(TAKE_SCRIPT)
+
+    def take(self, buckets):
+        keys, args = [], []
+        for key, limit, period, cost in buckets:
+            keys.append(self.prefix + key)
+            args.extend((limit, period, cost))
+        return float(self._take(keys=keys, args=args))
+
+
+class RateLimiter:
+    """Per-user, per-IP and global request limits in front of the chat endpoints.
+
+    Each limit is a token bucket of `requests` tokens refilled evenly over `seconds`, so
+    short bursts up to the limit are allowed but the sustained rate is capped. A limit
+    of None is not enforced.
+    """
+
+    def __init__(self, backend, user_limit=DEFAULT_USER_LIMIT, ip_limit=DEFAULT_IP_LIMIT, global_limit=None):
+        self.backend = backend
+        self.user_limit = user_limit
+        self.ip_limit = ip_limit
+        self.global_limit = global_limit
+        self.rejected = 0
+
+    @classmethod
+    def from_config(cls, config):
+        url = config.get('RATE_LIMIT_URL')
+        if url:
+            backend = RedisBackend(url)
+        else:
+            backend = MemoryBackend(max_keys=config.get('RATE_LIMIT_MAX_KEYS', DEFAULT_MAX_KEYS))
+        return cls(
+            backend,
+            user_limit=config.get('RATE_LIMIT_USER', DEFAULT_USER_LIMIT),
+            ip_limit=config.get('RATE_LIMIT_IP', DEFAULT_IP_LIMIT),
+            global_limit=config.get('RATE_LIMIT_GLOBAL'),
+        )
+
+    def check(self, user_id, ip, cost=1):
+        """Return None if the request may go ahead, else the seconds to wait before retrying.
+
+        Every limit is checked before any is charged, so a request turned away by one
+        limit (say, one client flooding the endpoint) uses up none of the others.
+
+        `cost` is what the request counts for against the user's limit, e.g. the number
+        of prompts in a batch. It is capped at the limit itself, so a batch bigger than the
+        allowance can still go ahead, once, with a full bucket. The IP and global limits
+        count requests; batch prompts wait their turn under the global one (wait_global).
+        """
+        buckets = [
+            (key, *limit, min(key_cost, limit[0])) for key, limit, key_cost in (
+                (f"user:{user_id}" if user_id is not None else None, self.user_limit, cost),
+                (f"ip:{ip}" if ip else None, self.ip_limit, 1),
+                ("global", self.global_limit, 1),
+            ) if key is not None and limit is not None
+        ]
+        if not buckets:
+            return None
+        wait = self.backend.take(buckets)
+        if wait > 0:
+            self.rejected += 1
+            return retry_after(wait)
+        return None
+
+    def wait_global(self):
+        """Block until the global limit allows one more upstream call; for background work, which waits its turn."""
+        if self.global_limit is None:
+            return
+        while (wait := self.backend.take([("global", *self.global_limit, 1)])) > 0:
+            time.sleep(wait)
+
+
+def retry_after(wait):
+    """Whole seconds for a Retry-After header, never 0."""
+    return max(1, math.ceil(wait))
@@ -0,0 +1,240 @@
+"""Related past conversations, from a per-user similarity index over chat messages.
+
+Each message becomes a hashed TF-IDF vector: its words are hashed (CRC32) into
+RELATED_DIMENSIONS signed buckets, weighted by 1 + log(term count) and by the
+word's inverse document frequency among the user's messages, and L2-normalized.
+Nothing leaves the process and no model is loaded. A user's vectors are the
+columns of one NumPy matrix with a row per bucket, so scoring every message is a
+product of the query's non-zero buckets with just those rows, followed by a
+per-conversation maximum and a partial sort: a few milliseconds for 100k messages,
+where the whole matrix (100 MB at 256 dimensions) would take several times longer
+just to read.
+
+Indexes are built per process on a user's first query and kept in an LRU capped
+at RELATED_MAX_MESSAGES messages in all. Every query first folds in the chats saved
+since the user's last one (by id, whichever worker saved them), so each message
+is vectorized once. A message's IDF weights are the ones known when it was
+indexed, which settle as the history grows. Like search, the index covers the
+hot tier: conversations archived before it was built are not suggested until
+they are reopened.
+
+NumPy is imported on first use; without it related() finds nothing.
+"""
+import re
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from itertools import chain
+
+from sqlalchemy import select
+
+from conversations import serialize_conversation
+from logs import log_event
+from metrics import RELATED_QUERY_SECONDS
+
+# Defaults used when an app does not override them in its config
+DEFAULT_DIMENSIONS = 256
+DEFAULT_MAX_MESSAGES = 250000
+DEFAULT_LIMIT = 5
+MAX_LIMIT = 20
+LOAD_BATCH_SIZE = 5000
+
+WORD = re.compile(r'\w\w+')
+
+_numpy = None
+
+
+def numpy():
+    """NumPy, or None when it is not installed."""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy as np
+        except ImportError:
+            log_event('related_index_disabled', reason='numpy is not installed')
+            np = False
+        _numpy = np
+    return _numpy or None
+
+
+def related_args(args):
+    """Read `q`, `conversation_id` (at least one) and `limit`; raises ValueError on bad input."""
+    text = ' '.join(args.get('q', '').split())
+    conversation_id = args.get('conversation_id') or None
+    if not text and not conversation_id:
+        raise ValueError("q or conversation_id is required")
+    limit = int(args.get('limit', DEFAULT_LIMIT))
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    return text, conversation_id, min(limit, MAX_LIMIT)
+
+
+def related_conversations(session, index, ChatHistory, Conversation, user_id, text, conversation_id, limit):
+    """The user's conversations most like `text` (or like `conversation_id`), serialized with their scores."""
+    scored = index.related(session, ChatHistory, user_id, text, conversation_id, limit)
+    if not scored:
+        return []
+    conversations = {conversation.id: conversation for conversation in session.query(Conversation).filter(
+        Conversation.user_id == user_id, Conversation.id.in_([conversation_id for conversation_id, _ in scored]))}
+    return [dict(serialize_conversation(conversations[conversation_id]), score=round(score, 4))
+            for conversation_id, score in scored if conversation_id in conversations]
+
+
+def term_counts(text):
+    """How often each word of `text` occurs, keyed by the word's CRC32."""
+    return Counter(map(zlib.crc32, map(str.encode, WORD.findall(text.lower()))))
+
+
+class _UserIndex:
+    """One user's message vectors, their conversations and document frequencies."""
+
+    def __init__(self, np, dimensions):
+        self.vectors = np.zeros((dimensions, 0), dtype=np.float32)  # one column per message
+        self.codes = np.zeros(0, dtype=np.int32)  # column -> index into conversation_ids
+        self.size = 0
+        self.conversation_ids = []
+        self.code_of = {}
+        self.document_frequency = Counter()
+        self.last_id = 0
+        self.lock = threading.Lock()
+
+    def append(self, np, vectors, conversation_ids):
+        count = len(conversation_ids)
+        if self.size + count > len(self.codes):
+            # Grow by doubling, so appends stay amortized O(1) per message
+            capacity = max(self.size + count, 2 * len(self.codes), 64)
+            vectors_grown = np.zeros((self.vectors.shape[0], capacity), dtype=np.float32)
+            vectors_grown[:, :self.size] = self.vectors[:, :self.size]
+            codes_grown = np.zeros(capacity, dtype=np.int32)
+            codes_grown[:self.size] = self.codes[:self.size]
+            self.vectors, self.codes = vectors_grown, codes_grown
+        for conversation_id in conversation_ids:
+            if conversation_id not in self.code_of:
+                self.code_of[conversation_id] = len(self.conversation_ids)
+                self.conversation_ids.append(conversation_id)
+        self.codes[self.size:self.size + count] = [self.code_of[conversation_id]
+                                                   for conversation_id in conversation_ids]
+        self.vectors[:, self.size:self.size + count] = vectors.T
+        self.size += count
+
+
+class RelatedIndex:
+    """Per-process LRU of users' message vectors, answering "which past conversations are like this"."""
+
+    def __init__(self, dimensions=DEFAULT_DIMENSIONS, max_messages=DEFAULT_MAX_MESSAGES):
+        self.dimensions = dimensions
+        self.max_messages = max_messages
+        self.queries = 0
+        self.indexed = 0
+        self._users = OrderedDict()  # user id -> _UserIndex
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            dimensions=config.get('RELATED_DIMENSIONS', DEFAULT_DIMENSIONS),
+            max_messages=config.get('RELATED_MAX_MESSAGES', DEFAULT_MAX_MESSAGES),
+        )
+
+    def vectorize(self, np, counts, document_frequency, documents):
+        """Unit vectors, one row per term_counts(), weighted with the given document frequencies."""
+        rows = np.repeat(np.arange(len(counts)), [len(text_counts) for text_counts in counts])
+        terms = np.fromiter(chain.from_iterable(counts), dtype=np.uint32, count=len(rows))
+        occurrences = np.fromiter(chain.from_iterable(text_counts.values() for text_counts in counts),
+                                  dtype=np.float64, count=len(rows))
+        # Look each distinct term up once rather than once per message
+        unique, inverse = np.unique(terms, return_inverse=True)
+        frequency = np.array([document_frequency[term] for term in unique.tolist()], dtype=np.float64)
+        idf = np.log((1 + documents) / (1 + frequency)) + 1
+        # The low bits pick the bucket and the top bit its sign, so collisions tend to cancel out
+        weights = np.where(terms >> 31, -1.0, 1.0) * (1 + np.log(occurrences)) * idf[inverse]
+        cells = rows * self.dimensions + terms % self.dimensions
+        vectors = np.bincount(cells, weights=weights, minlength=len(counts) * self.dimensions)
+        vectors = vectors.astype(np.float32).reshape(len(counts), self.dimensions)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+    def _catch_up(self, np, session, ChatHistory, user_id, index):
+        """Index the user's chats saved since the last one this index has seen."""
+        statement = (
+            select(ChatHistory.id, ChatHistory.conversation_id, ChatHistory.message)
+            .where(ChatHistory.user_id == user_id, ChatHistory.id > index.last_id)
+            .order_by(ChatHistory.id)
+            .execution_options(yield_per=LOAD_BATCH_SIZE)
+        )
+        for rows in session.execute(statement).partitions():
+            counts = [term_counts(row.message) for row in rows]
+            # Count the batch's terms first, so its messages are weighted like the ones before them
+            index.document_frequency.update(chain.from_iterable(counts))
+            vectors = self.vectorize(np, counts, index.document_frequency, index.size + len(rows))
+            index.append(np, vectors, [row.conversation_id for row in rows])
+            index.last_id = rows[-1].id
+            self.indexed += len(rows)
+
+    def _index(self, np, session, ChatHistory, user_id):
+        with self._lock:
+            index = self._users.get(user_id)
+            if index is None:
+                index = self._users[user_id] = _UserIndex(np, self.dimensions)
+            self._users.move_to_end(user_id)
+        with index.lock:
+            self._catch_up(np, session, ChatHistory, user_id, index)
+        with self._lock:
+            # Evict least recently queried users once over the message budget, never the current one
+            total = sum(other.size for other in self._users.values())
+            while total > self.max_messages and len(self._users) > 1:
+                _, evicted = self._users.popitem(last=False)
+                total -= evicted.size
+        return index
+
+    def related(self, session, ChatHistory, user_id, text=None, conversation_id=None, limit=DEFAULT_LIMIT):
+        """(conversation id, cosine score) pairs for the user's conversations most like `text`, best first.
+
+        Without `text`, the query is the conversation's own messages taken together.
+        `conversation_id` itself is never returned.
+        """
+        np = numpy()
+        if np is None:
+            return []
+        self.queries += 1
+        index = self._index(np, session, ChatHistory, user_id)
+        started = time.perf_counter()
+        with index.lock:
+            size = index.size
+            vectors, codes = index.vectors[:, :size], index.codes[:size]
+            exclude = index.code_of.get(conversation_id)
+            if text:
+                query = self.vectorize(np, [term_counts(text)], index.document_frequency, size)[0]
+            elif exclude is not None:
+                query = vectors[:, np.flatnonzero(codes == exclude)].sum(axis=1)
+                norm = np.linalg.norm(query)
+                if norm:
+                    query /= norm
+            else:
+                return []
+            conversation_ids = list(index.conversation_ids)
+
+            # Only the buckets the query has words in contribute to the scores
+            buckets = np.flatnonzero(query)
+            scores = query[buckets] @ vectors[buckets]
+            # A conversation scores as its best-matching message
+            best = np.full(len(conversation_ids), -np.inf, dtype=np.float32)
+            np.maximum.at(best, codes, scores)
+        if exclude is not None:
+            best[exclude] = -np.inf
+        count = min(limit, int(np.sum(best > 0)))
+        top = np.argpartition(-best, count - 1)[:count] if count else []
+        top = sorted(top, key=lambda code: -best[code])
+        RELATED_QUERY_SECONDS.observe(time.perf_counter() - started)
+        return [(conversation_ids[code], float(best[code])) for code in top]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "users": len(self._users),
+                "messages": sum(index.size for index in self._users.values()),
+                "queries": self.queries,
+                "indexed": self.indexed,
+            }
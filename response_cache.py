@@ -0,0 +1,131 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+# Defaults used when an app does not override them in its config
+DEFAULT_TTL = 3600
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+def normalize_prompt(prompt):
+    """Collapse whitespace and case so trivially different prompts share an entry."""
+    return ' '.join(prompt.split()).casefold()
+
+
+class MemoryBackend:
+    """In-process LRU store with per-entry expiry, bounded by entry count and bytes."""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at, _ = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        cost = len(key) + len(value.encode())
+        if cost > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.monotonic() + ttl, cost)
+            self.size += cost
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        _, _, cost = self._entries.pop(key)
+        self.size -= cost
+
+    def stats(self):
+        return {"entries": len(self._entries), "bytes": self.size}
+
+
+class RedisBackend:
+    """Shared store for multi-worker deployments; Redis handles expiry and eviction (needs redis)."""
+
+    def __init__(self, url, prefix='chat-cache:'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return value.decode() if value is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, value, ex=int(ttl))
+
+    def stats(self):
+        info = self.client.info('memory')
+        return {"bytes": info.get('used_memory')}
+
+
+class ResponseCache:
+    """Caches upstream answers keyed on the normalized prompt and the model that produced them."""
+
+    def __init__(self, backend, ttl=DEFAULT_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_config(cls, config):
+        url = config.get('CHAT_CACHE_URL')
+        if url:
+            backend = RedisBackend(url)
+        else:
+            backend = MemoryBackend(
+                max_entries=config.get('CHAT_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES),
+                max_bytes=config.get('CHAT_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES),
+            )
+        return cls(backend, ttl=config.get('CHAT_CACHE_TTL', DEFAULT_TTL))
+
+    @staticmethod
+    def key(prompt, model):
+        return hashlib.sha256(f"{model}\0{normalize_prompt(prompt)}".encode()).hexdigest()
+
+    def get(self, prompt, model):
+        value = self.backend.get(self.key(prompt, model))
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, prompt, model, response):
+        self.backend.set(self.key(prompt, model), response, self.ttl)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(
+            self.backend.stats(),
+            hits=self.hits,
+            misses=self.misses,
+            hit_rate=self.hits / lookups if lookups else 0.0,
+        )
+
+
+def cache_requested(request):
+    """Per-request opt-out: `"cache": false` in the JSON body or a `Cache-Control: no-cache` header."""
+    if 'no-cache' in request.headers.get('Cache-Control', ''):
+        return False
+    data = request.get_json(silent=True) or {}
+    return data.get('cache', True) is not False
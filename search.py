@@ -0,0 +1,230 @@
+"""Full-text search over a user's chat history.
+
+On SQLite, chats are indexed in the FTS5 table chat_history_fts. The save path fills
+it (index_chats), not triggers on chat_history, so the index always holds the text the
+user saw, whatever form chat_history stores it in. Each row's owner column holds a
+`u<user_id>` token: a search intersects that user's postings with the query's instead
+of ranking every user's matches and filtering afterwards.
+
+On PostgreSQL, chat_history_fts is a plain table with the same columns, filled the
+same way, plus a stored tsvector column under a GIN index and ranked with ts_rank.
+The owner token gets its own weight (D), so a query for it cannot match chat text.
+
+Other databases (MySQL) are not indexed: they get an unranked scan of the user's
+chats so the endpoint still works, matched in Python since answers are stored
+compressed.
+"""
+import html
+import re
+from itertools import islice
+
+from sqlalchemy import inspect, text
+
+from chat_storage import decode
+from pagination import DEFAULT_LIMIT, MAX_LIMIT
+
+FTS_TABLE = 'chat_history_fts'
+
+# bm25 column weights: owner, title, message, response
+RANK_WEIGHTS = (0.0, 3.0, 2.0, 1.0)
+SNIPPET_TOKENS = 16
+MIN_PREFIX = 3
+SCAN_BATCH_SIZE = 500  # chats decoded at a time by the scan on other databases
+MARK_START, MARK_END = '\x02', '\x03'
+WORD = re.compile(r'\w+')
+
+# ts_rank weights for {D, C, B, A} (owner, response, message, title): RANK_WEIGHTS scaled to at most 1
+TS_RANK_WEIGHTS = '{0, 0.33, 0.67, 1}'
+TSVECTOR = (
+    "setweight(to_tsvector('simple', owner), 'D') || setweight(to_tsvector('simple', title), 'A') || "
+    "setweight(to_tsvector('simple', message), 'B') || setweight(to_tsvector('simple', response), 'C')"
+)
+
+
+def uses_fts(bind):
+    return bind.dialect.name in ('sqlite', 'postgresql')
+
+
+def create_search_index(conn):
+    """Migration step: create the search index table and index the chats already stored."""
+    if conn.dialect.name == 'postgresql':
+        _create_tsvector_index(conn)
+        return
+    if not uses_fts(conn):
+        return
+    conn.execute(text(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} "
+        "USING fts5(owner, title, message, response, tokenize='unicode61 remove_diacritics 2', prefix='3')"
+    ))
+    # chat_history gets its title column in a later migration on databases app1.py created
+    columns = {column['name'] for column in inspect(conn).get_columns('chat_history')}
+    title = "COALESCE(title, '')" if 'title' in columns else "''"
+    conn.execute(text(f"""
+        INSERT INTO {FTS_TABLE} (rowid, owner, title, message, response)
+        SELECT id, 'u' || user_id, {title}, message, response FROM chat_history
+         WHERE id NOT IN (SELECT rowid FROM {FTS_TABLE})
+    """))
+
+
+def _create_tsvector_index(conn):
+    conn.execute(text(f"""
+        CREATE TABLE IF NOT EXISTS {FTS_TABLE} (
+            rowid BIGINT PRIMARY KEY, owner TEXT NOT NULL, title TEXT NOT NULL, message TEXT NOT NULL,
+            response TEXT NOT NULL, document TSVECTOR GENERATED ALWAYS AS ({TSVECTOR}) STORED
+        )
+    """))
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{FTS_TABLE}_document ON {FTS_TABLE} USING GIN (document)"))
+    # Answers may be stored compressed, so they are decoded here rather than copied in SQL
+    chats = conn.execute(text(f"""
+        SELECT id, user_id, title, message, response FROM chat_history
+         WHERE id NOT IN (SELECT rowid FROM {FTS_TABLE})
+    """).execution_options(stream_results=True, yield_per=SCAN_BATCH_SIZE))
+    for batch in chats.partitions():
+        conn.execute(
+            text(f"INSERT INTO {FTS_TABLE} (rowid, owner, title, message, response) "
+                 "VALUES (:id, :owner, :title, :message, :response)"),
+            [{'id': chat_id, 'owner': f"u{user_id}", 'title': title or '', 'message': message,
+              'response': decode(response)} for chat_id, user_id, title, message, response in batch],
+        )
+
+
+def index_chats(session, chats):
+    """Add (id, user_id, title, message, response) tuples to the index in the caller's transaction."""
+    if not chats or not uses_fts(session.get_bind()):
+        return
+    session.execute(
+        text(f"INSERT INTO {FTS_TABLE} (rowid, owner, title, message, response) "
+             "VALUES (:id, :owner, :title, :message, :response)"),
+        [{'id': chat_id, 'owner': f"u{user_id}", 'title': title or '', 'message': message, 'response': response}
+         for chat_id, user_id, title, message, response in chats],
+    )
+
+
+def unindex_chats(session, chat_ids):
+    """Remove chats from the index in the caller's transaction."""
+    if not chat_ids or not uses_fts(session.get_bind()):
+        return
+    session.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :id"), [{'id': chat_id} for chat_id in chat_ids])
+
+
+def search_args(args):
+    """Read `q`, `limit` and `cursor` (an offset into the ranked results); raises ValueError on bad input."""
+    query = ' '.join(args.get('q', '').split())
+    if not query:
+        raise ValueError("q is required")
+    limit = int(args.get('limit', DEFAULT_LIMIT))
+    offset = int(args.get('cursor', 0))
+    if limit < 1 or offset < 0:
+        raise ValueError("limit and cursor must be positive")
+    return query, min(limit, MAX_LIMIT), offset
+
+
+def match_expression(user_id, query):
+    """FTS5 query: every word must appear in this user's chats.
+
+    The last word also matches as a prefix, for search-as-you-type, once it is long enough
+    to use the 3-character prefix index; shorter prefixes would expand to too many terms.
+    """
+    words = query.split()
+    terms = ['"' + word.replace('"', '""') + '"' for word in words]
+    if len(words[-1]) >= MIN_PREFIX:
+        terms[-1] += '*'
+    return f'owner : "u{user_id}" AND {{title message response}} : ({" ".join(terms)})'
+
+
+def tsquery(user_id, query):
+    """to_tsquery() text for the same search as match_expression(), or None if the query has no words."""
+    words = WORD.findall(query.lower())
+    if not words:
+        return None
+    terms = [f"'{word}'" for word in words]
+    if len(words[-1]) >= MIN_PREFIX:
+        terms[-1] += ':*'
+    return ' & '.join([f"'u{user_id}':D", *terms])
+
+
+def best_snippet(*snippets):
+    """The first snippet with a match in it (a title-only match has none)."""
+    return next((snippet for snippet in snippets if MARK_START in snippet), snippets[-1])
+
+
+def highlight(snippet):
+    """HTML-escape a snippet and wrap the matched words in <mark>."""
+    return html.escape(snippet).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>')
+
+
+def search_chats(session, ChatHistory, user_id, query, limit, offset):
+    """Return (results, next cursor or None), best match first."""
+    bind = session.get_bind()
+    if uses_fts(bind):
+        ranked = _tsvector_rows if bind.dialect.name == 'postgresql' else _fts5_rows
+        rows = ranked(session, user_id, query, limit, offset)
+        results = [{
+            "conversation_id": row.conversation_id,
+            "title": row.title,
+            "message": row.message,
+            "snippet": highlight(best_snippet(row.message_snippet, row.response_snippet)),
+            "score": row.score,
+            "timestamp": _timestamp(row.timestamp),
+        } for row in rows[:limit]]
+    else:
+        needle = query.lower()
+        chats = ChatHistory.query.filter_by(user_id=user_id) \
+            .order_by(ChatHistory.timestamp.desc(), ChatHistory.id.desc()) \
+            .yield_per(SCAN_BATCH_SIZE)
+        matches = (chat for chat in chats
+                   if any(needle in (value or '').lower() for value in (chat.message, chat.response, chat.title)))
+        rows = list(islice(matches, offset, offset + limit + 1))
+        results = [{
+            "conversation_id": chat.conversation_id,
+            "title": chat.title,
+            "message": chat.message,
+            "snippet": html.escape(chat.response[:200]),
+            "score": None,
+            "timestamp": chat.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+        } for chat in rows[:limit]]
+
+    next_cursor = str(offset + limit) if len(rows) > limit else None
+    return results, next_cursor
+
+
+def _fts5_rows(session, user_id, query, limit, offset):
+    return session.execute(text(f"""
+        SELECT h.conversation_id, h.message, h.timestamp, f.title,
+               snippet({FTS_TABLE}, 2, :start, :end, '…', :tokens) AS message_snippet,
+               snippet({FTS_TABLE}, 3, :start, :end, '…', :tokens) AS response_snippet,
+               -bm25({FTS_TABLE}, {', '.join(map(str, RANK_WEIGHTS))}) AS score
+          FROM {FTS_TABLE} f JOIN chat_history h ON h.id = f.rowid
+         WHERE {FTS_TABLE} MATCH :match
+         ORDER BY score DESC, f.rowid DESC
+         LIMIT :limit OFFSET :offset
+    """), {
+        'match': match_expression(user_id, query), 'start': MARK_START, 'end': MARK_END,
+        'tokens': SNIPPET_TOKENS, 'limit': limit + 1, 'offset': offset,
+    }).all()
+
+
+def _tsvector_rows(session, user_id, query, limit, offset):
+    match = tsquery(user_id, query)
+    if match is None:
+        return []
+    return session.execute(text(f"""
+        SELECT h.conversation_id, h.message, h.timestamp, f.title,
+               ts_headline('simple', f.message, q, :options) AS message_snippet,
+               ts_headline('simple', f.response, q, :options) AS response_snippet,
+               ts_rank(CAST('{TS_RANK_WEIGHTS}' AS REAL[]), f.document, q) AS score
+          FROM {FTS_TABLE} f JOIN chat_history h ON h.id = f.rowid, to_tsquery('simple', :match) q
+         WHERE f.document @@ q
+         ORDER BY score DESC, f.rowid DESC
+         LIMIT :limit OFFSET :offset
+    """), {
+        'match': match, 'limit': limit + 1, 'offset': offset,
+        'options': f"StartSel={MARK_START}, StopSel={MARK_END}, MaxWords={SNIPPET_TOKENS}, MinWords=4",
+    }).all()
+
+
+def _timestamp(value):
+    # Raw SQL on SQLite returns DATETIME columns as text
+    if isinstance(value, str):
+        return value[:19]
+    return value.strftime('%Y-%m-%d %H:%M:%S')
@@ -0,0 +1,17 @@
+import json
+
+
+def sse_event(data, event=None):
+    """Format one server-sent event whose data is a JSON object."""
+    lines = []
+    if event:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+# Headers that keep proxies from buffering an event stream
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',
+}
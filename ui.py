@@ -0,0 +1,414 @@
+"""HTML UI: sign up, log in, the chat page and conversation history."""
+import datetime
+import logging
+import uuid
+
+from flask import (Blueprint, Response, current_app, jsonify, make_response, redirect, render_template, request,
+                   session, stream_with_context, url_for)
+
+from context import load_turns
+from conversations import TITLE_LENGTH, serialize_conversation
+from export import EXPORT_FORMATS, accepts_gzip, chat_records, encode, export_args, gzip_chunks
+from credentials import CredentialsBusy, authenticate
+from extensions import (auth_cache, chat_context, chat_writes, gemini, password_hasher, rate_limiter, related_index,
+                        response_cache)
+from gemini_client import UpstreamError, extract_text
+from http_cache import not_modified, tag, version_etag
+from logs import log_event
+from metrics import StageTimer
+from models import ChatArchive, ChatHistory, Conversation, User, db, restore_conversation
+from pagination import keyset, page, page_args
+from quota import refund_token, reserve_token
+from related import related_args, related_conversations
+from response_cache import cache_requested
+from sse import SSE_HEADERS, sse_event
+
+bp = Blueprint('ui', __name__)
+
+# Number of conversations listed in the chat page sidebar
+SIDEBAR_CONVERSATIONS = 50
+
+# Turn away chat requests over the rate limits before they reach the database or upstream
+@bp.before_request
+def limit_chat_rate():
+    if request.method != 'POST' or request.endpoint not in ('ui.chat', 'ui.chat_stream'):
+        return None
+    wait = rate_limiter.check(session.get('user_id'), request.remote_addr)
+    if wait is None:
+        return None
+    message = {'ai_response': 'Too many messages, please wait a moment and try again.'}
+    if request.endpoint == 'ui.chat_stream':
+        return Response(sse_event(message, event='error'), status=429, mimetype='text/event-stream',
+                        headers=dict(SSE_HEADERS, **{'Retry-After': str(wait)}))
+    return jsonify(message), 429, {'Retry-After': str(wait)}
+
+def credentials_busy(error):
+    # The password hashing queue is full: shed the request rather than let it wait
+    return 'Too many sign-ins right now, please try again shortly.', 503, {'Retry-After': str(error.retry_after)}
+
+def user_not_found():
+    # The session outlived its account: forget it, so the next page asks to log in
+    session.pop('user_id', None)
+    return 'User not found, please log in again.', 404
+
+# Route for home page
+@bp.route('/')
+def index():
+    return render_template('index.html')
+
+# Route for signup page
+@bp.route('/signup', methods=['GET', 'POST'])
+def signup():
+    if request.method == 'POST':
+        email = request.form['email']
+        password = request.form['password']
+        user = User.query.filter_by(email=email).first()
+
+        if user:
+            return 'Email already exists, please log in.'
+        # Hand the connection back while the password is hashed
+        db.session.rollback()
+
+        new_user = User(email=email)
+        try:
+            new_user.password = password_hasher.hash(password)
+        except CredentialsBusy as e:
+            return credentials_busy(e)
+        db.session.add(new_user)
+        db.session.commit()
+        # SQLite may reuse a deleted user's id
+        auth_cache.invalidate(new_user.id)
+        return redirect(url_for('.login'))
+    return render_template('signup.html')
+
+# Route for login page
+@bp.route('/login', methods=['GET', 'POST'])
+def login():
+    if request.method == 'POST':
+        email = request.form['email']
+        password = request.form['password']
+        try:
+            user = authenticate(db.session, User, password_hasher, email, password)
+        except CredentialsBusy as e:
+            return credentials_busy(e)
+
+        if user:
+            session['user_id'] = user.id
+            session['conversation_id'] = str(uuid.uuid4())  # New conversation ID for each login
+            auth_cache.put(user)
+            return redirect(url_for('.chat'))
+        else:
+            return 'Invalid credentials'
+
+    return render_template('login.html')
+# Route for logout
+@bp.route('/logout')
+def logout():
+    user_id = session.pop('user_id', None)
+    if user_id is not None:
+        auth_cache.invalidate(user_id)
+    return redirect(url_for('.index'))
+
+# Chat page (Authenticated users can access)
+@bp.route('/chat', methods=['GET', 'POST'])
+def chat():
+    if 'user_id' not in session:
+        return redirect(url_for('.login'))
+
+    stages = StageTimer(request.endpoint)
+    chat_writes.wait(session['user_id'])
+    user = auth_cache.get(session['user_id'], User.query.get)
+    if user is None:
+        return user_not_found()
+
+    if request.method == 'POST':
+        stages.lap('load_user')
+        user_input = request.form['user_input']
+
+        # Generate a chat title based on the first message, limited to 50 characters
+        if 'conversation_id' not in session:
+            session['conversation_id'] = str(uuid.uuid4())
+            session['chat_title'] = user_input[:50]  # Use first message as chat title
+
+        # Reserve a token unless the user has a subscription; it is refunded if the chat fails
+        metered = not user.is_subscribed()
+        if metered and not reserve_token(db.session, User, user.id, daily_refill=current_app.config['TOKEN_DAILY_REFILL'],
+                                         auth_cache=auth_cache):
+            return jsonify({'ai_response': 'Token limit reached. Please subscribe for unlimited access.'})
+        stages.lap('quota')
+
+        conversation_id = session['conversation_id']
+        conversation = Conversation.query.filter_by(id=conversation_id, user_id=user.id).first()
+        if conversation is not None and conversation.archived_at is not None:
+            # Its chats move back from the archive before the earlier turns are read
+            restore_conversation(db.session, conversation_id)
+
+        # Serve repeated prompts from the response cache unless the client opted out;
+        # only an answer that opens a conversation depends on the prompt alone
+        use_cache = cache_requested(request) and conversation is None
+        model = gemini.choose(user_input, subscribed=not metered)[0]
+        ai_response = response_cache.get(user_input, model) if use_cache else None
+        stages.lap('cache')
+
+        if ai_response is None:
+            # Send request to Gemini API, with the conversation's earlier turns
+            data = chat_context.build_payload(
+                conversation, user_input, lambda skip: load_turns(ChatHistory, user.id, conversation_id, skip)
+            )
+            # The chat itself may be saved by the write-behind worker, so persist any new summary now
+            if db.session.dirty:
+                db.session.commit()
+            stages.lap('context')
+            try:
+                model, response = gemini.generate_content(data, subscribed=not metered)
+            except UpstreamError:
+                response = None
+            stages.lap('upstream')
+
+            if response is None or response.status_code != 200:
+                if metered:
+                    refund_token(db.session, User, user.id, auth_cache=auth_cache)
+                return jsonify({'ai_response': 'Error occurred, please try again.'})
+
+            try:
+                ai_response = extract_text(response.json())
+            except ValueError as e:
+                log_event('upstream_response_invalid', logging.WARNING, model=model, error=repr(e))
+                if metered:
+                    refund_token(db.session, User, user.id, auth_cache=auth_cache)
+                return jsonify({'ai_response': 'Error occurred, please try again.'})
+            if use_cache and ai_response != 'No response':
+                response_cache.set(user_input, model, ai_response)
+            stages.lap('parse')
+
+        # Save chat history with conversation_id (queued when write-behind is on)
+        chat_title = conversation.title if conversation else (session.get('chat_title') or user_input)[:TITLE_LENGTH]
+        chat_writes.put(user.id, (dict(
+            user_id=user.id,
+            conversation_id=conversation_id,
+            title=chat_title,
+            message=user_input,
+            response=ai_response,
+            timestamp=datetime.datetime.utcnow(),
+            model=model
+        ), chat_title))
+        chat_context.record_turn(conversation_id, user_input, ai_response)
+        stages.lap('save')
+
+        # Limit AI response to 50 words
+        words = ai_response.split()[:50]
+        limited_response = ' '.join(words)
+
+        return jsonify({'ai_response': limited_response})
+
+    # Fetch user's most recent conversations for the sidebar
+    conversations = Conversation.query.filter_by(user_id=user.id) \
+                    .order_by(Conversation.updated_at.desc()).limit(SIDEBAR_CONVERSATIONS).all()
+    chat_titles_display = [serialize_conversation(conversation) for conversation in conversations]
+
+    return render_template('chat.html', user=user, chat_titles=chat_titles_display)
+
+# Streaming variant of the chat POST, used by the chat page to show the answer as it arrives
+@bp.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    if 'user_id' not in session:
+        return redirect(url_for('.login'))
+
+    stages = StageTimer(request.endpoint)
+    chat_writes.wait(session['user_id'])
+    user = auth_cache.get(session['user_id'], User.query.get)
+    if user is None:
+        return user_not_found()
+    user_id = user.id
+    user_input = request.form['user_input']
+    stages.lap('load_user')
+
+    if 'conversation_id' not in session:
+        session['conversation_id'] = str(uuid.uuid4())
+        session['chat_title'] = user_input[:50]
+    conversation_id = session['conversation_id']
+
+    # Reserve a token unless the user has a subscription; it is refunded if the chat fails
+    metered = not user.is_subscribed()
+    if metered and not reserve_token(db.session, User, user_id, daily_refill=current_app.config['TOKEN_DAILY_REFILL'],
+                                     auth_cache=auth_cache):
+        return Response(sse_event({'ai_response': 'Token limit reached. Please subscribe for unlimited access.'}, event='error'),
+                            mimetype='text/event-stream', headers=SSE_HEADERS)
+    stages.lap('quota')
+
+    conversation = Conversation.query.filter_by(id=conversation_id, user_id=user_id).first()
+    if conversation is not None and conversation.archived_at is not None:
+        restore_conversation(db.session, conversation_id)
+    chat_title = conversation.title if conversation else (session.get('chat_title') or user_input)[:TITLE_LENGTH]
+
+    # A cached answer is sent as a single chunk
+    use_cache = cache_requested(request) and conversation is None
+    model = gemini.choose(user_input, subscribed=not metered)[0]
+    cached_response = response_cache.get(user_input, model) if use_cache else None
+    stages.lap('cache')
+
+    if cached_response is None:
+        data = chat_context.build_payload(
+            conversation, user_input, lambda skip: load_turns(ChatHistory, user_id, conversation_id, skip)
+        )
+        # The stream below runs in a fresh DB session, so persist any new summary now
+        db.session.commit()
+        stages.lap('context')
+        try:
+            model, upstream = gemini.stream_generate_content(data, subscribed=not metered)
+        except UpstreamError:
+            upstream = None
+
+        if upstream is None or upstream.status_code != 200:
+            if upstream is not None:
+                upstream.close()
+            if metered:
+                refund_token(db.session, User, user_id, auth_cache=auth_cache)
+            return Response(sse_event({'ai_response': 'Error occurred, please try again.'}, event='error'),
+                            mimetype='text/event-stream', headers=SSE_HEADERS)
+        chunks = gemini.iter_stream_text(upstream)
+        stages.lap('upstream')
+    else:
+        chunks = iter([cached_response])
+
+    def save(parts):
+        ai_response = ''.join(parts) or 'No response'
+        chat_writes.put(user_id, (dict(
+            user_id=user_id,
+            conversation_id=conversation_id,
+            title=chat_title,
+            message=user_input,
+            response=ai_response,
+            timestamp=datetime.datetime.utcnow(),
+            model=model
+        ), chat_title))
+        chat_context.record_turn(conversation_id, user_input, ai_response)
+
+    def stream_failed(parts, error):
+        log_event('upstream_stream_failed', logging.WARNING, received=len(parts), error=repr(error))
+        if metered:
+            refund_token(db.session, User, user_id, auth_cache=auth_cache)
+
+    def generate():
+        parts = []
+        try:
+            for text in chunks:
+                parts.append(text)
+                yield sse_event({'text': text})
+        except GeneratorExit:
+            # The browser went away mid-answer; finish reading so the chat is still saved
+            try:
+                parts.extend(chunks)
+            except (UpstreamError, ValueError) as e:
+                stream_failed(parts, e)
+            else:
+                save(parts)
+            raise
+        except (UpstreamError, ValueError) as e:
+            stream_failed(parts, e)
+            yield sse_event({'ai_response': 'Error occurred, please try again.'}, event='error')
+            return
+        stages.lap('stream')
+
+        save(parts)
+        if use_cache and cached_response is None and parts:
+            response_cache.set(user_input, model, ''.join(parts))
+        stages.lap('save')
+        yield sse_event({'conversation_id': conversation_id}, event='done')
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+
+@bp.route('/conversation/<conversation_id>')
+def conversation(conversation_id):
+    if 'user_id' not in session:
+        return redirect(url_for('.login'))
+
+    chat_writes.wait(session['user_id'])
+    user = auth_cache.get(session['user_id'], User.query.get)
+    if user is None:
+        return user_not_found()
+    try:
+        limit, cursor = page_args(request.args)
+    except ValueError:
+        return 'Invalid limit or cursor', 400
+
+    # The conversation only changes when a message is added to it
+    summary = Conversation.query.filter_by(id=conversation_id, user_id=user.id).first()
+    etag = version_etag(request.full_path, 'conversation', user.id, summary.message_count if summary else 0)
+    if (cached := not_modified(request, etag)) is not None:
+        return cached
+
+    if summary is not None and summary.archived_at is not None:
+        restore_conversation(db.session, conversation_id)
+    # Oldest first, so the conversation reads top to bottom
+    query = ChatHistory.query.filter_by(user_id=user.id, conversation_id=conversation_id)
+    chats, next_cursor = page(keyset(query, ChatHistory, limit, cursor, newest_first=False), limit)
+
+    return tag(make_response(render_template('conversation.html', chats=chats, next_cursor=next_cursor,
+                                             conversation_id=conversation_id)), etag)
+
+
+# Past conversations like the text typed in the chat box, or like the open conversation
+@bp.route('/related')
+def related():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    try:
+        text, conversation_id, limit = related_args(request.args)
+    except ValueError:
+        return jsonify({'error': 'Invalid q, conversation_id or limit'}), 400
+
+    user_id = session['user_id']
+    chat_writes.wait(user_id)
+    # The chat page's own conversation is never suggested to it
+    conversation_id = conversation_id or session.get('conversation_id')
+    return jsonify({'related': related_conversations(db.session, related_index, ChatHistory, Conversation, user_id,
+                                                     text, conversation_id, limit)})
+
+
+# Route to get chat history
+@bp.route('/get_history')
+def get_history():
+    if 'user_id' not in session:
+        return redirect(url_for('.login'))
+
+    chat_writes.wait(session['user_id'])
+    # Read the row rather than the auth cache: its history_version is what the ETag must reflect
+    user = User.query.get(session['user_id'])
+    if user is None:
+        return user_not_found()
+    try:
+        limit, cursor = page_args(request.args)
+    except ValueError:
+        return jsonify({'error': 'Invalid limit or cursor'}), 400
+
+    etag = version_etag(request.full_path, 'history', user.id, user.history_version)
+    if (cached := not_modified(request, etag)) is not None:
+        return cached
+
+    chat_history, next_cursor = page(keyset(ChatHistory.query.filter_by(user_id=user.id), ChatHistory, limit, cursor), limit)
+
+    history = [{"message": chat.message, "response": chat.response} for chat in chat_history]
+    return tag(make_response(jsonify({'history': history, 'next_cursor': next_cursor})), etag)
+
+# Stream the logged-in user's whole chat history (only chats after `since` when given)
+@bp.route('/export_history', methods=['GET'])
+def export_history():
+    if 'user_id' not in session:
+        return redirect(url_for('.login'))
+
+    try:
+        export_format, since = export_args(request.args)
+    except ValueError:
+        return jsonify({"message": "Invalid format or since"}), 400
+
+    user_id = session['user_id']
+    chat_writes.wait(user_id)
+    body = encode(chat_records(db.session, ChatHistory, user_id, since, ChatArchive=ChatArchive), export_format)
+    headers = {'Content-Disposition': f'attachment; filename=chat_history.{export_format}', 'Vary': 'Accept-Encoding'}
+    if accepts_gzip(request):
+        body = gzip_chunks(body)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(body), mimetype=EXPORT_FORMATS[export_format], headers=headers)
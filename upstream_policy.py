@@ -0,0 +1,152 @@
+"""Retry, deadline and circuit breaker policy for the Gemini clients.
+
+Both clients run each call as a series of attempts. An attempt that fails to
+connect, times out or gets a retryable status (429 or 5xx) is retried after a
+jittered exponential backoff: at least as long as the upstream's Retry-After
+asks (a Retry-After beyond the largest backoff ends the call instead), and only
+while the whole call stays inside its deadline. The breaker
+counts consecutive failed attempts. Once it opens, calls fail at once until a
+single probe after the cool-down succeeds.
+"""
+import datetime
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from logs import log_event
+
+# Defaults used when an app does not override them in its config
+DEFAULT_ATTEMPTS = 3
+DEFAULT_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 8
+DEFAULT_DEADLINE = 90
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta seconds or an HTTP date), or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+class RetryPolicy:
+    def __init__(self, attempts=DEFAULT_ATTEMPTS, backoff=DEFAULT_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF,
+                 deadline=DEFAULT_DEADLINE, hedge_after=None):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.hedge_after = hedge_after  # seconds before a second, identical request is sent; None disables hedging
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            attempts=config.get('GEMINI_RETRY_ATTEMPTS', DEFAULT_ATTEMPTS),
+            backoff=config.get('GEMINI_RETRY_BACKOFF', DEFAULT_BACKOFF),
+            max_backoff=config.get('GEMINI_RETRY_MAX_BACKOFF', DEFAULT_MAX_BACKOFF),
+            deadline=config.get('GEMINI_DEADLINE', DEFAULT_DEADLINE),
+            hedge_after=config.get('GEMINI_HEDGE_AFTER'),
+        )
+
+    def delay(self, attempt, retry_after=None):
+        """Wait before retry number `attempt` (from 1): full jitter, but never less than Retry-After."""
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+        return max(delay, retry_after or 0)
+
+    def next_delay(self, attempt, deadline, retry_after=None):
+        """Delay before the next attempt, or None when the call should give up now."""
+        if attempt >= self.attempts:
+            return None
+        # Asked to come back later than any backoff of ours: give up rather than hold the request
+        if retry_after is not None and retry_after > self.max_backoff:
+            return None
+        delay = self.delay(attempt, retry_after)
+        if time.monotonic() + delay >= deadline:
+            return None
+        return delay
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker, one per process.
+
+    Closed: calls go through. After `failure_threshold` failed attempts in a row it
+    opens and calls are refused for `reset_timeout` seconds. Then it lets one probe
+    through (half-open): success closes it again, failure reopens it.
+    """
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.rejected = 0
+        self.trips = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            failure_threshold=config.get('GEMINI_BREAKER_THRESHOLD', DEFAULT_FAILURE_THRESHOLD),
+            reset_timeout=config.get('GEMINI_BREAKER_RESET', DEFAULT_RESET_TIMEOUT),
+        )
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half_open' if self.probing else 'open'
+
+    @property
+    def available(self):
+        """Whether check() would let a call through now."""
+        return self.opened_at is None or (not self.probing and time.monotonic() - self.opened_at >= self.reset_timeout)
+
+    def check(self):
+        """None if a call may go upstream now, else the seconds until the breaker lets a probe through."""
+        with self._lock:
+            if self.opened_at is None:
+                return None
+            waited = time.monotonic() - self.opened_at
+            if waited >= self.reset_timeout and not self.probing:
+                self.probing = True
+                return None
+            self.rejected += 1
+            return max(self.reset_timeout - waited, 1)
+
+    def record_success(self):
+        with self._lock:
+            closing = self.opened_at is not None
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+        if closing:
+            log_event('upstream_circuit_closed', logging.WARNING)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            # A failed probe reopens at once; otherwise wait for the threshold
+            opening = self.probing or (self.opened_at is None and self.failures >= self.failure_threshold)
+            if opening:
+                self.opened_at = time.monotonic()
+                self.probing = False
+                self.trips += 1
+        if opening:
+            log_event('upstream_circuit_opened', logging.WARNING, failures=self.failures, reset_timeout=self.reset_timeout)
+
+    def stats(self):
+        return {"state": self.state, "failures": self.failures, "rejected": self.rejected, "trips": self.trips}
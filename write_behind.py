@@ -0,0 +1,162 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+from collections import Counter
+
+from logs import log_event
+
+# Defaults used when an app does not override them in its config
+DEFAULT_MAX_SIZE = 1000
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_PUT_TIMEOUT = 5
+
+
+class WriteBehindQueue:
+    """Saves chats on a background thread in batched transactions, off the request path.
+
+    `flush(items)` writes a list of items in one transaction on `session`, the app's
+    scoped DB session. When the queue is disabled, put() just calls it on the caller's thread. Otherwise:
+
+    - the worker takes everything queued (up to batch_size) per commit, so batches grow
+      with load instead of each chat waiting on its own commit;
+    - when the queue is full, put() blocks for up to put_timeout and then writes the item
+      itself, which slows producers down to what the database can take;
+    - items are counted per key until written, so a request can wait(key) to read its
+      own earlier chats back;
+    - whatever is still queued is written when the process exits.
+    """
+
+    def __init__(self, app, session, flush, enabled=False, max_size=DEFAULT_MAX_SIZE, batch_size=DEFAULT_BATCH_SIZE,
+                 put_timeout=DEFAULT_PUT_TIMEOUT):
+        self.app = app
+        self.session = session
+        self.flush = flush
+        self.enabled = enabled
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.put_timeout = put_timeout
+        self.written = 0
+        self.batches = 0
+        self.overflowed = 0
+        self.failed = 0
+        self._pid = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+        atexit.register(self.close)
+
+    @classmethod
+    def from_config(cls, app, session, flush):
+        config = app.config
+        return cls(
+            app,
+            session,
+            flush,
+            enabled=config.get('CHAT_WRITE_BEHIND', False),
+            max_size=config.get('CHAT_WRITE_QUEUE_SIZE', DEFAULT_MAX_SIZE),
+            batch_size=config.get('CHAT_WRITE_BATCH_SIZE', DEFAULT_BATCH_SIZE),
+            put_timeout=config.get('CHAT_WRITE_PUT_TIMEOUT', DEFAULT_PUT_TIMEOUT),
+        )
+
+    def _start(self):
+        # The worker thread does not survive a fork, so each process starts its own
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.max_size)
+            self._pending = Counter()
+            self._done = threading.Condition()
+            self._thread = threading.Thread(target=self._run, name='chat-write-behind', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def put(self, key, item):
+        if not self.enabled:
+            self.flush([item])
+            return
+
+        if self._pid != os.getpid():
+            self._start()
+        with self._done:
+            self._pending[key] += 1
+        try:
+            self._queue.put((key, item), timeout=self.put_timeout)
+        except queue.Full:
+            self.overflowed += 1
+            self._write([(key, item)])
+
+    def wait(self, key, timeout=None):
+        """Block until every item put under `key` by this process has been written.
+
+        Call it before the request opens its own DB connection: waiting while holding one
+        can starve the worker of the pool.
+        """
+        if not self.enabled or self._pid != os.getpid():
+            return
+        with self._done:
+            self._done.wait_for(lambda: not self._pending[key], timeout)
+
+    def _run(self):
+        stopping = False
+        while True:
+            entries = [] if stopping else [self._queue.get()]
+            while len(entries) < self.batch_size:
+                try:
+                    entries.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = stopping or None in entries
+            entries = [entry for entry in entries if entry is not None]
+            if entries:
+                with self.app.app_context():
+                    self._write(entries)
+            if stopping and self._queue.empty():
+                return
+
+    def _write(self, entries):
+        items = [item for _, item in entries]
+        try:
+            try:
+                self.flush(items)
+                written = len(items)
+            except Exception as e:
+                # One bad item should not lose the rest of the batch: retry them one by one
+                log_event('chat_batch_write_failed', logging.WARNING, size=len(items), error=repr(e))
+                self.session.rollback()
+                written = 0
+                for item in items:
+                    try:
+                        self.flush([item])
+                        written += 1
+                    except Exception as e:
+                        log_event('chat_write_failed', logging.ERROR, error=repr(e))
+                        self.session.rollback()
+                        self.failed += 1
+            self.written += written
+            self.batches += 1
+        finally:
+            with self._done:
+                for key, _ in entries:
+                    self._pending[key] -= 1
+                    if not self._pending[key]:
+                        del self._pending[key]
+                self._done.notify_all()
+
+    def close(self):
+        """Write everything still queued and stop the worker."""
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join()
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "queued": self._queue.qsize() if self._pid == os.getpid() else 0,
+            "written": self.written,
+            "batches": self.batches,
+            "overflowed": self.overflowed,
+            "failed": self.failed,
+        }